@@ -1,18 +1,421 @@
+import ipaddress
+import itertools
+import math
 import os
 
+from functools import wraps
+
 from flask import (
     Flask,
+    Response,
     request,
     abort,
+    has_app_context,
     jsonify,
     redirect,
+    stream_with_context,
     url_for
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy.exc import SQLAlchemyError
+
+from auth0 import AuthError, check_permissions, requires_auth
+from cache import response_cache
+from conditional import conditional
+from graph import cast_graph, GRAPH_MAX_DEGREES
+from instrumentation import finish_request, start_request, timed
+from jobs import format_job, JobFailed, JobQueue, JobWorkers, JOB_CHUNK_SIZE
+from metrics import (
+    auth_errors,
+    error_handler_hits,
+    record_pool,
+    registry,
+    CONTENT_TYPE
+)
+from models import (
+    setup_db,
+    db,
+    bulk_write,
+    clean_ids,
+    detail_tags,
+    invalidate_on_commit,
+    linked_ids,
+    linked_rows,
+    read_detail,
+    update_links_in_chunks,
+    validate_bulk,
+    BULK_CHUNK_SIZE,
+    GENDERS,
+    Movie,
+    Actor,
+    ReadQuery,
+    VERSIONED_TABLES
+)
+from pagination import encode_cursor, is_offset, page_args, paginate
+from pool import pool_status
+from ratelimit import RateLimited
+from replicas import read_replica, replica_set
+from serializer import dumps, json_response
+from search import (
+    full_text_search,
+    search_args,
+    search_terms,
+    ACTOR_FILTERS,
+    ACTOR_SORTS,
+    MOVIE_FILTERS,
+    MOVIE_SORTS
+)
+
+
+# Client networks allowed to call the /internal endpoints
+INTERNAL_NETWORKS = [
+    ipaddress.ip_network(network) for network in
+    os.getenv('INTERNAL_NETWORKS', '127.0.0.1/32,::1/128').split(',')
+    if network
+]
+
+# Rows fetched per round trip by the export endpoints
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+
+
+def export_ndjson(query, model, link_key=None, link_name=None):
+    '''Streams query results as newline-delimited json
+
+    Rows are read through a server-side cursor in batches of
+    EXPORT_BATCH_SIZE, so memory does not grow with the table size.
+
+    Parameters
+    ----------
+    query: query of movies or actors ordered by id, reading the
+           model's row_columns
+    model: Movie or Actor
+    link_key: 'movie_id' or 'actor_id' to add linked ids to every row,
+              loaded with one query per batch, optional
+    link_name: name of the field holding linked ids
+    '''
+
+    rows = iter(query.yield_per(EXPORT_BATCH_SIZE))
+    while True:
+        batch = list(itertools.islice(rows, EXPORT_BATCH_SIZE))
+        if not batch:
+            break
+        links = None
+        if link_key:
+            links = linked_ids(link_key, [row.id for row in batch])
+        lines = []
+        for row in batch:
+            item = model.format_row(row)
+            if links is not None:
+                item[link_name] = links[row.id]
+            lines.append(dumps(item))
+        yield b'\n'.join(lines) + b'\n'
+
+
+BULK_MODES = ['all_or_nothing', 'best_effort']
+
+
+def write_bulk(model, items, mode, chunk_size=BULK_CHUNK_SIZE,
+               progress=None):
+    '''Validates and writes the rows of a bulk request, see bulk_save
+
+    Database errors of bulk_write are raised
+
+    Returns the status, 200 or 422, and the json body of the response
+    '''
+
+    rows, errors = validate_bulk(model, items)
+    atomic = mode == 'all_or_nothing'
+    if atomic and errors:
+        return 422, {
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }
+    created, updated, failed = bulk_write(
+        model, rows, atomic=atomic, chunk_size=chunk_size, progress=progress)
+    errors = sorted(errors + failed, key=lambda error: error['index'])
+    return 200, {
+        'success': True,
+        'created': created,
+        'updated': updated,
+        'errors': errors
+    }
+
+
+def bulk_save(model, jwt, items, mode):
+    '''Validates and writes the rows of a bulk request
+
+    With 'Prefer: respond-async' the rows are only queued, see
+    queue_job
+
+    Parameters
+    ----------
+    model: Movie or Actor
+    jwt: payload of the caller's token
+    items: list of rows, rows with an 'id' update existing records
+    mode: 'all_or_nothing' writes nothing if any row is invalid or fails,
+          'best_effort' writes every valid row and reports the others
+
+    Returns json response with numbers of created and updated rows and
+    per-row errors
+    '''
+
+    if not isinstance(items, list) or mode not in BULK_MODES:
+        abort(400)
+    if any(isinstance(item, dict) and 'id' in item for item in items):
+        check_permissions(f'patch:{model.__tablename__}', jwt)
+    if prefers_async():
+        return queue_job('bulk', {'table': model.__tablename__,
+                                  'items': items, 'mode': mode},
+                         jwt, f'post:{model.__tablename__}')
+    try:
+        status, body = write_bulk(model, items, mode)
+    except Exception:
+        abort(422)
+    return jsonify(body), status
+
+
+# Asynchronous writes
+# ------------------------------------------------
+
+# Jobs queued by the write endpoints, run by threads of the worker that
+# queued them or by `python manage.py jobs`
+job_workers = JobWorkers(JobQueue())
+
+MODELS = {'movies': Movie, 'actors': Actor}
+
+
+def prefers_async():
+    '''True if the client asked for an asynchronous write with the
+    header 'Prefer: respond-async'
+    '''
+
+    preferences = request.headers.get('Prefer', '').split(',')
+    return any(preference.split(';')[0].strip().lower() == 'respond-async'
+               for preference in preferences)
+
+
+def queue_job(kind, payload, jwt, permission):
+    '''Queues a job of the caller and answers 202 with its id
+
+    Parameters
+    ----------
+    kind: handler of the job, see job_workers
+    payload: json arguments of the handler
+    jwt: payload of the caller's token, the only client reading the job
+    permission: permission needed to read the job
+    '''
+
+    id = job_workers.submit(kind, payload, jwt.get('sub'), permission)
+    url = url_for('get_job', job_id=id)
+    return jsonify({
+        'success': True,
+        'job': id,
+        'status_url': url
+    }), 202, {'Location': url, 'Preference-Applied': 'respond-async'}
+
+
+def queue_update(model, id, jwt):
+    '''Validates a PATCH request of model and queues it, answers 400 if
+    invalid
+    '''
+
+    data = request.get_json()
+    try:
+        validate_update(model, data)
+    except ValueError:
+        abort(400)
+    return queue_job('update', {'table': model.__tablename__, 'id': id,
+                                'data': data},
+                     jwt, f'patch:{model.__tablename__}')
+
+
+def job_permission(job_id):
+    '''Permission needed to read a job, the one it was queued with'''
+
+    job = job_workers.queue.get(job_id)
+    if job is None:
+        abort(404)
+    return job['permission']
+
+
+def link_fields(model):
+    '''Linked model and the fields replacing, adding and removing links
+    in a PATCH request of model
+    '''
+
+    linked_model, name = (Actor, 'actors') if model is Movie \
+        else (Movie, 'movies')
+    return linked_model, (name, f'add_{name}', f'remove_{name}')
+
+
+def validate_update(model, data):
+    '''Checks a PATCH request before it is queued, whether linked ids
+    exist is checked by the job
+
+    Raises ValueError if invalid
+    '''
+
+    if not isinstance(data, dict):
+        raise ValueError('body must be an object')
+    model.clean(data, partial=True)
+    _, (replace, add, remove) = link_fields(model)
+    if data.get(replace) is not None:
+        clean_ids(data[replace], replace)
+    for field in (add, remove):
+        if field in data:
+            clean_ids(data[field], field)
+
+
+@job_workers.handler('update')
+def run_update(payload, progress):
+    '''Applies a queued PATCH of a movie or actor
+
+    Fields are committed with the first chunk of links, links are
+    written JOB_CHUNK_SIZE per transaction
+    '''
+
+    model = MODELS[payload['table']]
+    data = payload['data']
+    record = model.query.filter_by(id=payload['id']).one_or_none()
+    if record is None:
+        raise JobFailed('not found')
+    values = model.clean(data, partial=True)
+    for name, value in values.items():
+        setattr(record, name, value)
+    if values:
+        invalidate_on_commit(model.__tablename__,
+                             *detail_tags(model.link_key, [record.id]))
+    linked_model, (replace, add, remove) = link_fields(model)
+    if any(field in data for field in (replace, add, remove)):
+        try:
+            update_links_in_chunks(
+                model.link_key, record.id, linked_model, data.get(replace),
+                data.get(add, []), data.get(remove, []),
+                chunk_size=JOB_CHUNK_SIZE, progress=progress)
+        except ValueError as e:
+            db.session.rollback()
+            raise JobFailed(str(e))
+    record.update()
+    return {model.__tablename__[:-1]: record.format()}
+
+
+@job_workers.handler('bulk')
+def run_bulk(payload, progress):
+    '''Applies a queued bulk request, see write_bulk'''
+
+    try:
+        status, body = write_bulk(
+            MODELS[payload['table']], payload['items'], payload['mode'],
+            chunk_size=JOB_CHUNK_SIZE, progress=progress)
+    except SQLAlchemyError:
+        raise JobFailed('unprocessable')
+    if status != 200:
+        raise JobFailed('unprocessable', {'errors': body['errors']})
+    del body['success']
+    return body
+
+
+def list_tags(table):
+    '''Cache tags and versioned tables of a movies or actors listing
+
+    Listings with 'include' also show linked records, so they depend on
+    both tables and on movie_actor
+    '''
+
+    if request.args.get('include'):
+        return ['movies', 'actors', 'links']
+    return [table]
+
+
+def internal_only(f):
+    '''Answers 404 to clients outside INTERNAL_NETWORKS'''
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            address = ipaddress.ip_address(request.remote_addr)
+        except ValueError:
+            abort(404)
+        if not any(address in network for network in INTERNAL_NETWORKS):
+            abort(404)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def pool_statuses():
+    '''Returns pool.pool_status of the primary and replica pools by name'''
+
+    pools = {'primary': pool_status(db.engine.pool)}
+    for number, engine in enumerate(replica_set.engines):
+        pools[f'replica{number}'] = dict(
+            pool_status(engine.pool),
+            ejected=replica_set.is_ejected(engine))
+    return pools
+
+
+def collect_pool_metrics():
+    '''Sets the pool metrics of this worker, run before its metrics are
+    written or shown
+    '''
+
+    if has_app_context():
+        pools = pool_statuses()
+    else:
+        # written by the flush thread
+        with APP.app_context():
+            pools = pool_statuses()
+    for name, status in pools.items():
+        record_pool(name, status)
+
+
+def format_rows(model, rows, include=()):
+    '''Formats records or rows read as model.row_columns like
+    model.format
+
+    The linked records asked for by 'include' are read with one query
+    for all rows
+    '''
+
+    with timed('serialize'):
+        items = [model.format_row(row, include) for row in rows]
+    linked_model, name = (Actor, 'actors') if model is Movie \
+        else (Movie, 'movies')
+    if name in include:
+        links = linked_rows(model.link_key, [row.id for row in rows],
+                            linked_model)
+        with timed('serialize'):
+            for item in items:
+                item[name] = [linked_model.format_row(row)
+                              for row in links[item['id']]]
+    return items
+
 
-from auth0 import AuthError, requires_auth
-from models import setup_db, Movie, Actor
+def read_actors(ids):
+    '''Returns {id: record} of the actors with given ids'''
+
+    rows = ReadQuery(Actor).filter(Actor.id.in_(list(ids))).all()
+    return {row.id: row for row in rows}
+
+
+# Names accepted by the 'include' query parameter of listings
+MOVIE_INCLUDES = ('actors', 'actor_count')
+ACTOR_INCLUDES = ('movies', 'movie_count')
+
+
+def include_args(args, allowed):
+    '''Parses the comma separated 'include' query parameter
+
+    Raises ValueError if it names a relation not in allowed
+    '''
+
+    include = tuple(name for name in args.get('include', '').split(',')
+                    if name)
+    if any(name not in allowed for name in include):
+        raise ValueError('Invalid include')
+    return include
 
 
 def create_app():
@@ -20,6 +423,10 @@ def create_app():
     CORS(app, resources={r'/*': {'origins': '*'}})
     setup_db(app)
 
+    app.before_request(start_request)
+    registry.add_collector(collect_pool_metrics)
+    job_workers.app = app
+
     @app.after_request
     def after_request(response):
         """Intercept response to add 'Access-Control-Allow' headers"""
@@ -28,7 +435,8 @@ def create_app():
                              'Content-Type, Authorization, True')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET, POST, PATCH, DELETE, OPTIONS')
-        return response
+        # Server-Timing header and request log line
+        return finish_request(response)
 
     @app.route('/')
     def index():
@@ -36,27 +444,184 @@ def create_app():
 
         return redirect(os.getenv('REDIRECT_URI'))
 
+    @app.route('/search')
+    @requires_auth('get:movies')
+    @conditional(lambda: ['movies', 'actors'])
+    def search_catalogue(jwt):
+        '''Full-text search over movie titles and actor names
+
+        Query parameters
+        ----------------
+        q: words to look for, each has to match the beginning of a word
+           in the title or name
+        type: 'movies' or 'actors' to search only one of them, optional,
+              searching actors needs 'get:actors'
+        limit: number of results of each type in the page, optional
+        after: cursor returned as 'next_cursor' by the previous page,
+               optional
+
+        Returns in json format
+        ----------------------
+        movies: list of matching movies, best matches first
+        actors: list of matching actors, best matches first
+        next_cursor: cursor of the next page, null on the last page
+        '''
+
+        kind = request.args.get('type')
+        if kind not in (None, 'movies', 'actors'):
+            abort(400)
+        models = {'movies': Movie, 'actors': Actor}
+        if kind is not None:
+            models = {kind: models[kind]}
+        if 'actors' in models:
+            check_permissions('get:actors', jwt)
+        try:
+            terms = search_terms(request.args.get('q'))
+            limit, after = page_args(request.args)
+            # ranked results are paged by offset, one per result type
+            offsets = after or [0 if name in models else None
+                                for name in ('movies', 'actors')]
+            if len(offsets) != 2 or not all(
+                    offset is None or is_offset(offset)
+                    for offset in offsets):
+                raise ValueError('Invalid cursor')
+        except ValueError:
+            abort(400)
+
+        result = {'success': True}
+        next_offsets = []
+        for name, offset in zip(('movies', 'actors'), offsets):
+            if name not in models:
+                next_offsets.append(None)
+                continue
+            model = models[name]
+            rows = []
+            if offset is not None:
+                rows = full_text_search(model, terms) \
+                    .with_entities(*model.row_columns) \
+                    .offset(offset).limit(limit + 1).all()
+            more = len(rows) > limit
+            result[name] = format_rows(model, rows[:limit])
+            next_offsets.append(offset + limit if more else None)
+        result['next_cursor'] = None
+        if any(offset is not None for offset in next_offsets):
+            result['next_cursor'] = encode_cursor(next_offsets)
+        return json_response(result)
+
     # Movies
     # ---------------------------------------------------------
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @read_replica
+    @conditional(lambda: list_tags('movies'))
+    @response_cache.cached(lambda: list_tags('movies'))
     def get_movies(jwt):
-        '''Get all movies from database
+        '''Get a page of movies from database ordered by id
+
+        Query parameters
+        ----------------
+        limit: number of movies in the page, optional
+        after: cursor returned as 'next_cursor' by the previous page,
+               optional
+        include: comma separated, 'actors' to add the actors of every
+                 movie and 'actor_count' their number, optional
 
         Returns in json format
         ----------------------
-        movies: list of movies (id, title and release date)
+        movies: list of movies (id, title, release date and actors)
+        next_cursor: cursor of the next page, null on the last page
         '''
 
-        movies = Movie.query.all()
-        return jsonify({
+        try:
+            limit, after = page_args(request.args)
+            include = include_args(request.args, MOVIE_INCLUDES)
+            query = ReadQuery(Movie)
+            movies, next_cursor = paginate(query, Movie.id, limit, after)
+        except ValueError:
+            abort(400)
+        return json_response({
+            'success': True,
+            # one extra query for the actors of the whole page
+            'movies': format_rows(Movie, movies, include),
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/movies/search')
+    @requires_auth('get:movies')
+    @conditional(lambda: VERSIONED_TABLES)
+    def search_movies(jwt):
+        '''Search movies with filters, answered by a single query
+
+        Query parameters
+        ----------------
+        released_from: earliest release date, optional
+        released_to: latest release date, optional
+        title_prefix: beginning of the title, case-insensitive, optional
+        title_contains: part of the title, case-insensitive, needs
+                        another filter, optional
+        actor_ids: comma separated ids, movies featuring any of these
+                   actors, optional
+        actor_count_min, actor_count_max: bounds of the number of actors,
+                                          optional
+        sort: id, release_date, title or actor_count, '-' prefix for
+              descending order, sorting by title needs a filter, optional
+        limit, after, include: same as for listing movies
+
+        Returns in json format
+        ----------------------
+        movies: list of matching movies (id, title and release date)
+        next_cursor: cursor of the next page, null on the last page
+        '''
+
+        try:
+            limit, after = page_args(request.args)
+            include = include_args(request.args, MOVIE_INCLUDES)
+            conditions, sort, descending = search_args(
+                request.args, MOVIE_FILTERS, MOVIE_SORTS)
+            query = ReadQuery(Movie).filter(*conditions)
+            movies, next_cursor = paginate(query, Movie.id, limit, after,
+                                           sort, descending)
+        except ValueError:
+            abort(400)
+        return json_response({
             'success': True,
-            'movies': [movie.format() for movie in movies]
+            'movies': format_rows(Movie, movies, include),
+            'next_cursor': next_cursor
         })
 
+    @app.route('/movies/export')
+    @requires_auth('get:movies')
+    @conditional(lambda: list_tags('movies'))
+    def export_movies(jwt):
+        '''Stream all movies as newline-delimited json
+
+        Query parameters
+        ----------------
+        include: 'actor_ids' to add the list of actor ids to every movie,
+                 optional
+
+        Returns a stream of movies (id, title, release date and actor ids),
+        one json object per line
+        '''
+
+        include = request.args.get('include')
+        if include not in (None, 'actor_ids'):
+            abort(400)
+        link_key = 'movie_id' if include else None
+        query = Movie.query.with_entities(*Movie.row_columns) \
+            .order_by(Movie.id)
+        return Response(
+            stream_with_context(
+                export_ndjson(query, Movie, link_key, 'actors')),
+            mimetype='application/x-ndjson'
+        )
+
     @app.route('/movies/<int:movie_id>')
     @requires_auth('get:movies')
+    @read_replica
+    @conditional(lambda movie_id: VERSIONED_TABLES)
+    @response_cache.cached(lambda movie_id: [f'movie:{movie_id}'])
     def get_actors_in_movie(jwt, movie_id):
         '''Get list of assigned actors for the movie with given id
 
@@ -70,14 +635,14 @@ def create_app():
         actors: list of actors in selected movie
         '''
 
-        movie = Movie.query.filter_by(id=movie_id).one_or_none()
+        movie, actors = read_detail(Movie, movie_id)
         if movie is None:
             abort(404)
         try:
-            return jsonify({
+            return json_response({
                 'success': True,
                 'title': movie.title,
-                'actors': [actor.format() for actor in movie.actors]
+                'actors': [Actor.format_row(actor) for actor in actors]
             })
         except Exception:
             abort(400)
@@ -99,8 +664,9 @@ def create_app():
 
         data = request.get_json()
         try:
-            movie = Movie(title=data.get('title'),
-                          release_date=data.get('release_date'))
+            values = Movie.clean(data)
+            movie = Movie(title=values['title'],
+                          release_date=values['release_date'])
             movie.insert()
 
             return jsonify({
@@ -110,6 +676,28 @@ def create_app():
         except Exception:
             abort(422)
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def bulk_movies(jwt):
+        '''Add or modify many movies at once
+
+        Arguments in json format
+        ------------------------
+        movies: list of movies (title and release date), movies with
+                an id update the existing movie and need 'patch:movies'
+        mode: 'all_or_nothing' (default) or 'best_effort', optional
+
+        Returns json object
+        -------------------
+        created: number of added movies
+        updated: number of modified movies
+        errors: list of invalid rows (index and message)
+        '''
+
+        data = request.get_json() or {}
+        return bulk_save(Movie, jwt, data.get('movies'),
+                         data.get('mode', 'all_or_nothing'))
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(jwt, movie_id):
@@ -121,6 +709,11 @@ def create_app():
         release_date: release date of movie, optional
         actors: list of actors ids assigned to the movie,
                 list of integers, optional
+        add_actors: list of actors ids to assign, optional
+        remove_actors: list of actors ids to unassign, optional
+
+        With the header 'Prefer: respond-async' the change is validated,
+        queued and answered with 202 and the job id, see GET /jobs/<id>
 
         Parameters
         ----------
@@ -134,20 +727,20 @@ def create_app():
         movie = Movie.query.filter_by(id=movie_id).one_or_none()
         if movie is None:
             abort(404)
+        if prefers_async():
+            return queue_update(Movie, movie_id, jwt)
         try:
             data = request.get_json()
-            if 'title' in data:
-                movie.title = data.get('title')
-            if 'release_date' in data:
-                movie.release_date = data.get('release_date')
-            if 'actors' in data:
-                actors = data.get('actors')
-                movie.actors = []
-                for actor_id in actors:
-                    actor = Actor.query.filter_by(id=actor_id).one_or_none()
-                    if actor is None:
-                        raise Exception
-                    movie.actors.append(actor)
+            values = Movie.clean(data, partial=True)
+            if 'title' in values:
+                movie.title = values['title']
+            if 'release_date' in values:
+                movie.release_date = values['release_date']
+            if any(field in data for field in
+                   ('actors', 'add_actors', 'remove_actors')):
+                movie.set_actors(data.get('actors'),
+                                 data.get('add_actors', []),
+                                 data.get('remove_actors', []))
             movie.update()
 
             return jsonify({
@@ -189,22 +782,116 @@ def create_app():
 
     @app.route('/actors')
     @requires_auth('get:actors')
+    @read_replica
+    @conditional(lambda: list_tags('actors'))
+    @response_cache.cached(lambda: list_tags('actors'))
     def get_actors(jwt):
-        '''Get all actors from database
+        '''Get a page of actors from database ordered by id
+
+        Query parameters
+        ----------------
+        limit: number of actors in the page, optional
+        after: cursor returned as 'next_cursor' by the previous page,
+               optional
+        include: comma separated, 'movies' to add the movies of every
+                 actor and 'movie_count' their number, optional
 
         Returns in json format
         ----------------------
-        actors: list of actors (id, name, age and gender)
+        actors: list of actors (id, name, age, gender and movies)
+        next_cursor: cursor of the next page, null on the last page
         '''
 
-        actors = Actor.query.all()
-        return jsonify({
+        try:
+            limit, after = page_args(request.args)
+            include = include_args(request.args, ACTOR_INCLUDES)
+            query = ReadQuery(Actor)
+            actors, next_cursor = paginate(query, Actor.id, limit, after)
+        except ValueError:
+            abort(400)
+        return json_response({
+            'success': True,
+            # one extra query for the movies of the whole page
+            'actors': format_rows(Actor, actors, include),
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/actors/search')
+    @requires_auth('get:actors')
+    @conditional(lambda: VERSIONED_TABLES)
+    def search_actors(jwt):
+        '''Search actors with filters, answered by a single query
+
+        Query parameters
+        ----------------
+        name_prefix: beginning of the name, case-insensitive, optional
+        name_contains: part of the name, case-insensitive, needs another
+                       filter, optional
+        age_min: minimal age, optional
+        age_max: maximal age, optional
+        gender: male, female or other, optional
+        movie_ids: comma separated ids, actors in any of these movies,
+                   optional
+        movie_count_min, movie_count_max: bounds of the number of movies,
+                                          optional
+        sort: id, age, name or movie_count, '-' prefix for descending
+              order, sorting by name needs a filter, optional
+        limit, after, include: same as for listing actors
+
+        Returns in json format
+        ----------------------
+        actors: list of matching actors (id, name, age and gender)
+        next_cursor: cursor of the next page, null on the last page
+        '''
+
+        try:
+            limit, after = page_args(request.args)
+            include = include_args(request.args, ACTOR_INCLUDES)
+            conditions, sort, descending = search_args(
+                request.args, ACTOR_FILTERS, ACTOR_SORTS)
+            query = ReadQuery(Actor).filter(*conditions)
+            actors, next_cursor = paginate(query, Actor.id, limit, after,
+                                           sort, descending)
+        except ValueError:
+            abort(400)
+        return json_response({
             'success': True,
-            'actors': [actor.format() for actor in actors]
+            'actors': format_rows(Actor, actors, include),
+            'next_cursor': next_cursor
         })
 
+    @app.route('/actors/export')
+    @requires_auth('get:actors')
+    @conditional(lambda: list_tags('actors'))
+    def export_actors(jwt):
+        '''Stream all actors as newline-delimited json
+
+        Query parameters
+        ----------------
+        include: 'movie_ids' to add the list of movie ids to every actor,
+                 optional
+
+        Returns a stream of actors (id, name, age, gender and movie ids),
+        one json object per line
+        '''
+
+        include = request.args.get('include')
+        if include not in (None, 'movie_ids'):
+            abort(400)
+        link_key = 'actor_id' if include else None
+        query = Actor.query.with_entities(*Actor.row_columns) \
+            .order_by(Actor.id)
+        return Response(
+            stream_with_context(
+                export_ndjson(query, Actor, link_key, 'movies')),
+            mimetype='application/x-ndjson'
+        )
+
     @app.route('/actors/<int:actor_id>')
     @requires_auth('get:actors')
+    @read_replica
+    @conditional(lambda actor_id: VERSIONED_TABLES)
+    @response_cache.cached(lambda actor_id: [f'actor:{actor_id}'])
     def get_movies_from_actor(jwt, actor_id):
         '''Get a list of movies where the actor is assigned
 
@@ -218,18 +905,125 @@ def create_app():
         movies: list of movies
         '''
 
-        actor = Actor.query.filter_by(id=actor_id).one_or_none()
+        actor, movies = read_detail(Actor, actor_id)
         if actor is None:
             abort(404)
         try:
-            return jsonify({
+            return json_response({
                 'success': True,
-                'actor': actor.format(),
-                'movies': [movie.format() for movie in actor.movies]
+                'actor': Actor.format_row(actor),
+                'movies': [Movie.format_row(movie) for movie in movies]
             })
         except Exception:
             abort(400)
 
+    @app.route('/actors/<int:actor_id>/costars')
+    @requires_auth('get:actors')
+    @conditional(lambda actor_id: ['actors', 'links'])
+    @response_cache.cached(lambda actor_id: ['actors', 'links'])
+    def get_costars(jwt, actor_id):
+        '''Get a page of the actors sharing a movie with the actor
+
+        Parameters
+        ----------
+        actor_id: integer representing the actor
+
+        Query parameters
+        ----------------
+        limit: number of actors in the page, optional
+        after: cursor returned as 'next_cursor' by the previous page,
+               optional
+
+        Returns in json format
+        ----------------------
+        costars: list of actors with the number of 'shared_movies', most
+                 shared movies first
+        next_cursor: cursor of the next page, null on the last page
+        '''
+
+        try:
+            limit, after = page_args(request.args)
+            # ranked results are paged by offset
+            offset, = after or [0]
+            if not is_offset(offset):
+                raise ValueError('Invalid cursor')
+        except ValueError:
+            abort(400)
+        actors = read_actors([actor_id])
+        if actor_id not in actors:
+            abort(404)
+        costars = cast_graph.costars(actor_id)
+        page = costars[offset:offset + limit]
+        actors = read_actors(id for id, _ in page)
+        items = []
+        for id, shared in page:
+            item = Actor.format_row(actors[id])
+            item['shared_movies'] = shared
+            items.append(item)
+        next_cursor = None
+        if offset + limit < len(costars):
+            next_cursor = encode_cursor([offset + limit])
+        return json_response({
+            'success': True,
+            'costars': items,
+            'next_cursor': next_cursor
+        })
+
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>')
+    @requires_auth('get:actors')
+    @conditional(lambda actor_id, other_id: VERSIONED_TABLES)
+    @response_cache.cached(lambda actor_id, other_id: VERSIONED_TABLES)
+    def get_costar_path(jwt, actor_id, other_id):
+        '''Get the shortest chain of co-stars from one actor to another
+
+        Parameters
+        ----------
+        actor_id: integer representing the first actor
+        other_id: integer representing the last actor
+
+        Query parameters
+        ----------------
+        max_degrees: most movies in the chain, optional, clamped to
+                     GRAPH_MAX_DEGREES
+
+        Returns in json format
+        ----------------------
+        degrees: number of movies in the chain, null if there is none
+        actors: list of actors of the chain, from the first to the last
+        movies: list of movies of the chain, movies[i] has actors[i] and
+                actors[i + 1]
+        '''
+
+        try:
+            max_degrees = int(request.args.get('max_degrees',
+                                               GRAPH_MAX_DEGREES))
+        except ValueError:
+            abort(400)
+        if max_degrees < 1:
+            abort(400)
+        actors = read_actors([actor_id, other_id])
+        if actor_id not in actors or other_id not in actors:
+            abort(404)
+        path = cast_graph.shortest_path(
+            actor_id, other_id, min(max_degrees, GRAPH_MAX_DEGREES))
+        if path is None:
+            return json_response({
+                'success': True,
+                'degrees': None,
+                'actors': [],
+                'movies': []
+            })
+        actor_ids, movie_ids = path
+        actors = read_actors(actor_ids)
+        movies = {row.id: row for row in ReadQuery(Movie).filter(
+            Movie.id.in_(movie_ids)).all()}
+        return json_response({
+            'success': True,
+            'degrees': len(movie_ids),
+            'actors': [Actor.format_row(actors[id]) for id in actor_ids],
+            'movies': [Movie.format_row(movies[id]) for id in movie_ids]
+        })
+
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
     def create_actor(jwt):
@@ -249,7 +1043,7 @@ def create_app():
         data = request.get_json()
         try:
             gender = data.get('gender').lower()
-            if gender not in ['male', 'female', 'other']:
+            if gender not in GENDERS:
                 raise Exception
             actor = Actor(
                 name=data.get('name'),
@@ -265,6 +1059,28 @@ def create_app():
         except Exception:
             abort(422)
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def bulk_actors(jwt):
+        '''Add or modify many actors at once
+
+        Arguments in json format
+        ------------------------
+        actors: list of actors (name, age and gender), actors with
+                an id update the existing actor and need 'patch:actors'
+        mode: 'all_or_nothing' (default) or 'best_effort', optional
+
+        Returns json object
+        -------------------
+        created: number of added actors
+        updated: number of modified actors
+        errors: list of invalid rows (index and message)
+        '''
+
+        data = request.get_json() or {}
+        return bulk_save(Actor, jwt, data.get('actors'),
+                         data.get('mode', 'all_or_nothing'))
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(jwt, actor_id):
@@ -277,6 +1093,11 @@ def create_app():
         gender: actor's gender, string (male, female or other), optional
         movies: list of movies ids to which actor is assigned,
                 list of integers, optional
+        add_movies: list of movies ids to assign, optional
+        remove_movies: list of movies ids to unassign, optional
+
+        With the header 'Prefer: respond-async' the change is validated,
+        queued and answered with 202 and the job id, see GET /jobs/<id>
 
         Parameters
         ----------
@@ -290,6 +1111,8 @@ def create_app():
         actor = Actor.query.filter_by(id=actor_id).one_or_none()
         if actor is None:
             abort(404)
+        if prefers_async():
+            return queue_update(Actor, actor_id, jwt)
         try:
             data = request.get_json()
             if 'name' in data:
@@ -298,17 +1121,14 @@ def create_app():
                 actor.age = data.get('age')
             if 'gender' in data:
                 gender = data.get('gender').lower()
-                if gender not in ['male', 'female', 'other']:
+                if gender not in GENDERS:
                     raise Exception
                 actor.gender = gender
-            if 'movies' in data:
-                movies = data.get('movies')
-                actor.movies = []
-                for movie_id in movies:
-                    movie = Movie.query.filter_by(id=movie_id).one_or_none()
-                    if movie is None:
-                        raise Exception
-                    actor.movies.append(movie)
+            if any(field in data for field in
+                   ('movies', 'add_movies', 'remove_movies')):
+                actor.set_movies(data.get('movies'),
+                                 data.get('add_movies', []),
+                                 data.get('remove_movies', []))
             actor.update()
 
             return jsonify({
@@ -345,6 +1165,59 @@ def create_app():
         except Exception:
             abort(422)
 
+    # Jobs
+    # ------------------------------------------------
+
+    @app.route('/jobs/<job_id>')
+    @requires_auth(job_permission)
+    def get_job(jwt, job_id):
+        '''Status of an asynchronous write, readable by the client that
+        queued it
+
+        Parameters
+        ----------
+        job_id: id returned with 202 by the write
+
+        Returns json object
+        -------------------
+        job: status (queued, running, succeeded or failed), links or
+             rows written so far out of total, result and error
+        '''
+
+        job = job_workers.queue.get(job_id)
+        if job is None or job['owner'] != jwt.get('sub'):
+            abort(404)
+        return jsonify({
+            'success': True,
+            'job': format_job(job)
+        })
+
+    # Internal
+    # ------------------------------------------------
+
+    @app.route('/internal/pool')
+    @internal_only
+    def get_pool_status():
+        '''Live state of the database connection pool of this worker
+
+        Returns in json format
+        ----------------------
+        pools: connections checked in and out, overflow, timeouts and a
+               histogram of the time spent waiting for a connection
+        '''
+
+        return json_response({'success': True, 'pools': pool_statuses()})
+
+    @app.route('/metrics')
+    @internal_only
+    def get_metrics():
+        '''Request counts and latencies, auth errors, error handler hits,
+        JWKS fetches, jobs and pool state added up over all workers, in
+        the Prometheus text format
+        '''
+
+        return Response(registry.render(), content_type=CONTENT_TYPE)
+
     # Error handling
     # ------------------------------------------------
 
@@ -352,6 +1225,7 @@ def create_app():
     def bad_request(error):
         '''Error handler for 400'''
 
+        error_handler_hits.inc('400')
         return jsonify({
             'success': False,
             'error': 400,
@@ -362,6 +1236,7 @@ def create_app():
     def not_found(error):
         '''Error handler for 404'''
 
+        error_handler_hits.inc('404')
         return jsonify({
             'success': False,
             'error': 404,
@@ -372,6 +1247,7 @@ def create_app():
     def unprocessable(error):
         '''Error handler for 422'''
 
+        error_handler_hits.inc('422')
         return jsonify({
             'success': False,
             'error': 422,
@@ -382,6 +1258,7 @@ def create_app():
     def internal_error(error):
         '''Generic error handler for all exceptions'''
 
+        error_handler_hits.inc('500')
         return jsonify({
             'success': False,
             'error': 500,
@@ -392,12 +1269,26 @@ def create_app():
     def authorization_error(error):
         '''Generic error handler for all exceptions'''
 
+        auth_errors.inc(error.error['code'])
         return jsonify({
             'success': False,
             'error': error.status_code,
             'message': error.error
         }), error.status_code
 
+    @app.errorhandler(RateLimited)
+    def too_many_requests(error):
+        '''Error handler for 429, the client may retry after Retry-After
+        seconds
+        '''
+
+        error_handler_hits.inc('429')
+        return jsonify({
+            'success': False,
+            'error': 429,
+            'message': 'too many requests'
+        }), 429, {'Retry-After': str(math.ceil(error.retry_after))}
+
     return app
 
 
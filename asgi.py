@@ -0,0 +1,418 @@
+import asyncio
+import logging
+import math
+import os
+import time
+
+from functools import wraps
+
+import httpx
+from databases import Database
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+
+from app import APP, include_args, ACTOR_INCLUDES, MOVIE_INCLUDES
+from auth0 import (
+    AuthError,
+    check_permissions,
+    decode_with_key,
+    jwks_cache,
+    parse_auth_header,
+    token_cache,
+    unverified_kid
+)
+from conditional import is_fresh, make_validators
+from metrics import (
+    auth_errors,
+    error_handler_hits,
+    jwks_fetch_seconds,
+    measure,
+    record_request
+)
+from models import (
+    database_path,
+    detail_records,
+    detail_select,
+    group_linked,
+    linked_select,
+    versions_from_rows,
+    versions_select,
+    Actor,
+    Movie,
+    ReadQuery,
+    VERSIONED_TABLES
+)
+from pagination import page_args, page_items, page_query
+from pool import async_database_options
+from ratelimit import RateLimited, rate_limiter
+from serializer import dumps
+
+# Seconds to wait for the JWKS endpoint
+JWKS_TIMEOUT = float(os.getenv('JWKS_TIMEOUT', 5))
+
+logger = logging.getLogger(__name__)
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'not found',
+    422: 'unprocessable',
+    429: 'too many requests',
+}
+
+
+class AsyncJWKSClient:
+    '''AsyncJWKSClient
+    Fetches the keys of an auth0.JWKSCache without blocking the event loop
+
+    The cache decides when to fetch, exactly as for the WSGI routes, and
+    its keys are shared with them. Concurrent requests needing a fetch
+    wait for the same one.
+
+    Parameters
+    ----------
+    cache: JWKSCache holding the keys, http(s) urls of its source are
+           fetched with httpx, other sources are called in a thread
+    '''
+
+    def __init__(self, cache=jwks_cache):
+        self.cache = cache
+        self.client = None
+        self._fetching = None
+
+    async def fetch(self):
+        source = self.cache.source
+        url = getattr(source, 'url', '')
+        if not url.startswith(('http://', 'https://')):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, source)
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=JWKS_TIMEOUT)
+        response = await self.client.get(url)
+        response.raise_for_status()
+        return response.json()
+
+    async def refresh(self):
+        with measure(jwks_fetch_seconds):
+            jwks = await self.fetch()
+        return self.cache.load(jwks)
+
+    async def _refresh_in_background(self):
+        try:
+            await self.refresh()
+        except Exception:
+            logger.warning('Background JWKS refresh failed', exc_info=True)
+            self.cache.back_off()
+        finally:
+            self.cache.finish_refresh()
+
+    async def _fetch(self):
+        try:
+            return await self.refresh()
+        except Exception:
+            return self.cache.fetch_failed()
+        finally:
+            self._fetching = None
+
+    async def _fetch_or_fail(self):
+        if self._fetching is None:
+            self._fetching = asyncio.ensure_future(self._fetch())
+        return await asyncio.shield(self._fetching)
+
+    async def get_key(self, kid):
+        '''Returns the RSA key with given 'kid' or None if it is unknown,
+        see JWKSCache.get_key
+        '''
+
+        keys = self.cache.keys
+        if self.cache.expired():
+            keys = await self._fetch_or_fail()
+        elif not keys:
+            # the last fetch failed moments ago
+            keys = self.cache.previous_keys()
+        elif self.cache.start_refresh():
+            asyncio.ensure_future(self._refresh_in_background())
+
+        if kid in keys:
+            return keys[kid]
+        if not self.cache.allow_forced_fetch():
+            return None
+        return (await self._fetch_or_fail()).get(kid)
+
+    async def get_verified_payload(self, token):
+        '''Returns the token payload, verifying the signature on cache miss
+        '''
+
+        payload = token_cache.get(token)
+        if payload is None:
+            rsa_key = await self.get_key(unverified_kid(token))
+            payload = decode_with_key(token, rsa_key)
+            token_cache.put(token, payload)
+        return payload
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+jwks_client = AsyncJWKSClient()
+
+
+def row_values(rows):
+    '''Rows fetched by databases as tuples, asyncpg records iterate over
+    their keys
+    '''
+
+    return [tuple(row[i] for i in range(len(row))) for row in rows]
+
+
+def json_response(obj, status=200):
+    '''Same as serializer.json_response for the async routes'''
+
+    return Response(dumps(obj), status_code=status,
+                    media_type='application/json')
+
+
+def error_response(status, message):
+    return json_response({
+        'success': False,
+        'error': status,
+        'message': message
+    }, status)
+
+
+def list_tables(table, request):
+    '''Versioned tables of a movies or actors listing, see app.list_tags'''
+
+    if request.query_params.get('include'):
+        return list(VERSIONED_TABLES)
+    return [table]
+
+
+def conditional(tables):
+    '''Decorator answering conditional GET requests of async views, see
+    conditional.conditional
+
+    Parameters
+    ----------
+    tables: callable receiving the request and the url arguments of the
+            view and returning the names of the tables the response
+            depends on
+    '''
+
+    def conditional_decorator(f):
+        @wraps(f)
+        async def wrapper(request, connection, **kwargs):
+            names = list(tables(request, **kwargs))
+            rows = await connection.fetch_all(versions_select(names))
+            etag, last_modified = make_validators(
+                request.url.path, request.query_params.multi_items(),
+                names, versions_from_rows(names, row_values(rows)))
+            if etag is None:
+                return await f(request, connection, **kwargs)
+            headers = request.headers
+            if is_fresh(etag, last_modified,
+                        parse_etags(headers.get('if-none-match')),
+                        parse_date(headers.get('if-modified-since'))):
+                response = Response(status_code=304)
+            else:
+                response = await f(request, connection, **kwargs)
+                if response.status_code != 200:
+                    return response
+            response.headers['ETag'] = quote_etag(etag)
+            response.headers['Last-Modified'] = http_date(last_modified)
+            return response
+        return wrapper
+    return conditional_decorator
+
+
+async def fetch_records(connection, select, model):
+    rows = await connection.fetch_all(select)
+    return [model.record(*values) for values in row_values(rows)]
+
+
+async def format_rows(connection, model, rows, include=()):
+    '''Same as app.format_rows, reading linked records on connection'''
+
+    items = [model.format_row(row, include) for row in rows]
+    linked_model, name = (Actor, 'actors') if model is Movie \
+        else (Movie, 'movies')
+    if name in include and rows:
+        ids = [row.id for row in rows]
+        linked = await connection.fetch_all(
+            linked_select(model.link_key, ids, linked_model))
+        links = group_linked(ids, row_values(linked), linked_model)
+        for item in items:
+            item[name] = [linked_model.format_row(row)
+                          for row in links[item['id']]]
+    return items
+
+
+def create_app(database_url=database_path, flask_app=APP):
+    '''ASGI application serving the read endpoints with async views
+
+    GET /movies, /actors, /movies/<id> and /actors/<id> answer the same
+    json as the Flask views, reading through an asyncpg or aiosqlite
+    pool. Every other route is served by flask_app in a thread.
+    Responses of the async views are neither cached nor read from
+    replicas.
+    '''
+
+    # Flask-SQLAlchemy falls back to an in-memory database as well
+    url, options = async_database_options(database_url or 'sqlite://')
+    database = Database(url, **options)
+    # Flask url rules by view name, requests are counted in /metrics
+    # under the same route as on the Flask app
+    rules = {rule.endpoint: rule.rule
+             for rule in flask_app.url_map.iter_rules()}
+
+    def endpoint(permission):
+        '''Decorator of async views checking the token's permission and
+        passing them a database connection, errors are answered like the
+        Flask error handlers
+        '''
+
+        def endpoint_decorator(f):
+            @wraps(f)
+            async def wrapper(request):
+                start = time.perf_counter()
+                try:
+                    token = parse_auth_header(
+                        request.headers.get('Authorization', None))
+                    payload = await jwks_client.get_verified_payload(token)
+                    check_permissions(permission, payload)
+                    rate_limiter.check(permission, payload)
+                    async with database.connection() as connection:
+                        response = await f(request, connection,
+                                           **request.path_params)
+                except AuthError as error:
+                    auth_errors.inc(error.error['code'])
+                    response = json_response({
+                        'success': False,
+                        'error': error.status_code,
+                        'message': error.error
+                    }, error.status_code)
+                except RateLimited as error:
+                    error_handler_hits.inc('429')
+                    response = error_response(429, ERROR_MESSAGES[429])
+                    response.headers['Retry-After'] = \
+                        str(math.ceil(error.retry_after))
+                except HTTPException as error:
+                    error_handler_hits.inc(str(error.status_code))
+                    response = error_response(
+                        error.status_code,
+                        ERROR_MESSAGES.get(error.status_code, error.detail))
+                except Exception:
+                    logger.exception('Error in %s', request.url.path)
+                    error_handler_hits.inc('500')
+                    response = error_response(500, 'Something went wrong!')
+                response.headers['Access-Control-Allow-Headers'] = \
+                    'Content-Type, Authorization, True'
+                response.headers['Access-Control-Allow-Methods'] = \
+                    'GET, POST, PATCH, DELETE, OPTIONS'
+                if 'origin' in request.headers:
+                    response.headers['Access-Control-Allow-Origin'] = '*'
+                record_request(rules.get(f.__name__, request.url.path),
+                               request.method, response.status_code,
+                               time.perf_counter() - start)
+                return response
+            return wrapper
+        return endpoint_decorator
+
+    @endpoint('get:movies')
+    @conditional(lambda request: list_tables('movies', request))
+    async def get_movies(request, connection):
+        '''Get a page of movies from database ordered by id, see
+        app.create_app
+        '''
+
+        try:
+            limit, after = page_args(request.query_params)
+            include = include_args(request.query_params,
+                                   MOVIE_INCLUDES)
+            query, columns = page_query(ReadQuery(Movie), Movie.id, limit,
+                                        after)
+        except ValueError:
+            raise HTTPException(400)
+        rows = await fetch_records(connection, query.select, Movie)
+        movies, next_cursor = page_items(rows, columns, limit)
+        return json_response({
+            'success': True,
+            'movies': await format_rows(connection, Movie, movies, include),
+            'next_cursor': next_cursor
+        })
+
+    @endpoint('get:movies')
+    @conditional(lambda request, movie_id: VERSIONED_TABLES)
+    async def get_actors_in_movie(request, connection, movie_id):
+        '''Get list of assigned actors for the movie with given id'''
+
+        rows = await connection.fetch_all(detail_select(Movie, movie_id))
+        movie, actors = detail_records(Movie, row_values(rows))
+        if movie is None:
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'title': movie.title,
+            'actors': [Actor.format_row(actor) for actor in actors]
+        })
+
+    @endpoint('get:actors')
+    @conditional(lambda request: list_tables('actors', request))
+    async def get_actors(request, connection):
+        '''Get a page of actors from database ordered by id, see
+        app.create_app
+        '''
+
+        try:
+            limit, after = page_args(request.query_params)
+            include = include_args(request.query_params,
+                                   ACTOR_INCLUDES)
+            query, columns = page_query(ReadQuery(Actor), Actor.id, limit,
+                                        after)
+        except ValueError:
+            raise HTTPException(400)
+        rows = await fetch_records(connection, query.select, Actor)
+        actors, next_cursor = page_items(rows, columns, limit)
+        return json_response({
+            'success': True,
+            'actors': await format_rows(connection, Actor, actors, include),
+            'next_cursor': next_cursor
+        })
+
+    @endpoint('get:actors')
+    @conditional(lambda request, actor_id: VERSIONED_TABLES)
+    async def get_movies_from_actor(request, connection, actor_id):
+        '''Get a list of movies where the actor is assigned'''
+
+        rows = await connection.fetch_all(detail_select(Actor, actor_id))
+        actor, movies = detail_records(Actor, row_values(rows))
+        if actor is None:
+            raise HTTPException(404)
+        return json_response({
+            'success': True,
+            'actor': Actor.format_row(actor),
+            'movies': [Movie.format_row(movie) for movie in movies]
+        })
+
+    routes = [
+        Route('/movies', get_movies, methods=['GET']),
+        Route('/movies/{movie_id:int}', get_actors_in_movie,
+              methods=['GET']),
+        Route('/actors', get_actors, methods=['GET']),
+        Route('/actors/{actor_id:int}', get_movies_from_actor,
+              methods=['GET']),
+        # other methods of the paths above match here as well
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ]
+    app = Starlette(routes=routes, on_startup=[database.connect],
+                    on_shutdown=[database.disconnect, jwks_client.aclose])
+    app.state.database = database
+    return app
+
+
+app = create_app()
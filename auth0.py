@@ -1,15 +1,42 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 
-from flask import request, abort
+from collections import OrderedDict
+from flask import request, abort, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
+from instrumentation import timed
+from metrics import jwks_fetch_seconds, measure
+from ratelimit import rate_limiter
+
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = os.getenv('ALGORITHMS')
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+# JWKS location, defaults to the Auth0 tenant. Any url understood by
+# urlopen works, so 'file:///path/to/jwks.json' can be used locally.
+JWKS_URL = os.getenv('JWKS_URL',
+                     f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+# Seconds the fetched key set is considered fresh
+JWKS_CACHE_TTL = float(os.getenv('JWKS_CACHE_TTL', 600))
+# Seconds before expiry when a background refresh is started
+JWKS_REFRESH_AHEAD = float(os.getenv('JWKS_REFRESH_AHEAD', 60))
+# Minimum seconds between refetches triggered by an unknown 'kid'
+JWKS_MIN_REFETCH_INTERVAL = float(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 30))
+# Seconds after a failed fetch during which the previous keys are used,
+# or requests fail with 503 if there are none, without fetching again
+JWKS_RETRY_INTERVAL = float(os.getenv('JWKS_RETRY_INTERVAL', 10))
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 
 class AuthError(Exception):
     '''AuthError Exception
@@ -21,10 +48,9 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
-def get_token_auth_header():
-    """Obtains the Access Token from the Authorization Header"""
+def parse_auth_header(auth_header):
+    '''Returns the token of a 'Bearer <token>' Authorization header'''
 
-    auth_header = request.headers.get('Authorization', None)
     if auth_header is None:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -46,6 +72,12 @@ def get_token_auth_header():
     return header_parts[1]
 
 
+def get_token_auth_header():
+    """Obtains the Access Token from the Authorization Header"""
+
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
 def check_permissions(permission, payload):
     if 'permissions' not in payload:
         raise AuthError({
@@ -60,28 +92,229 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    '''Verify token'''
+def url_jwks_source(url):
+    '''Returns a JWKS source reading the key set from the given url'''
+
+    def fetch():
+        with urlopen(url) as response:
+            return json.loads(response.read())
+    # lets asgi.AsyncJWKSClient fetch it without blocking
+    fetch.url = url
+    return fetch
+
+
+class JWKSCache:
+    '''JWKSCache
+    Process-wide cache of the JSON Web Key Set indexed by 'kid'
+
+    Parameters
+    ----------
+    source: callable returning the key set as a dict ({'keys': [...]})
+    ttl: seconds the fetched key set is considered fresh
+    refresh_ahead: seconds before expiry when a background refresh starts
+    min_refetch_interval: minimum seconds between refetches forced by
+                          an unknown 'kid'
+    retry_interval: seconds without fetches after a failed one
+    clock: callable returning the current time in seconds
+    '''
+
+    def __init__(self, source, ttl=JWKS_CACHE_TTL,
+                 refresh_ahead=JWKS_REFRESH_AHEAD,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 retry_interval=JWKS_RETRY_INTERVAL,
+                 clock=time.monotonic):
+        self.source = source
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.min_refetch_interval = min_refetch_interval
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.keys = {}
+        self.fetched_at = None
+        self.failed_at = None
+        self.last_forced_fetch = None
+        self._lock = threading.Lock()
+        # held by the one caller fetching synchronously
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+
+    def set_source(self, source):
+        '''Replaces the key source and drops all cached keys'''
+
+        with self._lock:
+            self.source = source
+            self.keys = {}
+            self.fetched_at = None
+            self.failed_at = None
+            self.last_forced_fetch = None
+
+    def load(self, jwks):
+        '''Replaces cached keys with the keys of a fetched key set'''
+
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use'),
+                'n': key['n'],
+                'e': key['e']
+            }
+        with self._lock:
+            self.keys = keys
+            self.fetched_at = self.clock()
+            self.failed_at = None
+        return keys
+
+    def refresh(self):
+        '''Fetches the key set from the source and replaces cached keys'''
+
+        with measure(jwks_fetch_seconds):
+            jwks = self.source()
+        return self.load(jwks)
+
+    def backing_off(self):
+        '''Whether a fetch failed less than retry_interval ago'''
+
+        return self.failed_at is not None and \
+            self.clock() - self.failed_at < self.retry_interval
+
+    def back_off(self):
+        '''Records a failed fetch, see backing_off'''
+
+        self.failed_at = self.clock()
+
+    def expired(self):
+        '''Whether the key set has to be fetched before it is used'''
+
+        if self.backing_off():
+            return False
+        return self.fetched_at is None or \
+            self.clock() - self.fetched_at >= self.ttl
+
+    def start_refresh(self):
+        '''Whether a refresh ahead of expiry should start now, True for
+        only one caller until finish_refresh is called
+        '''
+
+        if self.fetched_at is None or self.backing_off() or \
+                self.clock() - self.fetched_at < \
+                self.ttl - self.refresh_ahead:
+            return False
+        with self._lock:
+            start = not self._refreshing
+            self._refreshing = True
+        return start
+
+    def finish_refresh(self):
+        self._refreshing = False
+
+    def allow_forced_fetch(self):
+        '''Whether an unknown 'kid' may refetch the key set, at most once
+        per min_refetch_interval
+        '''
+
+        now = self.clock()
+        with self._lock:
+            if (self.last_forced_fetch is not None and
+                    now - self.last_forced_fetch < self.min_refetch_interval):
+                return False
+            self.last_forced_fetch = now
+        return True
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.warning('Background JWKS refresh failed', exc_info=True)
+            self.back_off()
+        finally:
+            self.finish_refresh()
+
+    def previous_keys(self):
+        '''Returns the keys to use while fetches fail, the previous ones
+
+        Raises AuthError 503 if there are none
+        '''
+
+        if self.keys:
+            return self.keys
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch signing keys.'
+        }, 503)
+
+    def fetch_failed(self):
+        '''Returns the keys to use after a failed fetch, see previous_keys,
+        and backs off further fetches
+        '''
+
+        logger.warning('JWKS fetch failed', exc_info=True)
+        self.back_off()
+        return self.previous_keys()
+
+    def _fetch_or_fail(self, needed):
+        '''Fetches the key set once for concurrent callers
+
+        Callers waiting for another caller's fetch use its keys, unless
+        needed() still holds after it and no failure is being backed off.
+        '''
+
+        with self._fetch_lock:
+            if not needed():
+                return self.keys
+            if self.backing_off():
+                return self.previous_keys()
+            try:
+                return self.refresh()
+            except Exception:
+                return self.fetch_failed()
+
+    def get_key(self, kid):
+        '''Returns the RSA key with given 'kid' or None if it is unknown
+
+        Expired key sets are refetched synchronously by one caller while
+        the others wait for it, key sets close to expiry are refreshed in
+        a background thread. An unknown 'kid' forces one refetch, at most
+        once per min_refetch_interval. After a failed fetch the previous
+        keys are used for retry_interval without fetching again.
+        '''
+
+        keys = self.keys
+        if self.expired():
+            keys = self._fetch_or_fail(self.expired)
+        elif not keys:
+            # the last fetch failed moments ago
+            keys = self.previous_keys()
+        elif self.start_refresh():
+            threading.Thread(target=self._refresh_in_background,
+                             daemon=True).start()
+
+        if kid in keys:
+            return keys[kid]
+        if not self.allow_forced_fetch():
+            return None
+        return self._fetch_or_fail(lambda: kid not in self.keys).get(kid)
+
+
+jwks_cache = JWKSCache(url_jwks_source(JWKS_URL))
+
+
+def unverified_kid(token):
+    '''Returns the 'kid' of the token's header, before verification'''
 
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
+
+
+def decode_with_key(token, rsa_key):
+    '''Verifies the token with the RSA key and returns its payload'''
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -108,19 +341,142 @@ def verify_decode_jwt(token):
                 'code': 'invalid_header',
                 'description': 'Unable to parse authentication token.'
             }, 400)
-        raise AuthError({
-            'code': 'invalid_header',
-            'description': 'Unable to find the appropriate key.'
-        }, 401)
+    raise AuthError({
+        'code': 'invalid_header',
+        'description': 'Unable to find the appropriate key.'
+    }, 401)
+
+
+def verify_decode_jwt(token):
+    '''Verify token'''
+
+    rsa_key = jwks_cache.get_key(unverified_kid(token))
+    return decode_with_key(token, rsa_key)
+
+
+class TokenCache:
+    '''TokenCache
+    LRU cache of verified token payloads keyed by a hash of the token
+
+    Entries are kept until the token's 'exp' claim, tokens without
+    'exp' are never cached.
+
+    Parameters
+    ----------
+    maxsize: maximum number of cached tokens
+    clock: callable returning the current unix time in seconds
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        '''Returns the cached payload of the token or None'''
+
+        key = self.key(token)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry['exp'] <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['payload']
+
+    def put(self, token, payload):
+        '''Stores a verified payload until its expiration time'''
+
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)) or self.maxsize <= 0:
+            return
+        key = self.key(token)
+        with self._lock:
+            self.entries[key] = {'payload': payload, 'exp': exp}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token):
+        '''Drops the given token from the cache'''
+
+        with self._lock:
+            return self.entries.pop(self.key(token), None) is not None
+
+    def invalidate_subject(self, sub):
+        '''Drops every cached token issued to the given subject'''
+
+        with self._lock:
+            keys = [key for key, entry in self.entries.items()
+                    if entry['payload'].get('sub') == sub]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+token_cache = TokenCache()
+
+
+def get_verified_payload(token):
+    '''Returns the token payload, verifying the signature on cache miss'''
+
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = verify_decode_jwt(token)
+        token_cache.put(token, payload)
+    return payload
 
 
 def requires_auth(permission=''):
+    '''Decorator of views checking the token's permission
+
+    Parameters
+    ----------
+    permission: permission needed, or a callable receiving the url
+                arguments of the view and returning it
+    '''
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            needed = permission(**kwargs) if callable(permission) \
+                else permission
+            with timed('auth'):
+                token = get_token_auth_header()
+                payload = get_verified_payload(token)
+                check_permissions(needed, payload)
+            rate_limiter.check(needed, payload)
+            g.jwt_payload = payload
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
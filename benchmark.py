@@ -0,0 +1,458 @@
+'''Benchmarks every endpoint of app.py against a seeded local database
+
+Run with `python benchmark.py [--movies 1000] [--actors 1000] [--links 5]
+[--concurrency 16] [--requests 500] [--output report.json]`.
+
+1. A SQLite database in a temporary directory (or --database-url, whose
+   tables are dropped and recreated) is seeded with --movies movies,
+   --actors actors and --links actors per movie.
+2. An RSA key is generated, its public half is written as the JWKS that
+   the app reads through JWKS_URL, and a token with every permission is
+   signed with it, so no Auth0 tenant is needed.
+3. Every route gets --samples requests in process, counting the SQL
+   statements each one executes.
+4. The app is started with gunicorn (or uvicorn asgi:app with --server
+   uvicorn) and every route gets --requests requests from --concurrency
+   concurrent clients.
+
+The report holds requests/sec, p50, p95 and p99 latency and queries per
+request of every route as json. Pass the report of another commit as
+--baseline to print the change of throughput and p99.
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+# Tokens are signed locally, these settings only have to be the same for
+# the benchmark and the server it starts
+os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
+os.environ.setdefault('ALGORITHMS', '["RS256"]')
+
+import httpx  # noqa: E402
+import rsa  # noqa: E402
+from jose import jwt  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from app import create_app  # noqa: E402
+from auth0 import (  # noqa: E402
+    jwks_cache,
+    token_cache,
+    url_jwks_source,
+    AUTH0_DOMAIN,
+    API_AUDIENCE
+)
+from loadtest import percentile  # noqa: E402
+from models import (  # noqa: E402
+    setup_db,
+    db,
+    movie_actor,
+    recount_links,
+    Actor,
+    Movie,
+    BULK_CHUNK_SIZE,
+    GENDERS
+)
+
+PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors',
+    'patch:movies', 'patch:actors', 'delete:movies', 'delete:actors'
+]
+
+
+class Seed:
+    '''Sizes of the seeded database
+
+    Movies and actors past the first `movies` and `actors` ids have no
+    links and are deleted by the DELETE routes, `reserved` of each.
+    '''
+
+    def __init__(self, movies, actors, links, reserved):
+        self.movies = movies
+        self.actors = actors
+        self.links = min(links, actors)
+        self.reserved = reserved
+
+    def movie(self, n):
+        return 1 + n % self.movies
+
+    def actor(self, n):
+        return 1 + n % self.actors
+
+    def insert(self):
+        '''Fills the tables of the current app, in chunks of
+        BULK_CHUNK_SIZE rows, and sets the link counters
+        '''
+
+        start = datetime(1970, 1, 1)
+        movies = [{'title': f'Movie {i}',
+                   'release_date': start + timedelta(days=i * 7)}
+                  for i in range(self.movies + self.reserved)]
+        actors = [{'name': f'Actor {i}', 'age': 18 + i % 60,
+                   'gender': GENDERS[i % len(GENDERS)]}
+                  for i in range(self.actors + self.reserved)]
+        # same links on every run
+        choose = random.Random(0).sample
+        links = [{'movie_id': movie_id, 'actor_id': actor_id}
+                 for movie_id in range(1, self.movies + 1)
+                 for actor_id in choose(range(1, self.actors + 1),
+                                        self.links)]
+        for table, rows in ((Movie.__table__, movies),
+                            (Actor.__table__, actors),
+                            (movie_actor, links)):
+            for chunk in range(0, len(rows), BULK_CHUNK_SIZE):
+                db.session.execute(table.insert(),
+                                   rows[chunk:chunk + BULK_CHUNK_SIZE])
+        db.session.commit()
+        # links are inserted directly, the counters of the search filters
+        # and sorts start at 0
+        recount_links()
+
+
+def routes(seed):
+    '''Returns (name, request builder) pairs of every endpoint
+
+    A builder returns the path and json body of the n-th request sent
+    to the route, detail routes go through the seeded ids and DELETE
+    routes through the reserved ones.
+    '''
+
+    def release_date(n):
+        return f'{2000 + n % 20}-01-01'
+
+    return [
+        ('GET /movies', lambda n: ('/movies', None)),
+        ('GET /movies?include=actors',
+         lambda n: ('/movies?include=actors', None)),
+        ('GET /movies/<id>', lambda n: (f'/movies/{seed.movie(n)}', None)),
+        ('GET /movies/search',
+         lambda n: ('/movies/search?released_from=1990-01-01'
+                    '&sort=-release_date', None)),
+        ('GET /movies/export', lambda n: ('/movies/export', None)),
+        ('GET /actors', lambda n: ('/actors', None)),
+        ('GET /actors?include=movies',
+         lambda n: ('/actors?include=movies', None)),
+        ('GET /actors/<id>', lambda n: (f'/actors/{seed.actor(n)}', None)),
+        ('GET /actors/<id>/costars',
+         lambda n: (f'/actors/{seed.actor(n)}/costars', None)),
+        ('GET /actors/<id>/path/<id>',
+         lambda n: (f'/actors/{seed.actor(n)}/path/'
+                    f'{seed.actor(n * 7919 + 1)}', None)),
+        ('GET /actors/search',
+         lambda n: ('/actors/search?gender=female&age_min=30', None)),
+        ('GET /actors/export', lambda n: ('/actors/export', None)),
+        ('GET /search', lambda n: (f'/search?q=movie+{n % 100}', None)),
+        ('POST /movies', lambda n: ('/movies', {
+            'title': f'New movie {n}', 'release_date': release_date(n)})),
+        ('POST /actors', lambda n: ('/actors', {
+            'name': f'New actor {n}', 'age': 30, 'gender': 'other'})),
+        ('POST /movies/bulk', lambda n: ('/movies/bulk', {
+            'movies': [{'title': f'Bulk movie {n}.{i}',
+                        'release_date': release_date(i)}
+                       for i in range(10)],
+            'mode': 'best_effort'})),
+        ('POST /actors/bulk', lambda n: ('/actors/bulk', {
+            'actors': [{'name': f'Bulk actor {n}.{i}', 'age': 20 + i,
+                        'gender': 'female'} for i in range(10)],
+            'mode': 'best_effort'})),
+        ('PATCH /movies/<id>', lambda n: (f'/movies/{seed.movie(n)}', {
+            'title': f'Movie {n}'})),
+        ('PATCH /actors/<id>', lambda n: (f'/actors/{seed.actor(n)}', {
+            'age': 18 + n % 60})),
+        ('DELETE /movies/<id>',
+         lambda n: (f'/movies/{seed.movies + 1 + n}', None)),
+        ('DELETE /actors/<id>',
+         lambda n: (f'/actors/{seed.actors + 1 + n}', None)),
+    ]
+
+
+def make_keys(directory):
+    '''Generates an RSA key and writes its JWKS into directory
+
+    Returns the private key as PEM and the file url of the JWKS
+    '''
+
+    public, private = rsa.newkeys(2048)
+
+    def encode(number):
+        data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+        return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as jwks:
+        json.dump({'keys': [{'kty': 'RSA', 'kid': 'benchmark', 'use': 'sig',
+                             'n': encode(public.n), 'e': encode(public.e)}]},
+                  jwks)
+    return private.save_pkcs1().decode(), 'file://' + path
+
+
+def make_token(private_key):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'aud': API_AUDIENCE,
+        'sub': 'benchmark',
+        'iat': now,
+        'exp': now + 24 * 3600,
+        'permissions': PERMISSIONS
+    }, private_key, algorithm='RS256', headers={'kid': 'benchmark'})
+
+
+def count_queries(app, token, builders, samples):
+    '''Sends the first samples requests of every route in process
+
+    Returns the statements executed for each route
+    '''
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    with app.app_context():
+        engine = db.get_engine(app)
+    counts = {}
+    for name, builder in builders:
+        method = name.split()[0]
+        statements = []
+
+        def count(*args):
+            statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', count)
+        for n in range(samples):
+            path, body = builder(n)
+            client.open(path, method=method, json=body,
+                        headers=headers).close()
+        event.remove(engine, 'before_cursor_execute', count)
+        counts[name] = statements
+    return counts
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server, workers, port, env, log):
+    if server == 'uvicorn':
+        command = ['uvicorn', 'asgi:app', '--port', str(port),
+                   '--workers', str(workers), '--no-access-log']
+    else:
+        command = ['gunicorn', '-w', str(workers),
+                   '-b', f'127.0.0.1:{port}', 'app:APP']
+    return subprocess.Popen(
+        command, env=env, stdout=log,
+        stderr=subprocess.STDOUT,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_until_ready(base_url, headers, process, log, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if httpx.get(base_url + '/movies?limit=1',
+                         headers=headers).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'The server did not start, see {log.name}')
+
+
+async def drive(base_url, headers, method, requests, concurrency):
+    '''Sends (path, body) requests with concurrency clients
+
+    Returns the latencies of successful requests, the number of failed
+    ones and the elapsed time
+    '''
+
+    latencies = []
+    failures = 0
+    pending = iter(requests)
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers,
+                                 limits=limits, timeout=60) as client:
+
+        async def worker():
+            nonlocal failures
+            # the clients share the iterator, every request is sent once
+            for path, body in pending:
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, json=body)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, failures, time.perf_counter() - start
+
+
+def summarize(latencies, failures, elapsed, statements, samples):
+    latencies = sorted(latencies)
+    total = len(latencies) + failures
+    return {
+        'requests': total,
+        'errors': failures,
+        'throughput': round(total / elapsed, 1) if elapsed else None,
+        # null when every request failed
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2)
+            if latencies else None
+            for name, fraction in (('p50', 0.5), ('p95', 0.95),
+                                   ('p99', 0.99))
+        },
+        'queries_per_request':
+            round(len(statements) / samples, 2) if samples else None
+    }
+
+
+def change(value, old):
+    if not old or value is None:
+        return '-'
+    return f'{(value - old) / old * 100:+.1f}%'
+
+
+def compare(report, baseline):
+    '''Prints the change of throughput and p99 against a baseline'''
+
+    print(f"{'route':<28} {'req/s':>10} {'p99':>10}", file=sys.stderr)
+    for name, result in report['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        throughput = change(result['throughput'], before['throughput'])
+        p99 = change(result['latency_ms']['p99'],
+                     before['latency_ms']['p99'])
+        print(f'{name:<28} {throughput:>10} {p99:>10}', file=sys.stderr)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--movies', type=int, default=1000)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--links', type=int, default=5,
+                        help='actors per movie')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per route')
+    parser.add_argument('--samples', type=int, default=20,
+                        help='requests per route counting queries')
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn'],
+                        default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--routes', default='',
+                        help='comma separated route name prefixes')
+    parser.add_argument('--database-url',
+                        help='database to use instead of SQLite, '
+                             'its tables are dropped')
+    parser.add_argument('--output', help='report file, default stdout')
+    parser.add_argument('--baseline', help='report to compare with')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    database_url = options.database_url or \
+        'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    seed = Seed(options.movies, options.actors, options.links,
+                options.samples + options.requests)
+    prefixes = [prefix for prefix in options.routes.split(',') if prefix]
+    builders = [(name, builder) for name, builder in routes(seed)
+                if not prefixes or name.startswith(tuple(prefixes))]
+
+    private_key, jwks_url = make_keys(directory)
+    token = make_token(private_key)
+    jwks_cache.set_source(url_jwks_source(jwks_url))
+
+    app = create_app()
+    setup_db(app, database_url, [])
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed.insert()
+    queries = count_queries(app, token, builders, options.samples)
+    token_cache.clear()
+
+    env = dict(os.environ, DATABASE_URL=database_url, JWKS_URL=jwks_url,
+               DATABASE_REPLICA_URLS='')
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    headers = {'Authorization': f'Bearer {token}'}
+    results = {}
+    with open(os.path.join(directory, 'server.log'), 'w') as log:
+        process = start_server(options.server, options.workers, port, env,
+                               log)
+        try:
+            wait_until_ready(base_url, headers, process, log)
+            for name, builder in builders:
+                requests = [builder(options.samples + n)
+                            for n in range(options.requests)]
+                latencies, failures, elapsed = asyncio.run(drive(
+                    base_url, headers, name.split()[0], requests,
+                    options.concurrency))
+                results[name] = summarize(latencies, failures, elapsed,
+                                          queries[name], options.samples)
+                print(f"{name:<28} {results[name]['throughput']!s:>9} req/s "
+                      f"p99 {results[name]['latency_ms']['p99']!s:>8} ms "
+                      f"{results[name]['errors']:>5} errors",
+                      file=sys.stderr)
+        finally:
+            process.terminate()
+            process.wait()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(),
+        'settings': {
+            'movies': options.movies,
+            'actors': options.actors,
+            'links': seed.links,
+            'concurrency': options.concurrency,
+            'requests': options.requests,
+            'samples': options.samples,
+            'server': options.server,
+            'workers': options.workers,
+            'database': 'sqlite' if options.database_url is None
+                        else database_url.split(':')[0],
+        },
+        'routes': results
+    }
+    body = json.dumps(report, indent=2)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(body + '\n')
+    else:
+        print(body)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            compare(report, json.load(baseline))
+    print(f'Server log: {log.name}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''Measures the cost of the /metrics collection
+
+Run with `python benchmark_metrics.py [--requests 5000] [--routes 20]`.
+Prints the time taken by record_request, the per request overhead of the
+metrics on a Flask request answered by the AuthError handler, and the
+time taken to write this worker's metrics and to render /metrics when
+METRICS_DIR holds the files of --workers workers.
+'''
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+from unittest import mock
+
+os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import instrumentation  # noqa: E402
+import metrics  # noqa: E402
+from app import APP  # noqa: E402
+
+
+def per_call(function, number):
+    '''Best time of one call in microseconds over 5 rounds'''
+
+    return min(timeit.repeat(function, number=number, repeat=5)) \
+        / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--routes', type=int, default=20,
+                        help='distinct routes already counted')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='worker files read by /metrics')
+    options = parser.parse_args()
+
+    for number in range(options.routes):
+        for status in (200, 401, 404):
+            metrics.record_request(f'/route{number}', 'GET', status, 0.01)
+
+    record = per_call(
+        lambda: metrics.record_request('/movies', 'GET', 200, 0.012),
+        options.requests)
+
+    client = APP.test_client()
+    disabled = [
+        mock.patch.object(instrumentation, 'record_request',
+                          lambda *args: None),
+        mock.patch.object(metrics.auth_errors, 'inc', lambda *args: None),
+    ]
+    with_metrics = without_metrics = float('inf')
+    # alternating rounds, so both see the same machine load
+    for _ in range(5):
+        with_metrics = min(with_metrics, per_call(
+            lambda: client.get('/movies'), options.requests // 5))
+        for patch in disabled:
+            patch.start()
+        without_metrics = min(without_metrics, per_call(
+            lambda: client.get('/movies'), options.requests // 5))
+        for patch in disabled:
+            patch.stop()
+
+    directory = tempfile.mkdtemp(prefix='metrics-')
+    try:
+        registry = metrics.registry
+        registry.directory = directory
+        with APP.app_context():
+            flush = per_call(registry.flush, 200)
+            for number in range(options.workers - 1):
+                shutil.copy(registry.path, os.path.join(
+                    directory, f'{os.getpid()}-copy{number}.json'))
+            start = time.perf_counter()
+            text = registry.render()
+            render = (time.perf_counter() - start) * 1000
+    finally:
+        registry.directory = None
+        shutil.rmtree(directory)
+
+    overhead = with_metrics - without_metrics
+    print(f'record_request          {record:>8.2f}us')
+    print(f'request with metrics    {with_metrics:>8.1f}us')
+    print(f'request without metrics {without_metrics:>8.1f}us')
+    print(f'overhead per request    {overhead:>8.1f}us '
+          f'({overhead / without_metrics:.1%})')
+    print(f'flush                   {flush / 1000:>8.2f}ms '
+          f'(every {metrics.METRICS_FLUSH_SECONDS:g}s)')
+    print(f'render                  {render:>8.2f}ms '
+          f'({options.workers} workers, {len(text.splitlines())} lines)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''Compares the ways of serializing movie listings
+
+Run with `python benchmark_serialization.py [--rows 1000,10000,100000]`.
+Movies are stored in an in-memory SQLite database, every path reads all
+of them and produces the json body of a listing:
+
+orm+jsonify: ORM instances, a dict per movie with strftime, jsonify
+             (the path used before serializer.py)
+rows+json: column tuples, format_row with cached dates, stdlib json
+rows+orjson: column tuples, format_row with cached dates, orjson
+core+orjson: records of a Core select (models.ReadQuery), orjson
+'''
+
+import argparse
+import time
+
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify
+
+from models import setup_db, db, Movie, ReadQuery
+from serializer import format_date, get_dumps, orjson
+
+
+def legacy_format(movie):
+    return {
+        'id': movie.id,
+        'title': movie.title,
+        'release_date': movie.release_date.strftime('%A, %b %d %Y'),
+        'updated_at': movie.updated_at.isoformat()
+    }
+
+
+def orm_jsonify():
+    movies = Movie.query.order_by(Movie.id).all()
+    body = jsonify({'success': True,
+                    'movies': [legacy_format(movie) for movie in movies]})
+    db.session.expunge_all()
+    return body.get_data()
+
+
+def rows_with(dumps):
+    def serialize():
+        rows = Movie.query.with_entities(*Movie.row_columns) \
+            .order_by(Movie.id).all()
+        return dumps({'success': True,
+                      'movies': [Movie.format_row(row) for row in rows]})
+    return serialize
+
+
+def records_with(dumps):
+    def serialize():
+        records = ReadQuery(Movie).order_by(Movie.id).all()
+        return dumps({'success': True,
+                      'movies': [Movie.format_row(record)
+                                 for record in records]})
+    return serialize
+
+
+def seed(count):
+    db.session.execute(Movie.__table__.delete())
+    start = datetime(2000, 1, 1)
+    now = datetime.utcnow()
+    db.session.bulk_insert_mappings(Movie, [
+        {'title': f'Movie {i}',
+         'release_date': start + timedelta(days=i % 3650),
+         'updated_at': now}
+        for i in range(count)])
+    db.session.commit()
+
+
+def best_of(repeat, f):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+
+    paths = {'orm+jsonify': orm_jsonify,
+             'rows+json': rows_with(get_dumps('json'))}
+    if orjson is not None:
+        paths['rows+orjson'] = rows_with(get_dumps('orjson'))
+        paths['core+orjson'] = records_with(get_dumps('orjson'))
+
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+    with app.test_request_context():
+        db.create_all()
+        print(f"{'rows':>8} " + ' '.join(f'{name:>14}' for name in paths))
+        for count in map(int, options.rows.split(',')):
+            seed(count)
+            format_date.cache_clear()
+            timings = [best_of(options.repeat, f) for f in paths.values()]
+            print(f'{count:>8} ' + ' '.join(f'{timing * 1000:>12.1f}ms'
+                                            for timing in timings))
+
+
+if __name__ == '__main__':
+    main()
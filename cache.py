@@ -0,0 +1,287 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import current_app, g, request
+
+from instrumentation import timed
+
+# 'memory' (default), 'redis' or 'off'
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'memory')
+# Maximum number of responses kept by the in-process cache
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+# Seconds a cached response is kept at most
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 300))
+# Maximum number of tag versions kept by the in-process cache
+RESPONSE_CACHE_TAGS = int(os.getenv('RESPONSE_CACHE_TAGS', 10000))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+
+class MemoryBackend:
+    '''MemoryBackend
+    In-process LRU store of cached responses and tag versions
+
+    Only writes of this process bump its tag versions, writes of other
+    processes make responses stale through the ETag in their key, see
+    ResponseCache.key.
+
+    Tag versions are kept apart from responses, in an LRU of their own.
+    Every bump takes the next value of one counter, and tags unknown or
+    evicted get the highest version evicted so far. An evicted tag thus
+    never goes back to a version older than its last one, which would
+    revive stale responses.
+    '''
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE,
+                 maxtags=RESPONSE_CACHE_TAGS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.maxtags = maxtags
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.versions = OrderedDict()
+        self.counter = 0
+        self.evicted_version = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self.entries[key] = (self.clock() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_versions(self, tags):
+        with self._lock:
+            versions = []
+            for tag in tags:
+                if tag in self.versions:
+                    self.versions.move_to_end(tag)
+                versions.append(self.versions.get(tag, self.evicted_version))
+            return versions
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.counter += 1
+                self.versions[tag] = self.counter
+                self.versions.move_to_end(tag)
+            while len(self.versions) > self.maxtags:
+                _, version = self.versions.popitem(last=False)
+                self.evicted_version = max(self.evicted_version, version)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.versions.clear()
+            self.counter = self.evicted_version = 0
+
+
+class RedisBackend:
+    '''RedisBackend
+    Store shared by all workers, takes any client with the redis-py
+    get/set/mget/incr interface
+    '''
+
+    def __init__(self, client, prefix='capstone:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=ttl)
+
+    def get_versions(self, tags):
+        values = self.client.mget([f'{self.prefix}tag:{tag}' for tag in tags])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def bump(self, tags):
+        for tag in tags:
+            self.client.incr(f'{self.prefix}tag:{tag}')
+
+
+class SingleFlight:
+    '''SingleFlight
+    Runs a function once for concurrent calls with the same key, the
+    other callers wait for its result or exception
+
+    Parameters
+    ----------
+    timeout: seconds a caller waits before running the function itself
+    '''
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function):
+        '''Returns the result of function and whether it was shared with
+        a call already in flight
+        '''
+
+        with self._lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'done': threading.Event(),
+                                          'followers': 0}
+                leader = True
+            else:
+                call['followers'] += 1
+                leader = False
+        if not leader:
+            if not call['done'].wait(self.timeout):
+                return function(), False
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+        try:
+            call['result'] = function()
+        except BaseException as error:
+            call['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['result'], False
+
+
+class ResponseCache:
+    '''ResponseCache
+    Caches successful json responses of read endpoints
+
+    Every entry depends on tags such as 'movies' (any movie listing) or
+    'movie:1' (the detail of movie 1). The current version of each tag
+    is part of the cache key, so invalidating a tag bumps its version
+    and makes every dependent entry unreachable at once.
+
+    Concurrent misses of the same key are coalesced, one request runs the
+    view and the others answer with its response.
+
+    Parameters
+    ----------
+    backend: MemoryBackend, RedisBackend or None to only coalesce
+    ttl: seconds a response is kept at most
+    '''
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def key(self, tags):
+        '''Cache key of the current request
+
+        Views decorated with conditional.conditional also key on their
+        ETag, derived from the table versions of the database. Tag
+        versions are only bumped by the process committing a write, so
+        other workers, or web workers after a write of
+        `python manage.py jobs`, would otherwise answer from their copy
+        older than the ETag. A replica lagging behind a write likewise
+        stores its stale response under its own key instead of the key of
+        the fresh data.
+        '''
+
+        args = urlencode(sorted(request.args.items(multi=True)))
+        versions = [] if self.backend is None else \
+            self.backend.get_versions(tags)
+        stamp = '.'.join(f'{tag}={version}'
+                         for tag, version in zip(tags, versions))
+        key = f'response:{request.path}?{args}#{stamp}'
+        if g.get('etag') is not None:
+            key += f'#{g.etag}'
+        return key
+
+    def cached(self, tags):
+        '''Decorator caching the view's response
+
+        Without a backend responses are not cached, concurrent requests
+        are still coalesced.
+
+        Parameters
+        ----------
+        tags: callable receiving the url arguments of the view and
+              returning the list of tags the response depends on
+        '''
+
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with timed('cache'):
+                    key = self.key(tags(**kwargs))
+                    body = None if self.backend is None else \
+                        self.backend.get(key)
+                if body is not None:
+                    self.hits += 1
+                    response = current_app.response_class(
+                        body, mimetype='application/json')
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                def render():
+                    response = current_app.make_response(f(*args, **kwargs))
+                    body = response.get_data()
+                    if response.status_code == 200 and \
+                            self.backend is not None:
+                        with timed('cache'):
+                            self.backend.set(key, body, self.ttl)
+                    return response, response.status_code, body
+
+                (response, status, body), shared = self.flights.run(
+                    key, render)
+                if shared:
+                    # the response of another request, its headers are
+                    # changed by that request's after_request hooks
+                    self.coalesced += 1
+                    response = current_app.response_class(
+                        body, status=status, mimetype='application/json')
+                    response.headers['X-Cache'] = 'COALESCED'
+                    return response
+                self.misses += 1
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return cached_decorator
+
+    def invalidate(self, *tags):
+        '''Makes every response depending on one of the tags stale'''
+
+        if self.backend is not None and tags:
+            self.backend.bump(sorted(set(tags)))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced}
+
+
+def backend_from_env():
+    if RESPONSE_CACHE == 'off':
+        return None
+    if RESPONSE_CACHE == 'redis':
+        import redis
+        return RedisBackend(redis.Redis.from_url(REDIS_URL))
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(backend_from_env())
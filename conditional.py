@@ -0,0 +1,108 @@
+from functools import wraps
+from hashlib import sha1
+from urllib.parse import urlencode
+
+from flask import current_app, g, request
+
+from models import get_versions
+
+
+def make_validators(path, args, tables, versions):
+    '''Computes the ETag and Last-Modified of a GET request
+
+    The ETag hashes the path, the query arguments and the versions of
+    the tables the response depends on, so it changes with every write
+    to them without serializing or hashing the body.
+
+    Parameters
+    ----------
+    path: path of the request
+    args: (name, value) pairs of the query arguments
+    tables: names of the tables the response depends on
+    versions: their (version, updated_at) pairs, see models.get_versions
+
+    Returns (etag, last_modified), both None if a table has no version
+    '''
+
+    if any(updated_at is None for version, updated_at in versions):
+        return None, None
+    args = urlencode(sorted(args))
+    stamp = '.'.join(f'{table}={version}'
+                     for table, (version, updated_at)
+                     in zip(tables, versions))
+    etag = sha1(f'{path}?{args}#{stamp}'.encode()).hexdigest()
+    last_modified = max(updated_at for version, updated_at in versions)
+    # HTTP dates have a resolution of one second
+    return etag, last_modified.replace(microsecond=0)
+
+
+def validators(tables):
+    '''Computes the ETag and Last-Modified of the current GET request,
+    see make_validators
+    '''
+
+    return make_validators(request.path, request.args.items(multi=True),
+                           tables, get_versions(tables))
+
+
+def is_fresh(etag, last_modified, if_none_match, if_modified_since):
+    '''Whether the client's copy matches, If-None-Match takes precedence
+    over If-Modified-Since as in RFC 7232
+
+    Parameters
+    ----------
+    etag, last_modified: validators of the current response
+    if_none_match: werkzeug ETags parsed from If-None-Match
+    if_modified_since: datetime parsed from If-Modified-Since or None
+    '''
+
+    if if_none_match:
+        return if_none_match.contains(etag)
+    if if_modified_since is None:
+        return False
+    return last_modified <= if_modified_since.replace(tzinfo=None)
+
+
+def not_modified(etag, last_modified):
+    '''Whether the client's copy of the current request matches, see
+    is_fresh
+    '''
+
+    return is_fresh(etag, last_modified, request.if_none_match,
+                    request.if_modified_since)
+
+
+def conditional(tables):
+    '''Decorator answering conditional GET requests
+
+    Versions are read before the view runs, so the body of a 200 response
+    is never older than its ETag. A matching If-None-Match or
+    If-Modified-Since gets 304 before the view queries or serializes
+    anything.
+
+    Parameters
+    ----------
+    tables: callable receiving the url arguments of the view and
+            returning the names of the tables the response depends on,
+            see models.VERSIONED_TABLES
+    '''
+
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag, last_modified = validators(tables(**kwargs))
+            if etag is None:
+                return f(*args, **kwargs)
+            # responses are cached by it, see cache.ResponseCache.key
+            g.etag = etag
+            if not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            return response
+        return wrapper
+    return conditional_decorator
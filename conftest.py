@@ -0,0 +1,13 @@
+'''Settings of the test suite, loaded by pytest before any test module
+
+auth0 reads its settings when it is first imported, whichever test
+module does so, so they are set here rather than in testing.py alone.
+'''
+
+import os
+
+# Tokens are signed locally by testing.LocalIssuer, these settings only
+# have to be the same for the issuer and auth0
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
+os.environ.setdefault('ALGORITHMS', '["RS256"]')
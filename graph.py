@@ -0,0 +1,314 @@
+'''In-memory index of movie_actor answering co-star queries
+
+Every worker keeps movie_actor as two compressed sparse row (CSR) arrays,
+the movies of each actor and the actors of each movie. Links written
+after the arrays were built are kept in small per-id overlays, read from
+link_changes on the first query after a write, and folded into new arrays
+once there are GRAPH_COMPACT_CHANGES of them.
+'''
+
+import os
+import threading
+
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+from models import (
+    db,
+    get_versions,
+    link_changes,
+    movie_actor,
+    LINK_CHANGES_KEPT
+)
+
+# Links in the overlays after which the arrays are built again
+GRAPH_COMPACT_CHANGES = int(os.getenv('GRAPH_COMPACT_CHANGES', 100000))
+# Longest co-star chain searched by shortest_path, larger 'max_degrees'
+# are clamped to it
+GRAPH_MAX_DEGREES = int(os.getenv('GRAPH_MAX_DEGREES', 6))
+# Links fetched per round trip while building the arrays
+GRAPH_BATCH_SIZE = int(os.getenv('GRAPH_BATCH_SIZE', 10000))
+
+
+class Adjacency:
+    '''Adjacency
+    Linked ids of every movie or actor
+
+    offsets[id] to offsets[id + 1] is the slice of targets holding the
+    sorted ids linked to id. Ids past the end of offsets have no links
+    in the arrays. Links added or removed since are kept in the added and
+    removed sets of their id.
+
+    Parameters
+    ----------
+    pairs: (id, linked id) pairs ordered by id and linked id
+    '''
+
+    def __init__(self, pairs=()):
+        offsets = array('q', [0])
+        targets = array('i')
+        for source, target in pairs:
+            while len(offsets) <= source:
+                offsets.append(len(targets))
+            targets.append(target)
+        offsets.append(len(targets))
+        self.offsets = offsets
+        self.targets = targets
+        self.added = {}
+        self.removed = {}
+        self.changes = 0
+
+    def _bounds(self, id):
+        if id + 1 < len(self.offsets):
+            return self.offsets[id], self.offsets[id + 1]
+        return 0, 0
+
+    def in_arrays(self, id, linked_id):
+        start, end = self._bounds(id)
+        index = bisect_left(self.targets, linked_id, start, end)
+        return index < end and self.targets[index] == linked_id
+
+    def linked(self, id):
+        '''Returns the ids linked to id'''
+
+        start, end = self._bounds(id)
+        linked = self.targets[start:end]
+        removed = self.removed.get(id)
+        if removed:
+            linked = [linked_id for linked_id in linked
+                      if linked_id not in removed]
+        added = self.added.get(id)
+        if added:
+            linked = list(linked) + sorted(added)
+        return linked
+
+    def _change(self, changes, id, linked_id, undone):
+        if linked_id in undone.get(id, ()):
+            undone[id].discard(linked_id)
+            self.changes -= 1
+        else:
+            changes.setdefault(id, set()).add(linked_id)
+            self.changes += 1
+
+    def add(self, id, linked_id):
+        '''Links linked_id to id, links already present are kept'''
+
+        if linked_id in self.removed.get(id, ()) or \
+                not self.in_arrays(id, linked_id):
+            if linked_id not in self.added.get(id, ()):
+                self._change(self.added, id, linked_id, self.removed)
+
+    def remove(self, id, linked_id):
+        '''Unlinks linked_id from id, missing links are ignored'''
+
+        if linked_id in self.added.get(id, ()) or \
+                self.in_arrays(id, linked_id):
+            if linked_id not in self.removed.get(id, ()):
+                self._change(self.removed, id, linked_id, self.added)
+
+
+def stream_links(key, other):
+    '''Yields the (key, other) pairs of movie_actor ordered by key'''
+
+    select = db.select([movie_actor.c[key], movie_actor.c[other]]) \
+        .order_by(movie_actor.c[key], movie_actor.c[other]) \
+        .execution_options(stream_results=True)
+    result = db.session.execute(select)
+    while True:
+        rows = result.fetchmany(GRAPH_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row[0], row[1]
+
+
+class CastGraph:
+    '''CastGraph
+    Movies of every actor and actors of every movie, kept up to date
+    with the 'links' version of table_versions
+
+    Parameters
+    ----------
+    compact_changes: see GRAPH_COMPACT_CHANGES
+    changes_kept: see models.LINK_CHANGES_KEPT
+    '''
+
+    def __init__(self, compact_changes=GRAPH_COMPACT_CHANGES,
+                 changes_kept=LINK_CHANGES_KEPT):
+        self.compact_changes = compact_changes
+        self.changes_kept = changes_kept
+        self.version = None
+        self.movies = None
+        self.actors = None
+        self.builds = 0
+        self.lock = threading.RLock()
+
+    def clear(self):
+        '''Drops the arrays, the next query builds them again'''
+
+        with self.lock:
+            self.version = self.movies = self.actors = None
+
+    def build(self, version):
+        # links written while reading are read again from link_changes,
+        # adding and removing them twice changes nothing
+        self.movies = Adjacency(stream_links('actor_id', 'movie_id'))
+        self.actors = Adjacency(stream_links('movie_id', 'actor_id'))
+        self.version = version
+        self.builds += 1
+
+    def apply(self, movie_id, actor_id, added):
+        if added:
+            self.movies.add(actor_id, movie_id)
+            self.actors.add(movie_id, actor_id)
+        else:
+            self.movies.remove(actor_id, movie_id)
+            self.actors.remove(movie_id, actor_id)
+
+    def refresh(self):
+        '''Catches up with the links committed since the last query
+
+        Reads link_changes newer than the arrays, or builds them again
+        from movie_actor if the changes are no longer kept or the version
+        went back, e.g. after restoring a backup. Needs an application
+        context.
+        '''
+
+        with self.lock:
+            (version, _), = get_versions(['links'])
+            if self.version == version:
+                return
+            if self.version is None or version < self.version or \
+                    version - self.version > self.changes_kept:
+                self.build(version)
+                return
+            rows = db.session.execute(
+                db.select([link_changes.c.movie_id, link_changes.c.actor_id,
+                           link_changes.c.added])
+                .where(link_changes.c.version > self.version)
+                .where(link_changes.c.version <= version)
+                .order_by(link_changes.c.version)).fetchall()
+            for movie_id, actor_id, added in rows:
+                self.apply(movie_id, actor_id, added)
+            self.version = version
+            if self.movies.changes + self.actors.changes > \
+                    self.compact_changes:
+                self.build(version)
+
+    def costars(self, actor_id):
+        '''Returns (actor id, shared movies) pairs of the actors sharing a
+        movie with the given one, most shared movies first
+        '''
+
+        with self.lock:
+            self.refresh()
+            shared = Counter()
+            for movie_id in self.movies.linked(actor_id):
+                shared.update(self.actors.linked(movie_id))
+        shared.pop(actor_id, None)
+        return sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+
+    def shortest_path(self, actor_id, other_id,
+                      max_degrees=GRAPH_MAX_DEGREES):
+        '''Returns the shortest chain of co-stars from one actor to another
+
+        Searches from both actors at once, a level at a time from the side
+        with fewer actors to expand.
+
+        Parameters
+        ----------
+        actor_id: id of the first actor
+        other_id: id of the last actor
+        max_degrees: most movies in the chain
+
+        Returns
+        -------
+        actors: ids of the actors of the chain, starting with actor_id and
+                ending with other_id
+        movies: ids of the movies linking them, movies[i] has actors[i]
+                and actors[i + 1]
+        or None if there is no chain of at most max_degrees movies
+        '''
+
+        if actor_id == other_id:
+            return [actor_id], []
+        with self.lock:
+            self.refresh()
+            sides = [Side(actor_id), Side(other_id)]
+            while sides[0].frontier and sides[1].frontier and \
+                    sides[0].depth + sides[1].depth < max_degrees:
+                index = 0 if len(sides[0].frontier) <= \
+                    len(sides[1].frontier) else 1
+                meeting = sides[index].expand(self, sides[1 - index])
+                if meeting is not None:
+                    break
+            else:
+                return None
+        actor, movie_id, other = meeting
+        actors = sides[index].chain(actor)[::-1] + \
+            sides[1 - index].chain(other)
+        movies = sides[index].movie_chain(actor)[::-1] + [movie_id] + \
+            sides[1 - index].movie_chain(other)
+        if index == 1:
+            actors.reverse()
+            movies.reverse()
+        return actors, movies
+
+
+class Side:
+    '''One end of the bidirectional search of CastGraph.shortest_path
+
+    parents maps every reached actor to the actor and movie it was
+    reached through, or None for the start
+    '''
+
+    def __init__(self, actor_id):
+        self.parents = {actor_id: None}
+        self.frontier = [actor_id]
+        self.movies = set()
+        self.depth = 0
+
+    def expand(self, graph, other):
+        '''Reaches the actors one movie away from the frontier
+
+        Returns (actor, movie, other actor) linking this side to other,
+        or None
+        '''
+
+        frontier = []
+        for actor_id in self.frontier:
+            for movie_id in graph.movies.linked(actor_id):
+                # the actors of a movie are reached by its first actor
+                if movie_id in self.movies:
+                    continue
+                self.movies.add(movie_id)
+                for linked_id in graph.actors.linked(movie_id):
+                    if linked_id in other.parents:
+                        return actor_id, movie_id, linked_id
+                    if linked_id not in self.parents:
+                        self.parents[linked_id] = (actor_id, movie_id)
+                        frontier.append(linked_id)
+        self.frontier = frontier
+        self.depth += 1
+        return None
+
+    def chain(self, actor_id):
+        '''Actors from actor_id back to the start'''
+
+        actors = [actor_id]
+        while self.parents[actors[-1]] is not None:
+            actors.append(self.parents[actors[-1]][0])
+        return actors
+
+    def movie_chain(self, actor_id):
+        '''Movies from actor_id back to the start'''
+
+        movies = []
+        while self.parents[actor_id] is not None:
+            actor_id, movie_id = self.parents[actor_id]
+            movies.append(movie_id)
+        return movies
+
+
+cast_graph = CastGraph()
@@ -0,0 +1,167 @@
+import heapq
+import json
+import logging
+import os
+import time
+
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import record_request
+
+# Requests taking longer than this many milliseconds are logged as
+# warnings together with their slowest SQL statements
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 500))
+# Number of statements logged for a slow request
+SLOW_REQUEST_STATEMENTS = int(os.getenv('SLOW_REQUEST_STATEMENTS', 10))
+# Add a Server-Timing header to every response
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'true') == 'true'
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings:
+    '''RequestTimings
+    Time spent by one request in each phase and in SQL statements
+
+    Only the slowest statements are kept, so the memory used does not
+    grow with the number of statements.
+
+    Parameters
+    ----------
+    keep: number of slowest statements kept
+    '''
+
+    def __init__(self, keep=SLOW_REQUEST_STATEMENTS):
+        self.start = time.perf_counter()
+        self.keep = keep
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.statements = []
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_sql(self, statement, seconds):
+        self.sql_count += 1
+        self.sql_seconds += seconds
+        # a min-heap of (seconds, statement) holding the slowest ones
+        if len(self.statements) < self.keep:
+            heapq.heappush(self.statements, (seconds, statement))
+        elif self.keep and seconds > self.statements[0][0]:
+            heapq.heapreplace(self.statements, (seconds, statement))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total):
+        '''Returns the value of the Server-Timing header, in milliseconds'''
+
+        entries = [f'{phase};dur={seconds * 1000:.2f}'
+                   for phase, seconds in self.phases.items()]
+        entries.append(f'db;dur={self.sql_seconds * 1000:.2f};'
+                       f'desc="{self.sql_count} queries"')
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(entries)
+
+    def slowest(self):
+        return [{'duration_ms': round(seconds * 1000, 2),
+                 'statement': statement}
+                for seconds, statement in sorted(self.statements,
+                                                 reverse=True)]
+
+
+def current_timings():
+    '''Timings of the current request, None outside of requests'''
+
+    if not has_request_context():
+        return None
+    return g.get('timings')
+
+
+@contextmanager
+def timed(phase):
+    '''Adds the time spent in the with block to a phase of the current
+    request, e.g. 'auth' or 'serialize'
+    '''
+
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    start = conn.info['statement_start'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add_sql(statement, time.perf_counter() - start)
+
+
+@event.listens_for(Engine, 'handle_error')
+def fail_statement(context):
+    # after_cursor_execute does not run for failed statements
+    if context.connection is not None:
+        starts = context.connection.info.get('statement_start')
+        if starts:
+            starts.pop()
+
+
+def start_request():
+    '''Starts timing the current request, registered as before_request'''
+
+    g.timings = RequestTimings()
+
+
+def finish_request(response):
+    '''Adds the Server-Timing header to the response and logs the
+    request as one json line and counts it in /metrics, called by the
+    after_request hook
+
+    Requests slower than SLOW_REQUEST_MS are logged as warnings with
+    their slowest statements, others at the info level. Streamed
+    bodies are not included in the timings.
+    '''
+
+    timings = g.get('timings')
+    if timings is None:
+        return response
+    total = timings.elapsed()
+    # the url rule keeps the number of label values bounded
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    record_request(route, request.method, response.status_code, total)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.server_timing(total)
+    line = {
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(total * 1000, 2),
+        'phases_ms': {phase: round(seconds * 1000, 2)
+                      for phase, seconds in timings.phases.items()},
+        'sql_count': timings.sql_count,
+        'sql_ms': round(timings.sql_seconds * 1000, 2),
+    }
+    if total * 1000 >= SLOW_REQUEST_MS:
+        line['slow_statements'] = timings.slowest()
+        logger.warning(json.dumps(line))
+    elif logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(line))
+    return response
@@ -0,0 +1,355 @@
+'''Queue of the asynchronous writes
+
+Jobs are rows of a SQLite file shared by the workers of one host, so no
+broker is needed. Threads of the web workers, or of
+`python manage.py jobs`, claim them one at a time and record their
+progress in the row, where GET /jobs/<id> reads it.
+'''
+
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from datetime import datetime
+
+from flask import g
+
+from metrics import job_seconds, jobs_finished
+
+# SQLite file holding the queue, the web workers and job workers of a
+# host have to use the same one
+JOBS_DATABASE = os.getenv(
+    'JOBS_DATABASE', os.path.join(tempfile.gettempdir(), 'capstone-jobs.db'))
+# Threads running jobs in every web worker, started by its first job.
+# With 0 jobs only run in `python manage.py jobs`.
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Links or rows written per transaction by a job
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', 500))
+# Seconds an idle thread waits before looking for jobs queued by other
+# processes
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 1))
+# Seconds without progress after which a running job is marked failed,
+# its worker is assumed dead
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 600))
+# Seconds finished jobs can still be read
+JOB_RETENTION_SECONDS = float(os.getenv('JOB_RETENTION_SECONDS', 86400))
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        owner TEXT,
+        permission TEXT,
+        status TEXT NOT NULL,
+        done INTEGER NOT NULL DEFAULT 0,
+        total INTEGER,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        updated_at REAL NOT NULL,
+        finished_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS ix_jobs_status ON jobs (status, created_at);
+'''
+
+
+class JobFailed(Exception):
+    '''JobFailed Exception
+    Raised by job handlers for failures reported to the client
+
+    Parameters
+    ----------
+    message: error of the job
+    result: json result of the job, optional
+    '''
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.message = message
+        self.result = result
+
+
+class JobQueue:
+    '''JobQueue
+    Jobs kept in a SQLite file, every thread uses a connection of its own
+
+    Parameters
+    ----------
+    path: SQLite file, created with the table if missing
+    stale_seconds: see JOB_STALE_SECONDS
+    retention_seconds: see JOB_RETENTION_SECONDS
+    '''
+
+    def __init__(self, path=JOBS_DATABASE, stale_seconds=JOB_STALE_SECONDS,
+                 retention_seconds=JOB_RETENTION_SECONDS, clock=time.time):
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self.clock = clock
+        # set by enqueue, wakes the threads of this process
+        self.added = threading.Event()
+        self._local = threading.local()
+
+    def connection(self):
+        local = self._local
+        # connections are not shared with forked workers
+        if getattr(local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def enqueue(self, kind, payload, owner=None, permission=None):
+        '''Adds a job and returns its id
+
+        Parameters
+        ----------
+        kind: name of the handler running it, see JobWorkers
+        payload: json arguments of the handler
+        owner: 'sub' of the client's token, the only one reading the job
+        permission: permission needed to read the job
+        '''
+
+        id = uuid.uuid4().hex
+        now = self.clock()
+        self.connection().execute(
+            'INSERT INTO jobs (id, kind, payload, owner, permission, status,'
+            ' created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (id, kind, json.dumps(payload), owner, permission, 'queued',
+             now, now))
+        self.added.set()
+        return id
+
+    def get(self, id):
+        '''Returns the job with given id as a dict, or None'''
+
+        row = self.connection().execute(
+            'SELECT * FROM jobs WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for field in ('payload', 'result'):
+            if job[field] is not None:
+                job[field] = json.loads(job[field])
+        return job
+
+    def claim(self):
+        '''Marks the oldest queued job running and returns it, or None
+
+        Jobs of dead workers are failed and expired jobs removed first.
+        '''
+
+        connection = self.connection()
+        now = self.clock()
+        # the write lock is taken at once, so two workers never claim the
+        # same job
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = ?,"
+                ' finished_at = ? WHERE status = ? AND updated_at < ?',
+                ('interrupted', now, 'running', now - self.stale_seconds))
+            connection.execute(
+                'DELETE FROM jobs WHERE finished_at < ?',
+                (now - self.retention_seconds,))
+            row = connection.execute(
+                'SELECT id FROM jobs WHERE status = ?'
+                ' ORDER BY created_at LIMIT 1', ('queued',)).fetchone()
+            if row is not None:
+                connection.execute(
+                    'UPDATE jobs SET status = ?, started_at = ?,'
+                    ' updated_at = ? WHERE id = ?',
+                    ('running', now, now, row['id']))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return None if row is None else self.get(row['id'])
+
+    def progress(self, id, done, total=None):
+        '''Records the units of work done, out of total
+
+        Jobs no longer running, e.g. failed as stale, are left unchanged
+        '''
+
+        self.connection().execute(
+            'UPDATE jobs SET done = ?, total = COALESCE(?, total),'
+            ' updated_at = ? WHERE id = ? AND status = ?',
+            (done, total, self.clock(), id, 'running'))
+
+    def finish(self, id, status, result=None, error=None):
+        '''Records the outcome of a job, status 'succeeded' or 'failed'
+
+        Returns False if the job was no longer running, a job failed as
+        stale keeps that status
+        '''
+
+        now = self.clock()
+        cursor = self.connection().execute(
+            'UPDATE jobs SET status = ?, result = ?, error = ?,'
+            ' updated_at = ?, finished_at = ? WHERE id = ? AND status = ?',
+            (status, None if result is None else json.dumps(result), error,
+             now, now, id, 'running'))
+        return cursor.rowcount == 1
+
+
+def format_job(job):
+    '''Returns the fields of a job shown to clients'''
+
+    def iso(timestamp):
+        if timestamp is None:
+            return None
+        return datetime.utcfromtimestamp(timestamp).isoformat()
+
+    total = job['total']
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'done': job['done'],
+        'total': total,
+        'progress': job['done'] / total if total else
+        (1.0 if job['status'] == 'succeeded' else 0.0),
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': iso(job['created_at']),
+        'started_at': iso(job['started_at']),
+        'finished_at': iso(job['finished_at'])
+    }
+
+
+class JobWorkers:
+    '''JobWorkers
+    Threads running the jobs of a JobQueue in an application context
+
+    Parameters
+    ----------
+    queue: JobQueue
+    app: Flask application the handlers use
+    threads: see JOB_WORKERS
+    poll_seconds: see JOB_POLL_SECONDS
+    '''
+
+    def __init__(self, queue, app=None, threads=JOB_WORKERS,
+                 poll_seconds=JOB_POLL_SECONDS):
+        self.queue = queue
+        self.app = app
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.handlers = {}
+        self.started_pid = None
+        self.stopping = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def handler(self, kind):
+        '''Decorator registering the handler of a kind of job
+
+        Handlers receive the payload and a progress(done, total) callable,
+        return the json result and raise JobFailed for errors shown to
+        the client
+        '''
+
+        def handler_decorator(f):
+            self.handlers[kind] = f
+            return f
+        return handler_decorator
+
+    def submit(self, kind, payload, owner=None, permission=None):
+        '''Queues a job, see JobQueue.enqueue, and starts the threads of
+        this process
+        '''
+
+        id = self.queue.enqueue(kind, payload, owner, permission)
+        self.start()
+        return id
+
+    def start(self):
+        '''Starts the threads of this process once, forked workers start
+        their own
+        '''
+
+        if not self.threads or self.started_pid == os.getpid():
+            return
+        with self._lock:
+            if self.started_pid == os.getpid():
+                return
+            self.started_pid = os.getpid()
+        for number in range(self.threads):
+            thread = threading.Thread(target=self.work_forever,
+                                      name=f'jobs-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        '''Lets the threads finish their current job and waits for them'''
+
+        self.stopping.set()
+        self.queue.added.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def work_forever(self):
+        while not self.stopping.is_set():
+            self.queue.added.clear()
+            try:
+                job = self.run_next()
+            except Exception:
+                logger.warning('Claiming a job failed', exc_info=True)
+                job = None
+            if job is None:
+                self.queue.added.wait(self.poll_seconds)
+
+    def run_next(self):
+        '''Claims and runs one job in this thread, returns it or None if
+        the queue is empty
+        '''
+
+        job = self.queue.claim()
+        if job is None:
+            return None
+        start = time.perf_counter()
+        status, result, error = 'succeeded', None, None
+        try:
+            with self.app.app_context():
+                # writes of the job are the owner's, who then reads them
+                # from the primary, see replicas.current_client
+                g.jwt_payload = {'sub': job['owner']}
+                result = self.handlers[job['kind']](
+                    job['payload'],
+                    lambda done, total=None:
+                        self.queue.progress(job['id'], done, total))
+        except JobFailed as e:
+            status, result, error = 'failed', e.result, e.message
+        except Exception:
+            logger.exception('Job %s (%s) failed', job['id'], job['kind'])
+            status, error = 'failed', 'Something went wrong!'
+        if not self.queue.finish(job['id'], status, result, error):
+            logger.warning('Job %s (%s) finished after it was failed as '
+                           'stale', job['id'], job['kind'])
+            status = 'failed'
+        jobs_finished.inc(job['kind'], status)
+        job_seconds.observe(time.perf_counter() - start, job['kind'])
+        return job
+
+    def run_pending(self):
+        '''Runs queued jobs in this thread until none is left, returns
+        their number
+        '''
+
+        count = 0
+        while self.run_next() is not None:
+            count += 1
+        return count
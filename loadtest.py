@@ -0,0 +1,82 @@
+'''Measures requests/sec and latency of a running server
+
+Run with `python loadtest.py http://127.0.0.1:8000 /movies /actors/1
+[--concurrency 64] [--duration 10]`. Every path gets its own run in
+which --concurrency clients send GET requests back to back for
+--duration seconds. The bearer token is read from --token or the
+ASSISTANT_TOKEN environment variable.
+
+Point it at `gunicorn app:APP` and at `uvicorn asgi:app` serving the
+same database to compare the sync and async deployments, see README.
+'''
+
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+async def run(base_url, path, headers, concurrency, duration):
+    '''Returns the latencies of successful requests and the number of
+    failed ones
+    '''
+
+    latencies = []
+    failures = 0
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, headers=headers,
+                                 limits=limits, timeout=30) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal failures
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures += 1
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base_url')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--token', default=os.getenv('ASSISTANT_TOKEN'))
+    options = parser.parse_args()
+
+    headers = {'Authorization': f'Bearer {options.token}'}
+    print(f"{'path':<24} {'req/s':>9} {'p50':>9} {'p99':>9} {'errors':>7}")
+    for path in options.paths:
+        latencies, failures = asyncio.run(run(
+            options.base_url, path, headers, options.concurrency,
+            options.duration))
+        latencies.sort()
+        print(f'{path:<24} {len(latencies) / options.duration:>9.1f} '
+              f'{percentile(latencies, 0.5) * 1000:>7.1f}ms '
+              f'{percentile(latencies, 0.99) * 1000:>7.1f}ms '
+              f'{failures:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,38 @@
+import threading
+
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
-from models import db
+from app import APP, job_workers
+from models import db, recount_links
 
 migrate = Migrate(APP, db)
 manager = Manager(APP)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('-t', '--threads', dest='threads', type=int, default=2,
+                help='jobs run at once')
+def jobs(threads):
+    '''Runs the queued asynchronous writes until interrupted'''
+
+    for number in range(threads - 1):
+        threading.Thread(target=job_workers.work_forever,
+                         name=f'jobs-{number}', daemon=True).start()
+    job_workers.work_forever()
+
+
+@manager.option('--check', dest='check', action='store_true',
+                help='only report wrong counters')
+def recount(check):
+    '''Repairs actor_count and movie_count from movie_actor'''
+
+    wrong = recount_links(fix=not check)
+    for table, number in wrong.items():
+        print(f'{table}: {number} wrong counters'
+              f'{"" if check else " fixed"}')
+
+
 if __name__ == '__main__':
     manager.run()
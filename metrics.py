@@ -0,0 +1,378 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from pool import WAIT_BUCKETS
+
+# Directory where every worker process writes its metrics so that
+# /metrics can add them up, e.g. a tmpfs emptied before gunicorn starts.
+# Unset, /metrics only shows the metrics of the worker answering it.
+METRICS_DIR = os.getenv('METRICS_DIR')
+# Seconds between two writes of a worker's metrics to METRICS_DIR, the
+# delay before its requests show up in /metrics
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 1))
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   float('inf'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger(__name__)
+
+
+class Metric:
+    '''Metric
+    Values of one metric by label values, see Counter, Gauge and Histogram
+
+    Parameters
+    ----------
+    name: metric name, without the '_total' suffix of counters
+    help: description shown by Prometheus
+    labels: names of the labels
+    '''
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(labels), value]
+                       for labels, value in self.values.items()]
+        return {'kind': self.kind, 'help': self.help,
+                'labels': list(self.labels), 'samples': samples}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    '''Gauge, added up over the live workers only'''
+
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    '''Histogram, values are [counts per bucket, sum] pairs'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, *labels):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            value = self.values.get(labels)
+            if value is None:
+                value = self.values[labels] = [[0] * len(self.buckets), 0.0]
+            value[0][index] += 1
+            value[1] += seconds
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = [_format_bound(le) for le in self.buckets]
+        # copies, observe changes the lists in place
+        snapshot['samples'] = [[labels, [list(counts), total]]
+                               for labels, (counts, total)
+                               in snapshot['samples']]
+        return snapshot
+
+
+def _format_bound(le):
+    return '+Inf' if le == float('inf') else repr(float(le))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    '''Registry
+    Metrics of this process, written to METRICS_DIR and added up with the
+    ones of the other workers
+
+    Counters and histograms of exited workers keep counting, so totals
+    never go down, gauges only count for live workers.
+
+    Parameters
+    ----------
+    directory: METRICS_DIR, optional
+    flush_seconds: seconds between two writes
+    prefix: prepended to every metric name
+    '''
+
+    def __init__(self, directory=METRICS_DIR,
+                 flush_seconds=METRICS_FLUSH_SECONDS, prefix='capstone_'):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.prefix = prefix
+        self.metrics = []
+        self.collectors = []
+        self.pid = None
+        self.path = None
+        self.flusher_pid = None
+        self._lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collector):
+        '''Registers a function setting gauges right before metrics are
+        written or shown
+        '''
+
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        return {'pid': os.getpid(),
+                'metrics': {self.prefix + metric.name: metric.snapshot()
+                            for metric in self.metrics}}
+
+    def flush(self):
+        '''Writes the metrics of this process to its file in directory'''
+
+        if not self.directory:
+            return
+        pid = os.getpid()
+        if pid != self.pid:
+            # a forked worker gets a file of its own
+            self.pid = pid
+            self.path = os.path.join(self.directory,
+                                     f'{pid}-{uuid.uuid4().hex}.json')
+        data = json.dumps(self.snapshot())
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as file:
+            file.write(data)
+        os.replace(temporary, self.path)
+
+    def start_flushing(self):
+        '''Starts the thread writing the metrics of this process every
+        flush_seconds, called after every request so that forked workers
+        start their own
+        '''
+
+        if not self.directory or self.flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='metrics-flush',
+                         daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.warning('Writing metrics failed', exc_info=True)
+
+    def collect(self):
+        '''Returns the snapshots of every worker, this one first'''
+
+        current = self.snapshot()
+        snapshots = [current]
+        if not self.directory:
+            return snapshots
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == self.path:
+                continue
+            try:
+                with open(path) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                # removed or being replaced
+                continue
+        return snapshots
+
+    def render(self):
+        '''Returns the metrics of all workers in the Prometheus text
+        format
+        '''
+
+        merged = {}
+        for snapshot in self.collect():
+            alive = snapshot['pid'] == os.getpid() or \
+                _is_alive(snapshot['pid'])
+            for name, metric in snapshot['metrics'].items():
+                if metric['kind'] == 'gauge' and not alive:
+                    continue
+                target = merged.setdefault(name, dict(metric, values={}))
+                for labels, value in metric['samples']:
+                    key = tuple(labels)
+                    current = target['values'].get(key)
+                    if metric['kind'] != 'histogram':
+                        target['values'][key] = (current or 0) + value
+                    elif current is None:
+                        target['values'][key] = [list(value[0]), value[1]]
+                    else:
+                        for index, count in enumerate(value[0]):
+                            current[0][index] += count
+                        current[1] += value[1]
+
+        lines = []
+        for name, metric in merged.items():
+            kind = metric['kind']
+            full_name = name + '_total' if kind == 'counter' else name
+            lines.append(f'# HELP {full_name} {metric["help"]}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for labels, value in sorted(metric['values'].items()):
+                if kind != 'histogram':
+                    lines.append(f'{full_name}'
+                                 f'{_label_text(metric["labels"], labels)} '
+                                 f'{_number(value)}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for le, count in zip(metric['buckets'], counts):
+                    cumulative += count
+                    label_text = _label_text(metric['labels'], labels,
+                                             [('le', le)])
+                    lines.append(f'{name}_bucket{label_text} {cumulative}')
+                label_text = _label_text(metric['labels'], labels)
+                lines.append(f'{name}_sum{label_text} {total}')
+                lines.append(f'{name}_count{label_text} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+http_requests = registry.counter(
+    'http_requests', 'Requests served by route, method and status',
+    ['route', 'method', 'status'])
+request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route and method',
+    ['route', 'method'])
+auth_errors = registry.counter(
+    'auth_errors', 'Rejected tokens and permissions by AuthError code',
+    ['code'])
+error_handler_hits = registry.counter(
+    'error_handler_hits', 'Responses of the error handlers by status',
+    ['status'])
+rate_limited = registry.counter(
+    'rate_limited', 'Requests refused by the rate limiter by permission',
+    ['permission'])
+jwks_fetch_seconds = registry.histogram(
+    'jwks_fetch_duration_seconds', 'Signing key set fetches by outcome',
+    ['outcome'])
+jobs_finished = registry.counter(
+    'jobs_finished', 'Asynchronous write jobs run by kind and status',
+    ['kind', 'status'])
+job_seconds = registry.histogram(
+    'job_duration_seconds', 'Time taken by asynchronous write jobs',
+    ['kind'], buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, float('inf')))
+
+db_pool_connections = registry.gauge(
+    'db_pool_connections', 'Connections of the pools by state',
+    ['pool', 'state'])
+db_pool_timeouts = registry.counter(
+    'db_pool_timeouts', 'Requests that got no connection in time',
+    ['pool'])
+db_pool_wait_seconds = registry.histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a connection',
+    ['pool'], buckets=WAIT_BUCKETS)
+
+
+def record_pool(name, status):
+    '''Sets the pool metrics from the pool.pool_status of one pool'''
+
+    for state in ('size', 'checked_in', 'checked_out', 'overflow'):
+        if state in status:
+            db_pool_connections.set(status[state], name, state)
+    if 'wait_seconds' in status:
+        db_pool_timeouts.set(status['timeouts'], name)
+        histogram = status['wait_seconds']
+        counts = []
+        previous = 0
+        for le, cumulative in histogram['buckets']:
+            counts.append(cumulative - previous)
+            previous = cumulative
+        db_pool_wait_seconds.set([counts, histogram['sum']], name)
+
+
+@contextmanager
+def measure(histogram, *labels):
+    '''Observes the duration of the with block, labelled with labels and
+    'success' or 'failure'
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        histogram.observe(time.perf_counter() - start, *labels, 'failure')
+        raise
+    histogram.observe(time.perf_counter() - start, *labels, 'success')
+
+
+def record_request(route, method, status, seconds):
+    '''Counts a request and its latency, route is the url rule'''
+
+    http_requests.inc(route, method, str(status))
+    request_seconds.observe(seconds, route, method)
+    registry.start_flushing()
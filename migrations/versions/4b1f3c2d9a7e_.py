@@ -0,0 +1,62 @@
+"""indexes for movie_actor, titles, names and release dates
+
+Revision ID: 4b1f3c2d9a7e
+Revises: 170577ec2841
+Create Date: 2026-10-18 10:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1f3c2d9a7e'
+down_revision = '170577ec2841'
+branch_labels = None
+depends_on = None
+
+# Names PostgreSQL gives to the unnamed constraints of 170577ec2841,
+# SQLite gets the same names through the batch naming convention
+FOREIGN_KEYS = {
+    'movie_id': ('movie_actor_movie_id_fkey', 'movies'),
+    'actor_id': ('movie_actor_actor_id_fkey', 'actors'),
+}
+NAMING_CONVENTION = {
+    'fk': 'movie_actor_%(column_0_name)s_fkey',
+}
+
+
+def replace_foreign_keys(ondelete):
+    with op.batch_alter_table(
+            'movie_actor',
+            naming_convention=NAMING_CONVENTION) as batch_op:
+        for column, (name, table) in FOREIGN_KEYS.items():
+            batch_op.drop_constraint(name, type_='foreignkey')
+            batch_op.create_foreign_key(name, table, [column], ['id'],
+                                        ondelete=ondelete)
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+    op.create_index('ix_movie_actor_actor_id', 'movie_actor',
+                    ['actor_id', 'movie_id'])
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+    if op.get_bind().dialect.name == 'postgresql':
+        # text_pattern_ops lets "lower(title) LIKE 'abc%'" use the index
+        op.execute('CREATE INDEX ix_movies_title_lower '
+                   'ON movies (lower(title) text_pattern_ops)')
+        op.execute('CREATE INDEX ix_actors_name_lower '
+                   'ON actors (lower(name) text_pattern_ops)')
+    else:
+        op.create_index('ix_movies_title_lower', 'movies',
+                        [sa.text('lower(title)')])
+        op.create_index('ix_actors_name_lower', 'actors',
+                        [sa.text('lower(name)')])
+
+
+def downgrade():
+    op.drop_index('ix_actors_name_lower', table_name='actors')
+    op.drop_index('ix_movies_title_lower', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_movie_actor_actor_id', table_name='movie_actor')
+    replace_foreign_keys(None)
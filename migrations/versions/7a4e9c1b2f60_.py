@@ -0,0 +1,58 @@
+"""updated_at columns and table versions for conditional requests
+
+Revision ID: 7a4e9c1b2f60
+Revises: c3d58f0e6b21
+Create Date: 2026-10-18 12:36:15.402873
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4e9c1b2f60'
+down_revision = 'c3d58f0e6b21'
+branch_labels = None
+depends_on = None
+
+# same as models.VERSIONED_TABLES
+VERSIONED_TABLES = ('movies', 'actors', 'links')
+
+
+def upgrade():
+    for table in ('movies', 'actors'):
+        if op.get_bind().dialect.name == 'sqlite':
+            # SQLite adds columns to tables holding rows with a constant
+            # default only, and rebuilding the table with batch mode
+            # would drop the full-text triggers and, with foreign keys
+            # on, the links of every movie
+            op.add_column(table, sa.Column(
+                'updated_at', sa.DateTime(), nullable=False,
+                server_default='1970-01-01 00:00:00.000000'))
+            op.execute(f'UPDATE {table} SET updated_at = '
+                       f"strftime('%Y-%m-%d %H:%M:%f000', 'now')")
+        else:
+            op.add_column(table, sa.Column('updated_at', sa.DateTime(),
+                                           nullable=False,
+                                           server_default=sa.func.now()))
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('name', sa.String(length=40), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 0, 'updated_at': now}
+        for name in VERSIONED_TABLES])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    # a batch rebuild would lose the full-text triggers on SQLite,
+    # which supports DROP COLUMN since 3.35
+    for table in ('actors', 'movies'):
+        op.drop_column(table, 'updated_at')
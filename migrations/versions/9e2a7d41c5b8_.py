@@ -0,0 +1,25 @@
+"""indexes for actor search by age and gender
+
+Revision ID: 9e2a7d41c5b8
+Revises: 4b1f3c2d9a7e
+Create Date: 2026-10-18 11:02:47.881135
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9e2a7d41c5b8'
+down_revision = '4b1f3c2d9a7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_actors_age', 'actors', ['age'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
@@ -0,0 +1,33 @@
+"""link_changes, movie_actor changes read by the co-star graph
+
+Revision ID: b8d3e6f24a17
+Revises: e5f1a7c3d920
+Create Date: 2026-10-18 18:41:09.530276
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d3e6f24a17'
+down_revision = 'e5f1a7c3d920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'link_changes',
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.Column('added', sa.Boolean(), nullable=False)
+    )
+    op.create_index(op.f('ix_link_changes_version'), 'link_changes',
+                    ['version'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_link_changes_version'), table_name='link_changes')
+    op.drop_table('link_changes')
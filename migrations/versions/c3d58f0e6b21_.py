@@ -0,0 +1,62 @@
+"""full-text search on movie titles and actor names
+
+Revision ID: c3d58f0e6b21
+Revises: 9e2a7d41c5b8
+Create Date: 2026-10-18 11:48:09.530742
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d58f0e6b21'
+down_revision = '9e2a7d41c5b8'
+branch_labels = None
+depends_on = None
+
+# table -> searched column, same as models.full_text_index
+SEARCHED = {'movies': 'title', 'actors': 'name'}
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for name, column in SEARCHED.items():
+        if dialect == 'postgresql':
+            # generated columns need PostgreSQL 12 or newer
+            op.execute(
+                f"ALTER TABLE {name} ADD COLUMN search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('simple', {column})) "
+                f"STORED")
+            op.execute(f"CREATE INDEX ix_{name}_search_vector ON {name} "
+                       f"USING GIN (search_vector)")
+        elif dialect == 'sqlite':
+            op.execute(f"CREATE VIRTUAL TABLE {name}_fts USING fts5("
+                       f"{column}, content='{name}', content_rowid='id')")
+            op.execute(f"CREATE TRIGGER {name}_fts_insert AFTER INSERT "
+                       f"ON {name} BEGIN "
+                       f"INSERT INTO {name}_fts(rowid, {column}) "
+                       f"VALUES (new.id, new.{column}); END")
+            op.execute(f"CREATE TRIGGER {name}_fts_delete AFTER DELETE "
+                       f"ON {name} BEGIN "
+                       f"INSERT INTO {name}_fts({name}_fts, rowid, {column}) "
+                       f"VALUES ('delete', old.id, old.{column}); END")
+            op.execute(f"CREATE TRIGGER {name}_fts_update AFTER UPDATE OF "
+                       f"{column} ON {name} BEGIN "
+                       f"INSERT INTO {name}_fts({name}_fts, rowid, {column}) "
+                       f"VALUES ('delete', old.id, old.{column}); "
+                       f"INSERT INTO {name}_fts(rowid, {column}) "
+                       f"VALUES (new.id, new.{column}); END")
+            op.execute(f"INSERT INTO {name}_fts({name}_fts) "
+                       f"VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for name in SEARCHED:
+        if dialect == 'postgresql':
+            op.drop_index(f'ix_{name}_search_vector', table_name=name)
+            op.drop_column(name, 'search_vector')
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER {name}_fts_{trigger}')
+            op.execute(f'DROP TABLE {name}_fts')
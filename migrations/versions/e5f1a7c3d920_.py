@@ -0,0 +1,38 @@
+"""actor_count of movies and movie_count of actors
+
+Revision ID: e5f1a7c3d920
+Revises: 7a4e9c1b2f60
+Create Date: 2026-10-18 16:02:37.184511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5f1a7c3d920'
+down_revision = '7a4e9c1b2f60'
+branch_labels = None
+depends_on = None
+
+# table -> (counter column, column of movie_actor pointing to the table),
+# same as models.Movie.count_column and models.Actor.count_column
+COUNTERS = {'movies': ('actor_count', 'movie_id'),
+            'actors': ('movie_count', 'actor_id')}
+
+
+def upgrade():
+    for table, (column, key) in COUNTERS.items():
+        op.add_column(table, sa.Column(column, sa.Integer(), nullable=False,
+                                       server_default='0'))
+        op.create_index(f'ix_{table}_{column}', table, [column])
+        op.execute(f'UPDATE {table} SET {column} = (SELECT count(*) '
+                   f'FROM movie_actor WHERE movie_actor.{key} = {table}.id)')
+
+
+def downgrade():
+    # a batch rebuild would lose the full-text triggers on SQLite,
+    # which supports DROP COLUMN since 3.35
+    for table, (column, _) in COUNTERS.items():
+        op.drop_index(f'ix_{table}_{column}', table_name=table)
+        op.drop_column(table, column)
@@ -1,29 +1,676 @@
+import itertools
 import os
 import dateutil.parser
 
-from sqlalchemy import Column, Integer, String, DateTime
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    DDL,
+    Integer,
+    String,
+    event,
+    func
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
+from flask_sqlalchemy import SignallingSession
+
+from cache import response_cache
+from pool import engine_options
+from replicas import (
+    current_client,
+    replica_set,
+    RoutingSQLAlchemy,
+    DATABASE_REPLICA_URLS
+)
+from serializer import format_date
 
 database_path = os.getenv('DATABASE_URL')
+# Rows written per executemany round trip by bulk_write
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+# Versions of movie_actor whose changes are kept in link_changes, workers
+# further behind rebuild their co-star graph from movie_actor
+LINK_CHANGES_KEPT = int(os.getenv('LINK_CHANGES_KEPT', 10000))
 
-db = SQLAlchemy()
+GENDERS = ['male', 'female', 'other']
 
+db = RoutingSQLAlchemy()
 
-def setup_db(app, database_path=database_path):
-    '''Binds a flask application and a SQLAlchemy service.'''
+
+def setup_db(app, database_path=database_path,
+             replica_paths=DATABASE_REPLICA_URLS):
+    '''Binds a flask application and a SQLAlchemy service.
+
+    Views decorated with replicas.read_replica read from replica_paths.
+    '''
 
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    replica_set.configure(replica_paths)
 
 
-# Many-to-many relationship between movies and actors
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''SQLite ignores ON DELETE CASCADE unless foreign keys are enabled'''
+
+    if type(dbapi_connection).__module__ == 'sqlite3':
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+# Many-to-many relationship between movies and actors.
+# Links are removed by the database when a movie or actor is deleted,
+# the primary key serves lookups by movie and ix_movie_actor_actor_id
+# lookups by actor.
 movie_actor = db.Table(
     'movie_actor',
-    Column('movie_id', Integer, db.ForeignKey('movies.id'), primary_key=True),
-    Column('actor_id', Integer, db.ForeignKey('actors.id'), primary_key=True)
+    Column('movie_id', Integer,
+           db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_movie_actor_actor_id', 'actor_id', 'movie_id')
+)
+
+
+# Version of each table, bumped in the transaction of every write so that
+# conditional requests can be answered without querying the table itself.
+# 'links' stands for movie_actor.
+table_versions = db.Table(
+    'table_versions',
+    Column('name', String(40), primary_key=True),
+    Column('version', Integer, nullable=False),
+    Column('updated_at', DateTime, nullable=False)
 )
+VERSIONED_TABLES = ('movies', 'actors', 'links')
+
+
+# Links added and removed by each version of movie_actor (the 'links'
+# row of table_versions), so that in-memory copies of movie_actor catch
+# up without reading it again, see graph.CastGraph. Writers of links
+# wait for each other on the version row, so versions are committed in
+# order.
+link_changes = db.Table(
+    'link_changes',
+    Column('version', Integer, nullable=False, index=True),
+    Column('movie_id', Integer, nullable=False),
+    Column('actor_id', Integer, nullable=False),
+    Column('added', Boolean, nullable=False)
+)
+
+
+@event.listens_for(table_versions, 'after_create')
+def create_versions(target, connection, **kwargs):
+    now = datetime.utcnow()
+    connection.execute(table_versions.insert(), [
+        {'name': name, 'version': 0, 'updated_at': now}
+        for name in VERSIONED_TABLES])
+
+
+def versions_select(names):
+    return db.select([table_versions.c.name, table_versions.c.version,
+                      table_versions.c.updated_at]) \
+        .where(table_versions.c.name.in_(list(names)))
+
+
+def versions_from_rows(names, rows):
+    '''Orders the rows of versions_select like names, tables without a
+    version row get (0, None)
+    '''
+
+    versions = {name: (version, updated_at)
+                for name, version, updated_at in rows}
+    return [versions.get(name, (0, None)) for name in names]
+
+
+def get_versions(names):
+    '''Returns the (version, updated_at) pairs of the given tables
+
+    Tables without a version row get (0, None)
+    '''
+
+    rows = db.session.execute(versions_select(names)).fetchall()
+    return versions_from_rows(names, rows)
+
+
+def linked_ids(key, ids):
+    '''Loads movie_actor links for a batch of movies or actors
+
+    Parameters
+    ----------
+    key: 'movie_id' to get actors of movies or 'actor_id' to get movies
+         of actors
+    ids: ids of movies or actors
+
+    Returns dict mapping each id to the sorted list of linked ids
+    '''
+
+    other = 'actor_id' if key == 'movie_id' else 'movie_id'
+    links = {id: [] for id in ids}
+    if not links:
+        return links
+    column = movie_actor.c[key]
+    rows = db.session.query(column, movie_actor.c[other]) \
+        .filter(column.in_(list(links))) \
+        .order_by(column, movie_actor.c[other])
+    for id, linked_id in rows:
+        links[id].append(linked_id)
+    return links
+
+
+def linked_select(key, ids, linked_model):
+    '''Select of the movies or actors linked to a batch, see linked_rows'''
+
+    other = 'actor_id' if key == 'movie_id' else 'movie_id'
+    column = movie_actor.c[key]
+    return db.select([column, *linked_model.row_columns]) \
+        .select_from(movie_actor.join(
+            linked_model.__table__,
+            linked_model.id == movie_actor.c[other])) \
+        .where(column.in_(list(ids))) \
+        .order_by(column, linked_model.id)
+
+
+def group_linked(ids, rows, linked_model):
+    '''Groups the rows of linked_select by id as records'''
+
+    links = {id: [] for id in ids}
+    record = linked_model.record
+    for link_id, *values in rows:
+        links[link_id].append(record(*values))
+    return links
+
+
+def linked_rows(key, ids, linked_model):
+    '''Loads the movies or actors linked to a batch as records
+
+    Parameters
+    ----------
+    key: 'movie_id' to get actors of movies or 'actor_id' to get movies
+         of actors
+    ids: ids of movies or actors
+    linked_model: Actor or Movie, its row_columns are read
+
+    Returns dict mapping each id to the list of linked records ordered
+    by id, see ReadQuery
+    '''
+
+    if not ids:
+        return {}
+    rows = db.session.execute(
+        linked_select(key, ids, linked_model)).fetchall()
+    return group_linked(ids, rows, linked_model)
+
+
+def existing_ids(model, ids):
+    '''Returns the subset of ids present in the model's table
+
+    Uses one IN query per BULK_CHUNK_SIZE ids
+    '''
+
+    ids = list(ids)
+    existing = set()
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        chunk = ids[start:start + BULK_CHUNK_SIZE]
+        existing.update(id for id, in db.session.query(model.id)
+                        .filter(model.id.in_(chunk)))
+    return existing
+
+
+def clean_ids(ids, field):
+    if not isinstance(ids, (list, tuple)) or not all(
+            isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        raise ValueError(f'{field} must be a list of integers')
+    return set(ids)
+
+
+def invalidate_on_commit(*tags):
+    '''Invalidates cached responses with these tags once the current
+    transaction commits, see cache.ResponseCache
+    '''
+
+    db.session.info.setdefault('cache_tags', set()).update(tags)
+
+
+@event.listens_for(SignallingSession, 'before_commit')
+def bump_versions(session):
+    '''Bumps the versions of the tables written in this transaction
+
+    Table tags collected by invalidate_on_commit ('movies', 'actors',
+    'links') name the tables, the update commits with the write itself.
+    '''
+
+    names = sorted(tag for tag in session.info.get('cache_tags', ())
+                   if tag in VERSIONED_TABLES)
+    if not names:
+        return
+    session.execute(
+        table_versions.update()
+        .where(table_versions.c.name.in_(names))
+        .values(version=table_versions.c.version + 1,
+                updated_at=datetime.utcnow()))
+    changes = session.info.pop('link_changes', None)
+    if changes:
+        version = db.select([table_versions.c.version]) \
+            .where(table_versions.c.name == 'links').as_scalar()
+        session.execute(link_changes.insert().values(version=version),
+                        changes)
+        session.execute(link_changes.delete().where(
+            link_changes.c.version <= version - LINK_CHANGES_KEPT))
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def invalidate_committed(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags:
+        response_cache.invalidate(*tags)
+        # the client reads its own writes from the primary for a while
+        replica_set.wrote(current_client())
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_rolled_back(session):
+    session.info.pop('cache_tags', None)
+    session.info.pop('link_changes', None)
+
+
+def log_link_changes(key, id, new, removed):
+    '''Adds links of one movie or actor to link_changes when the current
+    transaction commits
+    '''
+
+    other = 'actor_id' if key == 'movie_id' else 'movie_id'
+    changes = db.session.info.setdefault('link_changes', [])
+    changes.extend({key: id, other: linked_id, 'added': True}
+                   for linked_id in new)
+    changes.extend({key: id, other: linked_id, 'added': False}
+                   for linked_id in removed)
+
+
+def detail_tags(key, ids, links=None):
+    '''Tags of the detail responses showing the given movies or actors
+
+    The detail of a movie lists its actors and the detail of an actor
+    lists its movies, so linked records are included. links are the
+    linked_ids of ids, read if not given.
+    '''
+
+    own, other = ('movie', 'actor') if key == 'movie_id' \
+        else ('actor', 'movie')
+    tags = {f'{own}:{id}' for id in ids}
+    if links is None:
+        links = linked_ids(key, ids)
+    for linked in links.values():
+        tags.update(f'{other}:{linked_id}' for linked_id in linked)
+    return tags
+
+
+def diff_links(key, id, linked_model, ids=None, add=(), remove=()):
+    '''Returns the sorted lists of ids to link and to unlink, see
+    update_links
+
+    Raises ValueError if ids are malformed or some linked ids do not exist
+    '''
+
+    add = clean_ids(add, 'add')
+    remove = clean_ids(remove, 'remove')
+    current = set(linked_ids(key, [id])[id])
+    target = current if ids is None else clean_ids(ids, 'ids')
+    target = (target | add) - remove
+
+    new = target - current
+    missing = new - existing_ids(linked_model, new)
+    if missing:
+        raise ValueError(f'{linked_model.__name__} not found: '
+                         f'{sorted(missing)}')
+    return sorted(new), sorted(current - target)
+
+
+def add_to_counts(model, ids, amount):
+    '''Adds amount to the link counters (actor_count or movie_count) of
+    movies or actors in the current transaction
+
+    Parameters
+    ----------
+    model: Movie or Actor
+    ids: ids of the movies or actors, a list or a select
+    amount: number of links added, negative for removed links
+    '''
+
+    if not amount or isinstance(ids, (list, set)) and not ids:
+        return
+    table = model.__table__
+    count = table.c[model.count_column]
+    db.session.execute(
+        table.update()
+        .where(table.c.id.in_(list(ids) if isinstance(ids, set) else ids))
+        # links are not part of the record, updated_at is kept
+        .values({count: count + amount,
+                 table.c.updated_at: table.c.updated_at}))
+
+
+def recount_links(fix=True, chunk_size=BULK_CHUNK_SIZE):
+    '''Compares actor_count and movie_count with movie_actor
+
+    Records are checked chunk_size ids per transaction, so concurrent
+    writes only wait for one chunk.
+
+    Parameters
+    ----------
+    fix: if True wrong counters are set to the number of links
+
+    Returns dict of the number of wrong counters by table name
+    '''
+
+    wrong = {}
+    for model in (Movie, Actor):
+        table = model.__table__
+        count = table.c[model.count_column]
+        links = db.select([func.count()]) \
+            .where(movie_actor.c[model.link_key] == table.c.id) \
+            .as_scalar()
+        last = db.session.query(func.max(table.c.id)).scalar() or 0
+        wrong[table.name] = 0
+        for start in range(1, last + 1, chunk_size):
+            condition = table.c.id.between(start, start + chunk_size - 1) \
+                & (count != links)
+            if fix:
+                result = db.session.execute(
+                    table.update().where(condition)
+                    .values({count: links,
+                             table.c.updated_at: table.c.updated_at}))
+                wrong[table.name] += result.rowcount
+                if result.rowcount:
+                    invalidate_on_commit(table.name)
+                db.session.commit()
+            else:
+                wrong[table.name] += db.session.query(func.count()) \
+                    .select_from(table).filter(condition).scalar()
+    return wrong
+
+
+def forget_links(key, id, linked):
+    '''Updates the counters and link_changes for the links of a movie or
+    actor about to be deleted, the database removes the links themselves
+
+    Parameters
+    ----------
+    key: 'movie_id' for a movie or 'actor_id' for an actor
+    id: id of the movie or actor
+    linked: ids of its actors or movies
+    '''
+
+    linked_model = Actor if key == 'movie_id' else Movie
+    add_to_counts(linked_model, linked, -1)
+    log_link_changes(key, id, [], linked)
+
+
+def write_links(key, id, new, removed):
+    '''Inserts and deletes movie_actor links of one movie or actor in the
+    current transaction, see diff_links
+    '''
+
+    other = 'actor_id' if key == 'movie_id' else 'movie_id'
+    if removed:
+        db.session.execute(movie_actor.delete().where(
+            (movie_actor.c[key] == id) &
+            movie_actor.c[other].in_(list(removed))))
+    if new:
+        db.session.execute(movie_actor.insert(), [
+            {key: id, other: linked_id} for linked_id in new])
+    if new or removed:
+        own_model, linked_model = (Movie, Actor) if key == 'movie_id' \
+            else (Actor, Movie)
+        add_to_counts(own_model, [id], len(new) - len(removed))
+        add_to_counts(linked_model, new, 1)
+        add_to_counts(linked_model, removed, -1)
+        log_link_changes(key, id, new, removed)
+        own, linked = ('movie', 'actor') if key == 'movie_id' \
+            else ('actor', 'movie')
+        invalidate_on_commit(
+            'links', f'{own}:{id}',
+            *(f'{linked}:{linked_id}' for linked_id in
+              itertools.chain(new, removed)))
+
+
+def update_links(key, id, linked_model, ids=None, add=(), remove=()):
+    '''Changes movie_actor links of one movie or actor
+
+    Only the difference between current and requested links is written:
+    one DELETE for removed links and one executemany INSERT for new ones.
+    Changes are flushed in the current transaction and committed by the
+    caller.
+
+    Parameters
+    ----------
+    key: 'movie_id' to change actors of a movie or 'actor_id' to change
+         movies of an actor
+    id: id of the movie or actor
+    linked_model: Actor or Movie, the model of linked ids
+    ids: the complete list of linked ids, optional
+    add: ids to link, optional
+    remove: ids to unlink, optional
+
+    Raises ValueError if ids are malformed or some linked ids do not exist
+    '''
+
+    new, removed = diff_links(key, id, linked_model, ids, add, remove)
+    write_links(key, id, new, removed)
+
+
+def update_links_in_chunks(key, id, linked_model, ids=None, add=(),
+                           remove=(), chunk_size=BULK_CHUNK_SIZE,
+                           progress=None):
+    '''Same as update_links, committing chunk_size changed links per
+    transaction
+
+    Linked ids are checked before the first chunk. A failing chunk is
+    rolled back and raised, the chunks before it stay committed.
+
+    Parameters
+    ----------
+    chunk_size: links inserted or deleted per transaction
+    progress: called with the number of links written and their total
+              after every chunk, optional
+
+    Returns the number of links written
+    '''
+
+    new, removed = diff_links(key, id, linked_model, ids, add, remove)
+    total = len(new) + len(removed)
+    chunks = [([], removed[start:start + chunk_size])
+              for start in range(0, len(removed), chunk_size)]
+    chunks += [(new[start:start + chunk_size], [])
+               for start in range(0, len(new), chunk_size)]
+    done = 0
+    if progress is not None:
+        progress(done, total)
+    for new_chunk, removed_chunk in chunks:
+        try:
+            write_links(key, id, new_chunk, removed_chunk)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        done += len(new_chunk) + len(removed_chunk)
+        if progress is not None:
+            progress(done, total)
+    return total
+
+
+def clean_name(data, field):
+    value = data.get(field)
+    if not isinstance(value, str) or not value.strip() or len(value) > 80:
+        raise ValueError(f'{field} must be a non-empty string '
+                         'of at most 80 characters')
+    return value
+
+
+def clean_id(data):
+    value = data.get('id')
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError('id must be an integer')
+    return value
+
+
+def validate_bulk(model, items):
+    '''Validates rows of a bulk request before anything is written
+
+    Items with an 'id' are updates and only need the given fields,
+    the others are inserts and need every field. Ids of updates are
+    checked to exist with one IN query per chunk.
+
+    Parameters
+    ----------
+    model: Movie or Actor
+    items: list of dicts sent by the client
+
+    Returns
+    -------
+    rows: list of (index, column values) pairs of valid items
+    errors: list of {'index', 'message'} dicts of invalid items
+    '''
+
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('row must be an object')
+            rows.append((index, model.clean(item, partial='id' in item)))
+        except ValueError as e:
+            errors.append({'index': index, 'message': str(e)})
+
+    existing = existing_ids(
+        model, [values['id'] for _, values in rows if 'id' in values])
+    valid = []
+    for index, values in rows:
+        if 'id' in values and values['id'] not in existing:
+            errors.append({'index': index,
+                           'message': f'{model.__name__} not found'})
+        else:
+            valid.append((index, values))
+    errors.sort(key=lambda error: error['index'])
+    return valid, errors
+
+
+def _write_chunk(model, rows):
+    inserts = [values for _, values in rows if 'id' not in values]
+    updates = [values for _, values in rows if 'id' in values]
+    if inserts:
+        db.session.bulk_insert_mappings(model, inserts)
+    if updates:
+        db.session.bulk_update_mappings(model, updates)
+        invalidate_on_commit(*detail_tags(
+            model.link_key, [values['id'] for values in updates]))
+    invalidate_on_commit(model.__tablename__)
+    return len(inserts), len(updates)
+
+
+def _commit_chunk(model, rows):
+    # rows of a failing chunk are retried one by one
+    try:
+        inserted, changed = _write_chunk(model, rows)
+        db.session.commit()
+        return inserted, changed, []
+    except SQLAlchemyError:
+        db.session.rollback()
+    created = updated = 0
+    errors = []
+    for index, values in rows:
+        try:
+            inserted, changed = _write_chunk(model, [(index, values)])
+            db.session.commit()
+            created += inserted
+            updated += changed
+        except SQLAlchemyError:
+            db.session.rollback()
+            errors.append({'index': index, 'message': 'database error'})
+    return created, updated, errors
+
+
+def bulk_write(model, rows, atomic=True, chunk_size=BULK_CHUNK_SIZE,
+               progress=None):
+    '''Inserts and updates validated rows in chunks of executemany calls
+
+    Parameters
+    ----------
+    model: Movie or Actor
+    rows: list of (index, column values) pairs returned by validate_bulk
+    atomic: if True all rows are committed in a single transaction and
+            any database error rolls everything back and is raised,
+            otherwise every chunk is committed on its own and rows of a
+            failing chunk are retried one by one to isolate the bad ones
+    chunk_size: number of rows per executemany call
+    progress: called with the number of rows written and their total
+              after every chunk, optional
+
+    Returns
+    -------
+    created: number of inserted rows
+    updated: number of updated rows
+    errors: list of {'index', 'message'} dicts of rows that failed
+    '''
+
+    created = updated = 0
+    errors = []
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            if atomic:
+                inserted, changed = _write_chunk(model, chunk)
+                created += inserted
+                updated += changed
+            else:
+                inserted, changed, failed = _commit_chunk(model, chunk)
+                created += inserted
+                updated += changed
+                errors.extend(failed)
+            if progress is not None:
+                progress(start + len(chunk), len(rows))
+        if atomic:
+            db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return created, updated, errors
+
+
+class MovieRecord:
+    '''Read-only movie returned by ReadQuery, same columns as
+    Movie.row_columns
+    '''
+
+    __slots__ = ('id', 'title', 'release_date', 'updated_at', 'actor_count')
+
+    def __init__(self, id, title, release_date, updated_at, actor_count):
+        self.id = id
+        self.title = title
+        self.release_date = release_date
+        self.updated_at = updated_at
+        self.actor_count = actor_count
+
+
+class ActorRecord:
+    '''Read-only actor returned by ReadQuery, same columns as
+    Actor.row_columns
+    '''
+
+    __slots__ = ('id', 'name', 'age', 'gender', 'updated_at', 'movie_count')
+
+    def __init__(self, id, name, age, gender, updated_at, movie_count):
+        self.id = id
+        self.name = name
+        self.age = age
+        self.gender = gender
+        self.updated_at = updated_at
+        self.movie_count = movie_count
 
 
 class Movie(db.Model):
@@ -32,11 +679,26 @@ class Movie(db.Model):
     Has title and release date
     '''
     __tablename__ = 'movies'
+    # column of movie_actor pointing to this table
+    link_key = 'movie_id'
 
     id = Column(Integer, primary_key=True)
     title = Column(String(80), nullable=False)
-    release_date = Column(DateTime, nullable=False)
-    actors = db.relationship('Actor', secondary=movie_actor, backref='movies')
+    release_date = Column(DateTime, nullable=False, index=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow, server_default=func.now())
+    # number of links in movie_actor, kept by write_links and delete,
+    # repaired by recount_links
+    actor_count = Column(Integer, nullable=False, default=0,
+                         server_default='0', index=True)
+    count_column = 'actor_count'
+    # columns read by list endpoints, see format_row and ReadQuery
+    row_columns = (id, title, release_date, updated_at, actor_count)
+    record = MovieRecord
+    actors = db.relationship('Actor', secondary=movie_actor,
+                             passive_deletes=True,
+                             backref=db.backref('movies',
+                                                passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
@@ -44,21 +706,80 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        invalidate_on_commit(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        invalidate_on_commit(self.__tablename__,
+                             *detail_tags(self.link_key, [self.id]))
         db.session.commit()
 
     def delete(self):
+        # links are removed by the database, collect their tags and
+        # update the counters of linked records first
+        links = linked_ids(self.link_key, [self.id])
+        invalidate_on_commit(self.__tablename__, 'links',
+                             *detail_tags(self.link_key, [self.id], links))
+        forget_links(self.link_key, self.id, links[self.id])
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date.strftime('%A, %b %d %Y')
+    def set_actors(self, ids=None, add=(), remove=()):
+        '''Replaces (ids) or changes (add, remove) the movie's actors'''
+
+        update_links('movie_id', self.id, Actor, ids, add, remove)
+        db.session.expire(self, ['actors', 'actor_count'])
+
+    @staticmethod
+    def clean(data, partial=False):
+        '''Validates movie fields sent by a client
+
+        Parameters
+        ----------
+        data: dict with id, title and release_date
+        partial: if True only the given fields are validated
+
+        Returns dict of column values, raises ValueError if invalid
+        '''
+
+        values = {}
+        if 'id' in data:
+            values['id'] = clean_id(data)
+        if not partial or 'title' in data:
+            values['title'] = clean_name(data, 'title')
+        if not partial or 'release_date' in data:
+            try:
+                values['release_date'] = dateutil.parser.parse(
+                    data.get('release_date'))
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError('release_date must be a date')
+        return values
+
+    @staticmethod
+    def format_row(row, include=()):
+        '''Returns a movie read as row_columns, or the movie itself, as a
+        dict, include=('actor_count',) adds its number of actors
+        '''
+
+        movie = {
+            'id': row.id,
+            'title': row.title,
+            'release_date': format_date(row.release_date),
+            'updated_at': row.updated_at.isoformat()
         }
+        if 'actor_count' in include:
+            movie['actor_count'] = row.actor_count
+        return movie
+
+    def format(self, include=()):
+        '''Returns the movie as a dict, include=('actors',) adds its actors
+        and include=('actor_count',) their number
+        '''
+
+        movie = Movie.format_row(self, include)
+        if 'actors' in include:
+            movie['actors'] = [actor.format() for actor in self.actors]
+        return movie
 
 
 class Actor(db.Model):
@@ -67,32 +788,243 @@ class Actor(db.Model):
     Has name, age and gender
     '''
     __tablename__ = 'actors'
+    # column of movie_actor pointing to this table
+    link_key = 'actor_id'
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
-    age = Column(Integer, nullable=False)
+    age = Column(Integer, nullable=False, index=True)
     gender = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        onupdate=datetime.utcnow, server_default=func.now())
+    # number of links in movie_actor, see Movie.actor_count
+    movie_count = Column(Integer, nullable=False, default=0,
+                         server_default='0', index=True)
+    count_column = 'movie_count'
+    # columns read by list endpoints, see format_row and ReadQuery
+    row_columns = (id, name, age, gender, updated_at, movie_count)
+    record = ActorRecord
 
     def __init__(self, name, age, gender):
-        self.name = name,
-        self.age = age,
+        self.name = name
+        self.age = age
         self.gender = gender
 
     def insert(self):
         db.session.add(self)
+        invalidate_on_commit(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        invalidate_on_commit(self.__tablename__,
+                             *detail_tags(self.link_key, [self.id]))
         db.session.commit()
 
     def delete(self):
+        # links are removed by the database, collect their tags and
+        # update the counters of linked records first
+        links = linked_ids(self.link_key, [self.id])
+        invalidate_on_commit(self.__tablename__, 'links',
+                             *detail_tags(self.link_key, [self.id], links))
+        forget_links(self.link_key, self.id, links[self.id])
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender
+    def set_movies(self, ids=None, add=(), remove=()):
+        '''Replaces (ids) or changes (add, remove) the actor's movies'''
+
+        update_links('actor_id', self.id, Movie, ids, add, remove)
+        db.session.expire(self, ['movies', 'movie_count'])
+
+    @staticmethod
+    def clean(data, partial=False):
+        '''Validates actor fields sent by a client
+
+        Parameters
+        ----------
+        data: dict with id, name, age and gender
+        partial: if True only the given fields are validated
+
+        Returns dict of column values, raises ValueError if invalid
+        '''
+
+        values = {}
+        if 'id' in data:
+            values['id'] = clean_id(data)
+        if not partial or 'name' in data:
+            values['name'] = clean_name(data, 'name')
+        if not partial or 'age' in data:
+            age = data.get('age')
+            if not isinstance(age, int) or isinstance(age, bool) or age < 0:
+                raise ValueError('age must be a non-negative integer')
+            values['age'] = age
+        if not partial or 'gender' in data:
+            gender = data.get('gender')
+            if not isinstance(gender, str) or gender.lower() not in GENDERS:
+                raise ValueError('gender must be male, female or other')
+            values['gender'] = gender.lower()
+        return values
+
+    @staticmethod
+    def format_row(row, include=()):
+        '''Returns an actor read as row_columns, or the actor itself, as a
+        dict, include=('movie_count',) adds its number of movies
+        '''
+
+        actor = {
+            'id': row.id,
+            'name': row.name,
+            'age': row.age,
+            'gender': row.gender,
+            'updated_at': row.updated_at.isoformat()
         }
+        if 'movie_count' in include:
+            actor['movie_count'] = row.movie_count
+        return actor
+
+    def format(self, include=()):
+        '''Returns the actor as a dict, include=('movies',) adds its movies
+        and include=('movie_count',) their number
+        '''
+
+        actor = Actor.format_row(self, include)
+        if 'movies' in include:
+            actor['movies'] = [movie.format() for movie in self.movies]
+        return actor
+
+
+class ReadQuery:
+    '''Read-only query of movies or actors built on a Core select
+
+    Implements the part of the ORM query interface used by paginate and
+    returns the model's record objects instead of ORM instances, so rows
+    skip identity map bookkeeping and attribute instrumentation. Writes
+    keep using the ORM.
+
+    Parameters
+    ----------
+    model: Movie or Actor, its row_columns are read
+    select: select to start from, optional
+    '''
+
+    def __init__(self, model, select=None):
+        self.model = model
+        if select is None:
+            select = db.select(list(model.row_columns))
+        self.select = select
+
+    def filter(self, *conditions):
+        select = self.select
+        for condition in conditions:
+            select = select.where(condition)
+        return ReadQuery(self.model, select)
+
+    def order_by(self, *columns):
+        return ReadQuery(self.model, self.select.order_by(*columns))
+
+    def limit(self, limit):
+        return ReadQuery(self.model, self.select.limit(limit))
+
+    def all(self):
+        record = self.model.record
+        # fetchall is much faster than iterating the result row by row
+        rows = db.session.execute(self.select).fetchall()
+        return [record(*row) for row in rows]
+
+
+def detail_select(model, id):
+    '''Select of a movie joined to its actors or an actor joined to its
+    movies, see read_detail
+    '''
+
+    linked_model = Actor if model is Movie else Movie
+    joined = model.__table__ \
+        .outerjoin(movie_actor, movie_actor.c[model.link_key] == model.id) \
+        .outerjoin(linked_model.__table__,
+                   linked_model.id == movie_actor.c[linked_model.link_key])
+    return db.select([*model.row_columns, *linked_model.row_columns]) \
+        .select_from(joined) \
+        .where(model.id == id) \
+        .order_by(linked_model.id) \
+        .apply_labels()
+
+
+def detail_records(model, rows):
+    '''Splits the rows of detail_select into records, see read_detail'''
+
+    linked_model = Actor if model is Movie else Movie
+    size = len(model.row_columns)
+    record = None
+    linked = []
+    for values in rows:
+        values = tuple(values)
+        if record is None:
+            record = model.record(*values[:size])
+        if values[size] is not None:
+            linked.append(linked_model.record(*values[size:]))
+    return record, linked
+
+
+def read_detail(model, id):
+    '''Reads a movie with its actors or an actor with its movies in one
+    query
+
+    Returns (record, list of linked records ordered by id), record is
+    None if there is no such movie or actor
+    '''
+
+    rows = db.session.execute(detail_select(model, id)).fetchall()
+    return detail_records(model, rows)
+
+
+# Case-insensitive lookups by title and name. On PostgreSQL the migration
+# creates them with text_pattern_ops so that prefix LIKE can use them.
+db.Index('ix_movies_title_lower', func.lower(Movie.title))
+db.Index('ix_actors_name_lower', func.lower(Actor.name))
+db.Index('ix_actors_gender_age', Actor.gender, Actor.age)
+
+
+def full_text_index(table, column):
+    '''Adds full-text search DDL to a table created with create_all
+
+    PostgreSQL gets a generated tsvector column 'search_vector' with a GIN
+    index. SQLite gets an FTS5 table '<table>_fts' kept in sync by
+    triggers. Both follow every write, including insert() and update().
+    '''
+
+    name = table.name
+    postgresql = [
+        f"ALTER TABLE {name} ADD COLUMN search_vector tsvector "
+        f"GENERATED ALWAYS AS (to_tsvector('simple', {column})) STORED",
+        f"CREATE INDEX ix_{name}_search_vector ON {name} "
+        f"USING GIN (search_vector)",
+    ]
+    sqlite = [
+        f"CREATE VIRTUAL TABLE {name}_fts USING fts5("
+        f"{column}, content='{name}', content_rowid='id')",
+        f"CREATE TRIGGER {name}_fts_insert AFTER INSERT ON {name} BEGIN "
+        f"INSERT INTO {name}_fts(rowid, {column}) "
+        f"VALUES (new.id, new.{column}); END",
+        f"CREATE TRIGGER {name}_fts_delete AFTER DELETE ON {name} BEGIN "
+        f"INSERT INTO {name}_fts({name}_fts, rowid, {column}) "
+        f"VALUES ('delete', old.id, old.{column}); END",
+        f"CREATE TRIGGER {name}_fts_update AFTER UPDATE OF {column} "
+        f"ON {name} BEGIN "
+        f"INSERT INTO {name}_fts({name}_fts, rowid, {column}) "
+        f"VALUES ('delete', old.id, old.{column}); "
+        f"INSERT INTO {name}_fts(rowid, {column}) "
+        f"VALUES (new.id, new.{column}); END",
+    ]
+    for statement in postgresql:
+        event.listen(table, 'after_create',
+                     DDL(statement).execute_if(dialect='postgresql'))
+    for statement in sqlite:
+        event.listen(table, 'after_create',
+                     DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(table, 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS {name}_fts')
+                 .execute_if(dialect='sqlite'))
+
+
+full_text_index(Movie.__table__, 'title')
+full_text_index(Actor.__table__, 'name')
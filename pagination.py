@@ -0,0 +1,167 @@
+import base64
+import json
+import os
+
+from datetime import datetime
+from sqlalchemy import DateTime
+
+# Number of rows returned when the client does not pass 'limit'
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 50))
+# Hard cap on 'limit', larger values are clamped to it
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 500))
+
+
+def encode_cursor(values):
+    '''Encodes the keyset values of the last row into an opaque cursor'''
+
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor):
+    '''Decodes a cursor created by encode_cursor
+
+    Raises ValueError if the cursor is malformed
+    '''
+
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+
+def page_args(args):
+    '''Parses 'limit' and 'after' query parameters
+
+    Parameters
+    ----------
+    args: request query arguments
+
+    Returns
+    -------
+    limit: page size, clamped to MAX_PAGE_SIZE
+    after: decoded cursor values or None for the first page
+
+    Raises ValueError if a parameter is invalid
+    '''
+
+    limit = args.get('limit', PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    after = args.get('after')
+    after = decode_cursor(after) if after else None
+    return limit, after
+
+
+def is_offset(value):
+    '''Whether value is a valid offset of a ranked page cursor, json
+    booleans are not
+    '''
+
+    return type(value) is int and value >= 0
+
+
+def _to_cursor(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _from_cursor(column, value):
+    if isinstance(column.type, DateTime):
+        if not isinstance(value, str):
+            raise ValueError('Invalid cursor')
+        return datetime.fromisoformat(value)
+    python_type = column.type.python_type
+    # json booleans are ints to isinstance
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        raise ValueError('Invalid cursor')
+    return value
+
+
+def page_query(query, key, limit, after=None, sort=None,
+               descending=False):
+    '''Seeks query past the cursor and orders and limits it to a page
+
+    Parameters are the ones of paginate.
+
+    Returns
+    -------
+    query: query fetching the page and one more row
+    columns: ordering columns, passed to page_items
+    '''
+
+    columns = [key] if sort is None or sort is key else [sort, key]
+    if after is not None:
+        if len(after) != len(columns):
+            raise ValueError('Invalid cursor')
+        values = [_from_cursor(column, value)
+                  for column, value in zip(columns, after)]
+        if descending:
+            seek = columns[-1] < values[-1]
+        else:
+            seek = columns[-1] > values[-1]
+        if len(columns) == 2:
+            # written so that an index on the sort column alone is usable
+            sort_column, sort_value = columns[0], values[0]
+            if descending:
+                seek = (sort_column <= sort_value) & \
+                    ((sort_column < sort_value) | seek)
+            else:
+                seek = (sort_column >= sort_value) & \
+                    ((sort_column > sort_value) | seek)
+        query = query.filter(seek)
+    order = [column.desc() if descending else column for column in columns]
+    return query.order_by(*order).limit(limit + 1), columns
+
+
+def page_items(items, columns, limit):
+    '''Cuts the rows fetched by a page_query to the page
+
+    Returns the rows of the page and the cursor of the next page
+    '''
+
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor([_to_cursor(getattr(last, column.key))
+                                     for column in columns])
+    return items, next_cursor
+
+
+def paginate(query, key, limit, after=None, sort=None, descending=False):
+    '''Returns one page of query results using keyset pagination
+
+    Rows are ordered by (sort, key) and only rows past the cursor are
+    fetched, so every page costs the same as the first one.
+
+    Parameters
+    ----------
+    query: query to paginate
+    key: unique column to order and seek by, usually the primary key
+    limit: page size
+    after: cursor values of the last row of the previous page
+    sort: column to order by before the key column, optional
+    descending: if True rows are returned in descending order
+
+    Returns
+    -------
+    items: list of rows in the page
+    next_cursor: cursor of the next page or None on the last page
+
+    Raises ValueError if the cursor does not match the ordering
+    '''
+
+    query, columns = page_query(query, key, limit, after, sort, descending)
+    return page_items(query.all(), columns, limit)
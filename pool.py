@@ -0,0 +1,172 @@
+import bisect
+import os
+import threading
+import time
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Connections kept open by each worker
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+# Connections opened on top of DB_POOL_SIZE under load, closed when idle
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+# Seconds after which a connection is replaced, -1 keeps them forever
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+# Test connections with a round trip before using them
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true') == 'true'
+# Milliseconds after which PostgreSQL cancels a statement, 0 disables it
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+# Connect through PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'false') == 'true'
+
+# Upper bounds in seconds of the wait time histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+
+
+class PoolMetrics:
+    '''PoolMetrics
+    Histogram of the time spent waiting for a connection
+    '''
+
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def histogram(self):
+        '''Returns cumulative counts per bucket, as in Prometheus'''
+
+        with self._lock:
+            cumulative = []
+            count = 0
+            for le, bucket_count in zip(self.buckets, self.counts):
+                count += bucket_count
+                cumulative.append(('+Inf' if le == float('inf') else le,
+                                   count))
+            return {'buckets': cumulative, 'count': count,
+                    'sum': self.total}
+
+
+class TimedQueuePool(QueuePool):
+    '''QueuePool recording how long every checkout waits'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _timed_checkout(self, checkout):
+        start = time.perf_counter()
+        try:
+            connection = checkout()
+        except TimeoutError:
+            self.metrics.timed_out()
+            raise
+        self.metrics.observe(time.perf_counter() - start)
+        return connection
+
+    def connect(self):
+        return self._timed_checkout(super().connect)
+
+    def unique_connection(self):
+        # used by Engine.connect
+        return self._timed_checkout(super().unique_connection)
+
+
+def pool_status(pool):
+    '''Returns the live state of an engine's connection pool as a dict'''
+
+    status = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        status['timeouts'] = metrics.timeouts
+        status['wait_seconds'] = metrics.histogram()
+    return status
+
+
+def engine_options(database_path):
+    '''Engine options for the database from the DB_* environment variables
+
+    SQLite keeps the pool chosen by Flask-SQLAlchemy. In PgBouncer mode
+    prepared statement caches are disabled, since a prepared statement
+    lives on a server connection the next transaction may not get, and
+    the statement timeout is left to the database role because PgBouncer
+    rejects startup options.
+    '''
+
+    if not database_path:
+        return {}
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        return {}
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+    }
+    connect_args = {}
+    if DB_PGBOUNCER:
+        driver = url.drivername.partition('+')[2]
+        if driver == 'asyncpg':
+            connect_args['statement_cache_size'] = 0
+        elif driver == 'psycopg':
+            connect_args['prepare_threshold'] = None
+        # psycopg2 never prepares statements
+    elif DB_STATEMENT_TIMEOUT and \
+            url.get_backend_name() in ('postgresql', 'postgres'):
+        connect_args['options'] = \
+            f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def async_database_options(database_path):
+    '''Url and options of the async database of asgi.py, from the same
+    DB_* environment variables
+
+    PostgreSQL urls are served by asyncpg, whose pool is sized like the
+    sync one at its largest, SQLite urls by aiosqlite.
+
+    Returns (url, options) to pass to databases.Database
+    '''
+
+    url = make_url(database_path)
+    if url.get_backend_name() == 'sqlite':
+        url.drivername = 'sqlite'
+        return str(url), {}
+    url.drivername = 'postgresql'
+    options = {
+        'min_size': DB_POOL_SIZE,
+        'max_size': DB_POOL_SIZE + DB_MAX_OVERFLOW,
+        'max_inactive_connection_lifetime': max(DB_POOL_RECYCLE, 0),
+    }
+    if DB_PGBOUNCER:
+        options['statement_cache_size'] = 0
+    elif DB_STATEMENT_TIMEOUT:
+        options['server_settings'] = {
+            'statement_timeout': str(DB_STATEMENT_TIMEOUT)}
+    return str(url), options
@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from cache import REDIS_URL
+from metrics import rate_limited
+
+# Requests allowed per client and permission, comma separated
+# 'permission=requests/seconds' pairs, e.g. 'get:movies=120/60,
+# post:movies=10/60'. '*' applies to permissions without a limit of
+# their own. Unset, requests are not limited.
+RATE_LIMITS = os.getenv('RATE_LIMITS', '')
+# 'memory' (default, per worker) or 'redis' (shared by all workers)
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memory')
+# Maximum number of buckets kept by the in-process store
+RATE_LIMIT_BUCKETS = int(os.getenv('RATE_LIMIT_BUCKETS', 10000))
+
+
+class RateLimited(Exception):
+    '''RateLimited Exception
+    Raised when a client used up the requests allowed for a permission
+
+    Parameters
+    ----------
+    retry_after: seconds until the next request is allowed
+    '''
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+
+def parse_limits(value):
+    '''Parses RATE_LIMITS into {permission: (requests, seconds)}
+
+    Raises ValueError for malformed pairs
+    '''
+
+    limits = {}
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+        permission, _, limit = pair.strip().partition('=')
+        requests, _, seconds = limit.partition('/')
+        requests, seconds = int(requests), float(seconds)
+        if requests < 1 or seconds <= 0:
+            raise ValueError(f'Invalid rate limit {pair!r}')
+        limits[permission] = (requests, seconds)
+    return limits
+
+
+class MemoryBuckets:
+    '''MemoryBuckets
+    In-process token buckets, the least recently used ones are dropped
+    beyond maxsize, which refills them
+    '''
+
+    def __init__(self, maxsize=RATE_LIMIT_BUCKETS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        '''Takes a token from the bucket of key
+
+        Returns 0 or the seconds until a token is available
+
+        Parameters
+        ----------
+        capacity: tokens of a full bucket, the allowed burst
+        rate: tokens added per second
+        '''
+
+        with self._lock:
+            now = self.clock()
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+class RedisBuckets:
+    '''RedisBuckets
+    Token buckets shared by all workers, takes any client with the
+    redis-py eval interface
+
+    A bucket is updated by one script, so concurrent workers never take
+    the same token, and expires once it would be full again.
+    '''
+
+    script = '''
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity,
+                          tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    '''
+
+    def __init__(self, client, prefix='capstone:bucket:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key, capacity, rate):
+        # the clock of the workers, shared by all hosts
+        return float(self.client.eval(self.script, 1, self.prefix + key,
+                                      capacity, rate, self.clock()))
+
+
+class RateLimiter:
+    '''RateLimiter
+    Limits the requests of every client, the 'sub' of its token, per
+    permission
+
+    Parameters
+    ----------
+    store: MemoryBuckets, RedisBuckets or None to disable limiting
+    limits: {permission: (requests, seconds)}, see parse_limits
+    '''
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def check(self, permission, payload):
+        '''Counts a request of the token's client using permission
+
+        Raises RateLimited if its bucket is empty
+        '''
+
+        limit = self.limits.get(permission, self.limits.get('*'))
+        if self.store is None or limit is None:
+            return
+        requests, seconds = limit
+        key = f'{payload.get("sub")}:{permission}'
+        wait = self.store.take(key, requests, requests / seconds)
+        if wait:
+            rate_limited.inc(permission)
+            raise RateLimited(wait)
+
+
+def store_from_env():
+    if RATE_LIMIT_STORE == 'redis':
+        import redis
+        return RedisBuckets(redis.Redis.from_url(REDIS_URL))
+    return MemoryBuckets()
+
+
+rate_limiter = RateLimiter(store_from_env(), parse_limits(RATE_LIMITS))
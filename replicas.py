@@ -0,0 +1,170 @@
+import itertools
+import logging
+import os
+import threading
+import time
+
+from functools import wraps
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import DBAPIError
+
+from pool import engine_options
+
+# Comma separated database urls of read replicas
+DATABASE_REPLICA_URLS = [
+    url for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url]
+# Seconds during which a client's reads go to the primary after it wrote
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+# Seconds a replica gets no traffic after a connection failure
+REPLICA_EJECT_SECONDS = float(os.getenv('REPLICA_EJECT_SECONDS', 30))
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet:
+    '''ReplicaSet
+    Chooses the replica serving a read-only request
+
+    Healthy replicas are used in turn. A client that wrote less than
+    sticky_seconds ago reads from the primary, so it sees its own
+    writes. A replica whose connection fails is ejected for
+    eject_seconds. Write times are kept per process, so stickiness
+    covers requests served by the same worker.
+
+    Parameters
+    ----------
+    sticky_seconds: read-your-writes window
+    eject_seconds: time a failed replica is left out
+    clock: function returning the current time in seconds
+    '''
+
+    def __init__(self, sticky_seconds=REPLICA_STICKY_SECONDS,
+                 eject_seconds=REPLICA_EJECT_SECONDS, clock=time.monotonic):
+        self.sticky_seconds = sticky_seconds
+        self.eject_seconds = eject_seconds
+        self.clock = clock
+        self.engines = []
+        self.ejected_until = {}
+        self.last_writes = {}
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+
+    def configure(self, urls):
+        '''Creates an engine for every replica url'''
+
+        for engine in self.engines:
+            engine.dispose()
+        self.engines = []
+        self.ejected_until = {}
+        self._turns = itertools.count()
+        for url in urls:
+            engine = create_engine(url, **engine_options(url))
+            event.listen(engine, 'handle_error', self._handle_error)
+            self.engines.append(engine)
+
+    def _handle_error(self, context):
+        # context.connection is None when connecting failed
+        if context.is_disconnect or context.connection is None:
+            self.eject(context.engine)
+
+    def eject(self, engine):
+        logger.warning('Ejecting replica %r for %s seconds', engine.url,
+                       self.eject_seconds)
+        with self._lock:
+            self.ejected_until[engine] = self.clock() + self.eject_seconds
+
+    def is_ejected(self, engine):
+        return self.ejected_until.get(engine, 0) > self.clock()
+
+    def wrote(self, client):
+        '''Records a write of the client, identified by its token subject'''
+
+        if not self.engines or client is None:
+            return
+        now = self.clock()
+        with self._lock:
+            self.last_writes[client] = now
+            if len(self.last_writes) > 1024:
+                self.last_writes = {
+                    client: written for client, written
+                    in self.last_writes.items()
+                    if now - written < self.sticky_seconds}
+
+    def is_sticky(self, client):
+        written = self.last_writes.get(client)
+        return written is not None and \
+            self.clock() - written < self.sticky_seconds
+
+    def choose(self, client=None):
+        '''Returns the replica engine for the client or None to read from
+        the primary
+        '''
+
+        if not self.engines or self.is_sticky(client):
+            return None
+        healthy = [engine for engine in self.engines
+                   if not self.is_ejected(engine)]
+        if not healthy:
+            return None
+        return healthy[next(self._turns) % len(healthy)]
+
+
+replica_set = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    '''Session reading from the replica chosen for the current request,
+    see read_replica
+    '''
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context():
+            engine = g.get('replica')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def current_client():
+    '''Subject of the token of the current request, if any'''
+
+    if not has_app_context():
+        return None
+    payload = g.get('jwt_payload')
+    return payload.get('sub') if payload else None
+
+
+def read_replica(f):
+    '''Decorator running a read-only view on a replica
+
+    Every query of the request goes to the same replica, so table
+    versions and rows come from the same database. If the replica fails
+    the view runs again on the primary.
+    '''
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        engine = replica_set.choose(current_client())
+        if engine is None:
+            return f(*args, **kwargs)
+        g.replica = engine
+        try:
+            return f(*args, **kwargs)
+        except DBAPIError:
+            if not replica_set.is_ejected(engine):
+                raise
+            session = current_app.extensions['sqlalchemy'].db.session
+            session.rollback()
+            g.pop('replica', None)
+            return f(*args, **kwargs)
+        finally:
+            g.pop('replica', None)
+    return wrapper
@@ -0,0 +1,205 @@
+import re
+import dateutil.parser
+
+from collections import namedtuple
+from sqlalchemy import column, func, literal_column, table, text
+
+from models import db, movie_actor, Movie, Actor, GENDERS
+
+# Maximum number of ids accepted by the actor_ids / movie_ids filters
+MAX_FILTER_IDS = 1000
+
+# Maximum number of words in a full-text query
+MAX_SEARCH_TERMS = 10
+
+# Query parameters handled outside of the filters
+PAGE_PARAMETERS = ('limit', 'after', 'include', 'sort')
+
+# parse: converts the query parameter, raises ValueError if invalid
+# condition: builds the WHERE clause from the parsed value
+# indexed: whether the condition can be answered from an index
+Filter = namedtuple('Filter', 'parse condition indexed')
+
+
+def parse_date(value):
+    try:
+        return dateutil.parser.parse(value)
+    except (ValueError, OverflowError):
+        raise ValueError('Invalid date')
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Invalid integer')
+
+
+def parse_ids(value):
+    ids = [parse_int(id) for id in value.split(',') if id]
+    if not ids or len(ids) > MAX_FILTER_IDS:
+        raise ValueError('Invalid list of ids')
+    return ids
+
+
+def parse_gender(value):
+    value = value.lower()
+    if value not in GENDERS:
+        raise ValueError('Invalid gender')
+    return value
+
+
+def parse_text(value):
+    '''Lowercases the text and escapes LIKE wildcards'''
+
+    value = value.strip().lower()
+    if not value:
+        raise ValueError('Empty text')
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+def starts_with(column, text):
+    return func.lower(column).like(text + '%', escape='\\')
+
+
+def contains(column, text):
+    return func.lower(column).like('%' + text + '%', escape='\\')
+
+
+MOVIE_FILTERS = {
+    'released_from': Filter(parse_date,
+                            lambda value: Movie.release_date >= value, True),
+    'released_to': Filter(parse_date,
+                          lambda value: Movie.release_date <= value, True),
+    'title_prefix': Filter(parse_text,
+                           lambda value: starts_with(Movie.title, value),
+                           True),
+    'title_contains': Filter(parse_text,
+                             lambda value: contains(Movie.title, value),
+                             False),
+    'actor_ids': Filter(parse_ids, lambda value: Movie.id.in_(
+        db.select([movie_actor.c.movie_id])
+        .where(movie_actor.c.actor_id.in_(value))), True),
+    'actor_count_min': Filter(
+        parse_int, lambda value: Movie.actor_count >= value, True),
+    'actor_count_max': Filter(
+        parse_int, lambda value: Movie.actor_count <= value, True),
+}
+
+ACTOR_FILTERS = {
+    'name_prefix': Filter(parse_text,
+                          lambda value: starts_with(Actor.name, value), True),
+    'name_contains': Filter(parse_text,
+                            lambda value: contains(Actor.name, value), False),
+    'age_min': Filter(parse_int, lambda value: Actor.age >= value, True),
+    'age_max': Filter(parse_int, lambda value: Actor.age <= value, True),
+    'gender': Filter(parse_gender, lambda value: Actor.gender == value, True),
+    'movie_ids': Filter(parse_ids, lambda value: Actor.id.in_(
+        db.select([movie_actor.c.actor_id])
+        .where(movie_actor.c.movie_id.in_(value))), True),
+    'movie_count_min': Filter(
+        parse_int, lambda value: Actor.movie_count >= value, True),
+    'movie_count_max': Filter(
+        parse_int, lambda value: Actor.movie_count <= value, True),
+}
+
+# Sortable columns and whether the order can be read from an index
+MOVIE_SORTS = {
+    'id': (Movie.id, True),
+    'release_date': (Movie.release_date, True),
+    'title': (Movie.title, False),
+    'actor_count': (Movie.actor_count, True),
+}
+
+ACTOR_SORTS = {
+    'id': (Actor.id, True),
+    'age': (Actor.age, True),
+    'name': (Actor.name, False),
+    'movie_count': (Actor.movie_count, True),
+}
+
+
+def search_args(args, filters, sorts):
+    '''Parses and validates search query parameters
+
+    Conditions that cannot use an index (substring matches, sorting by
+    title or name) are only accepted together with an indexed filter,
+    so that a search never turns into a scan of the whole table.
+
+    Parameters
+    ----------
+    args: request query arguments
+    filters: MOVIE_FILTERS or ACTOR_FILTERS
+    sorts: MOVIE_SORTS or ACTOR_SORTS
+
+    Returns
+    -------
+    conditions: list of WHERE clauses
+    sort: column to order by
+    descending: True if 'sort' starts with '-'
+
+    Raises ValueError if a parameter is unknown or invalid or the
+    combination is not backed by an index
+    '''
+
+    unknown = set(args) - set(filters) - set(PAGE_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown filters: {sorted(unknown)}')
+
+    conditions = []
+    indexed = False
+    unindexed = False
+    for name, search_filter in filters.items():
+        if name not in args:
+            continue
+        value = search_filter.parse(args[name])
+        conditions.append(search_filter.condition(value))
+        indexed = indexed or search_filter.indexed
+        unindexed = unindexed or not search_filter.indexed
+
+    sort = args.get('sort', 'id')
+    descending = sort.startswith('-')
+    if sort.lstrip('-') not in sorts:
+        raise ValueError('Invalid sort')
+    column, sort_indexed = sorts[sort.lstrip('-')]
+    if not indexed and (unindexed or not sort_indexed):
+        raise ValueError('Search needs at least one indexed filter')
+    return conditions, column, descending
+
+
+def search_terms(q):
+    '''Splits a full-text query into lowercase words
+
+    Raises ValueError if there is no word or too many words
+    '''
+
+    terms = re.findall(r'\w+', (q or '').lower())
+    if not terms or len(terms) > MAX_SEARCH_TERMS:
+        raise ValueError('Invalid search query')
+    return terms
+
+
+def full_text_search(model, terms):
+    '''Returns a query of rows matching every term, best matches first
+
+    Terms match word prefixes. PostgreSQL uses the generated
+    'search_vector' column and ts_rank, SQLite the FTS5 table and bm25,
+    see models.full_text_index.
+    '''
+
+    name = model.__tablename__
+    if db.engine.dialect.name == 'postgresql':
+        vector = literal_column(f'{name}.search_vector')
+        tsquery = func.to_tsquery(
+            'simple', ' & '.join(f'{term}:*' for term in terms))
+        return model.query \
+            .filter(vector.op('@@')(tsquery)) \
+            .order_by(func.ts_rank(vector, tsquery).desc(), model.id)
+
+    fts = table(f'{name}_fts', column('rowid'), column('rank'))
+    return model.query \
+        .join(fts, fts.c.rowid == model.id) \
+        .filter(text(f'{name}_fts MATCH :terms')) \
+        .order_by(fts.c.rank, model.id) \
+        .params(terms=' '.join(f'"{term}"*' for term in terms))
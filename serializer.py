@@ -0,0 +1,59 @@
+import json
+import os
+
+from functools import lru_cache
+
+from flask import current_app
+
+from instrumentation import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'orjson' (default when installed) or 'json' for the standard library
+JSON_SERIALIZER = os.getenv('JSON_SERIALIZER',
+                            'orjson' if orjson is not None else 'json')
+# Number of distinct release dates whose formatted string is kept
+DATE_CACHE_SIZE = int(os.getenv('DATE_CACHE_SIZE', 4096))
+
+
+def _stdlib_dumps(obj):
+    # same bytes as orjson, so switching serializers keeps bodies equal
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')) \
+        .encode()
+
+
+def get_dumps(name=JSON_SERIALIZER):
+    '''Returns the function serializing an object to json bytes
+
+    Raises ValueError for an unknown or unavailable serializer
+    '''
+
+    if name == 'json':
+        return _stdlib_dumps
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        return orjson.dumps
+    raise ValueError(f'Unknown serializer: {name}')
+
+
+dumps = get_dumps()
+
+
+def json_response(obj, status=200):
+    '''Same as jsonify but serialized with the configured serializer'''
+
+    with timed('serialize'):
+        body = dumps(obj)
+    return current_app.response_class(body, status=status,
+                                      mimetype='application/json')
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def format_date(value):
+    '''Formats a release date, strftime runs once per distinct date'''
+
+    return value.strftime('%A, %b %d %Y')
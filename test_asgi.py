@@ -0,0 +1,166 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+# the async server packages are optional, see requirements-optional.txt
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('starlette')
+pytest.importorskip('databases')
+
+from app import create_app as create_flask_app  # noqa: E402
+from asgi import AsyncJWKSClient, create_app  # noqa: E402
+from auth0 import JWKSCache, token_cache  # noqa: E402
+from cache import response_cache, MemoryBackend  # noqa: E402
+from metrics import http_requests  # noqa: E402
+from ratelimit import rate_limiter, MemoryBuckets  # noqa: E402
+from models import setup_db, db, movie_actor, Actor, Movie  # noqa: E402
+
+TOKEN = 'asgi-test-token'
+header = {'Authorization': f'Bearer {TOKEN}'}
+
+
+class StubSource:
+    '''Counts fetches of a key set with the given kids'''
+
+    def __init__(self, *kids):
+        self.kids = kids
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(0.01)
+        return {'keys': [{'kty': 'RSA', 'kid': kid, 'n': 'n', 'e': 'AQAB'}
+                         for kid in self.kids]}
+
+
+class AsgiTestCase(unittest.TestCase):
+    '''This class represents the async view test cases, their responses
+    are compared to the ones of the Flask views
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        url = 'sqlite:///' + os.path.join(self.directory, 'capstone.db')
+        self.flask_app = create_flask_app()
+        setup_db(self.flask_app, url, [])
+        response_cache.backend = MemoryBackend()
+        with self.flask_app.app_context():
+            db.create_all()
+            Movie(title='Movie', release_date=datetime(2020, 1, 1)).insert()
+            db.session.execute(Actor.__table__.insert().values(
+                name='Actor', age=30, gender='female'))
+            db.session.execute(movie_actor.insert().values(
+                movie_id=1, actor_id=1))
+            db.session.commit()
+        self.app = create_app(url, self.flask_app)
+        # verified tokens are read from the cache by both applications
+        token_cache.put(TOKEN, {'sub': 'tester', 'exp': time.time() + 60,
+                                'permissions': ['get:movies',
+                                                'get:actors']})
+
+    def tearDown(self):
+        token_cache.clear()
+        shutil.rmtree(self.directory)
+
+    def get(self, *requests):
+        '''Sends (path, headers) requests to the async views'''
+
+        async def send():
+            database = self.app.state.database
+            await database.connect()
+            try:
+                async with httpx.AsyncClient(
+                        app=self.app, base_url='http://test') as client:
+                    return [await client.get(path, headers=headers)
+                            for path, headers in requests]
+            finally:
+                await database.disconnect()
+        return asyncio.run(send())
+
+    def test_same_json_as_flask(self):
+        paths = ['/movies', '/movies?include=actors', '/movies?limit=x',
+                 '/movies?include=actors,actor_count', '/movies/1',
+                 '/movies/2', '/actors', '/actors?include=movie_count']
+        responses = self.get(*[(path, header) for path in paths])
+
+        client = self.flask_app.test_client()
+        for path, response in zip(paths, responses):
+            expected = client.get(path, headers=header)
+            self.assertEqual(response.status_code, expected.status_code)
+            self.assertEqual(response.json(), expected.get_json())
+            self.assertEqual(response.headers.get('ETag'),
+                             expected.headers.get('ETag'))
+
+    def test_not_modified(self):
+        response, = self.get(('/movies', header))
+        etag = response.headers['ETag']
+
+        response, = self.get(('/movies', dict(header, **{
+            'If-None-Match': etag})))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_other_routes_are_served_by_flask(self):
+        response, = self.get(('/movies/search?title_prefix=mov', header))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['title'] for movie in response.json()[
+            'movies']], ['Movie'])
+
+    def test_rate_limited(self):
+        with mock.patch.object(rate_limiter, 'store', MemoryBuckets()), \
+                mock.patch.object(rate_limiter, 'limits',
+                                  {'get:movies': (1, 60)}):
+            first, second = self.get(('/movies', header), ('/movies', header))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second.headers['Retry-After'], '60')
+
+    def test_requests_are_counted_under_flask_rules(self):
+        key = ('/movies/<int:movie_id>', 'GET', '404')
+        before = http_requests.values.get(key, 0)
+
+        self.get(('/movies/2', header))
+
+        self.assertEqual(http_requests.values[key], before + 1)
+
+
+class AsyncJWKSClientTestCase(unittest.TestCase):
+    '''This class represents the async JWKS client test cases'''
+
+    def setUp(self):
+        self.source = StubSource('key-1')
+        self.client = AsyncJWKSClient(JWKSCache(
+            self.source, ttl=600, refresh_ahead=0, min_refetch_interval=30))
+
+    def get_keys(self, *kids):
+        async def get():
+            return await asyncio.gather(*[self.client.get_key(kid)
+                                          for kid in kids])
+        return asyncio.run(get())
+
+    def test_concurrent_requests_share_one_fetch(self):
+        keys = self.get_keys(*['key-1'] * 10)
+
+        self.assertEqual([key['kid'] for key in keys], ['key-1'] * 10)
+        self.assertEqual(self.source.calls, 1)
+
+    def test_unknown_kid_refetches_once(self):
+        self.get_keys('key-1')
+        keys = self.get_keys('key-2', 'key-2')
+
+        self.assertEqual(keys, [None, None])
+        self.assertEqual(self.source.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+import threading
+import unittest
+
+from auth0 import AuthError, JWKSCache, TokenCache
+
+
+def make_jwks(*kids):
+    return {'keys': [{
+        'kty': 'RSA',
+        'kid': kid,
+        'use': 'sig',
+        'n': f'n-{kid}',
+        'e': 'AQAB'
+    } for kid in kids]}
+
+
+class StubSource:
+    '''Counts fetches and returns the currently configured key set'''
+
+    def __init__(self, *kids):
+        self.jwks = make_jwks(*kids)
+        self.calls = 0
+        self.fail = False
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise OSError('JWKS endpoint unreachable')
+        return self.jwks
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    '''This class represents the JWKS cache test cases'''
+
+    def setUp(self):
+        self.source = StubSource('key-1')
+        self.clock = FakeClock()
+        self.cache = JWKSCache(self.source, ttl=600, refresh_ahead=0,
+                               min_refetch_interval=30, retry_interval=10,
+                               clock=self.clock)
+
+    def test_keys_are_fetched_once_within_ttl(self):
+        for _ in range(5):
+            key = self.cache.get_key('key-1')
+
+        self.assertEqual(key['n'], 'n-key-1')
+        self.assertEqual(self.source.calls, 1)
+
+    def test_expired_key_set_is_refetched(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 600
+        self.cache.get_key('key-1')
+
+        self.assertEqual(self.source.calls, 2)
+
+    def test_unknown_kid_forces_single_refetch(self):
+        self.cache.get_key('key-1')
+        self.source.jwks = make_jwks('key-1', 'key-2')
+
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.assertEqual(self.source.calls, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.cache.get_key('key-1')
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key('bogus'))
+
+        self.assertEqual(self.source.calls, 2)
+
+        self.clock.now += 30
+        self.assertIsNone(self.cache.get_key('bogus'))
+        self.assertEqual(self.source.calls, 3)
+
+    def test_stale_keys_are_served_when_refetch_fails(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 600
+        self.source.fail = True
+
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+
+    def test_unreachable_source_without_keys_503(self):
+        self.source.fail = True
+        with self.assertRaises(AuthError) as context:
+            self.cache.get_key('key-1')
+
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_failed_refetch_backs_off(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 600
+        self.source.fail = True
+        for _ in range(5):
+            self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.assertEqual(self.source.calls, 2)
+
+        self.clock.now += 10
+        self.source.fail = False
+        self.cache.get_key('key-1')
+        self.assertEqual(self.source.calls, 3)
+        self.assertIsNone(self.cache.failed_at)
+
+    def test_unreachable_source_backs_off_without_keys(self):
+        self.source.fail = True
+        for _ in range(3):
+            with self.assertRaises(AuthError) as context:
+                self.cache.get_key('key-1')
+            self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(self.source.calls, 1)
+
+    def test_expired_key_set_is_fetched_once_for_concurrent_requests(self):
+        self.cache.get_key('key-1')
+        self.clock.now += 600
+        release = threading.Event()
+
+        def slow_source():
+            self.source.calls += 1
+            release.wait(5)
+            return make_jwks('key-1')
+
+        self.cache.source = slow_source
+        keys = []
+        threads = [threading.Thread(
+            target=lambda: keys.append(self.cache.get_key('key-1')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual([key['kid'] for key in keys], ['key-1'] * 8)
+        self.assertEqual(self.source.calls, 2)
+
+    def test_refresh_ahead_runs_in_background(self):
+        refreshed = threading.Event()
+
+        def source():
+            if self.cache.fetched_at is not None:
+                refreshed.set()
+            return make_jwks('key-1')
+
+        cache = self.cache
+        cache.set_source(source)
+        cache.refresh_ahead = 60
+        cache.get_key('key-1')
+        self.clock.now += 550
+
+        self.assertEqual(cache.get_key('key-1')['kid'], 'key-1')
+        self.assertTrue(refreshed.wait(5))
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    '''This class represents the verified token cache test cases'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = TokenCache(maxsize=2, clock=self.clock)
+        self.payload = {'sub': 'user-1', 'exp': self.clock.now + 60,
+                        'permissions': ['get:movies']}
+
+    def test_cached_payload_is_returned(self):
+        self.assertIsNone(self.cache.get('token-1'))
+        self.cache.put('token-1', self.payload)
+
+        self.assertEqual(self.cache.get('token-1'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_payload_expires_with_token(self):
+        self.cache.put('token-1', self.payload)
+        self.clock.now += 60
+
+        self.assertIsNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_token_without_exp_is_not_cached(self):
+        self.cache.put('token-1', {'sub': 'user-1'})
+
+        self.assertIsNone(self.cache.get('token-1'))
+
+    def test_least_recently_used_token_is_evicted(self):
+        self.cache.put('token-1', self.payload)
+        self.cache.put('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.put('token-3', self.payload)
+
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertIsNotNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidation(self):
+        self.cache.put('token-1', self.payload)
+        self.cache.put('token-2', dict(self.payload, sub='user-2'))
+
+        self.assertTrue(self.cache.invalidate('token-1'))
+        self.assertIsNone(self.cache.get('token-1'))
+        self.assertEqual(self.cache.invalidate_subject('user-2'), 1)
+        self.assertIsNone(self.cache.get('token-2'))
+
+
+if __name__ == "__main__":
+    unittest.main()
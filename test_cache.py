@@ -0,0 +1,209 @@
+import threading
+import time
+import unittest
+
+from flask import Flask, abort, jsonify
+
+from cache import MemoryBackend, RedisBackend, ResponseCache, SingleFlight
+
+
+class FakeRedis:
+    '''Implements the part of the redis-py client used by RedisBackend'''
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    '''This class represents the response cache test cases'''
+
+    def make_app(self, backend):
+        app = Flask(__name__)
+        self.cache = ResponseCache(backend, ttl=60)
+        self.calls = 0
+
+        @app.route('/movies/<int:movie_id>')
+        @self.cache.cached(lambda movie_id: [f'movie:{movie_id}'])
+        def get_movie(movie_id):
+            self.calls += 1
+            return jsonify({'id': movie_id, 'calls': self.calls})
+
+        @app.route('/movies')
+        @self.cache.cached(lambda: ['movies'])
+        def get_movies():
+            self.calls += 1
+            return jsonify({'calls': self.calls})
+        return app.test_client()
+
+    def check_backend(self, backend):
+        client = self.make_app(backend)
+
+        self.assertEqual(client.get('/movies/1').headers['X-Cache'], 'MISS')
+        self.assertEqual(client.get('/movies/1').headers['X-Cache'], 'HIT')
+        self.assertEqual(client.get('/movies').headers['X-Cache'], 'MISS')
+        self.assertEqual(client.get('/movies?limit=1').headers['X-Cache'],
+                         'MISS')
+
+        self.cache.invalidate('movie:1')
+
+        self.assertEqual(client.get('/movies/1').json['calls'], 4)
+        self.assertEqual(client.get('/movies').headers['X-Cache'], 'HIT')
+        self.assertEqual(client.get('/movies/2').headers['X-Cache'], 'MISS')
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryBackend(maxsize=10))
+
+    def test_redis_backend(self):
+        self.check_backend(RedisBackend(FakeRedis()))
+
+    def test_memory_backend_evicts_least_recently_used(self):
+        backend = MemoryBackend(maxsize=2)
+        backend.set('a', b'1', 60)
+        backend.set('b', b'2', 60)
+        backend.get('a')
+        backend.set('c', b'3', 60)
+
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'1')
+
+    def test_memory_backend_bounds_tag_versions(self):
+        backend = MemoryBackend(maxsize=10, maxtags=2)
+        stale = backend.get_versions(['movie:1'])
+        backend.bump(['movie:1'])
+        bumped = backend.get_versions(['movie:1'])
+        backend.bump(['movie:2', 'movie:3'])
+
+        self.assertEqual(list(backend.versions), ['movie:2', 'movie:3'])
+        # the evicted tag does not go back to a version it had before
+        self.assertEqual(backend.get_versions(['movie:1']), bumped)
+        self.assertNotEqual(backend.get_versions(['movie:1']), stale)
+        self.assertEqual(backend.get_versions(['movie:4']), bumped)
+
+
+def wait_for_followers(flight, key, count):
+    '''Waits until count calls joined the call of key in flight'''
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with flight._lock:
+            call = flight.calls.get(key)
+            if call is not None and call['followers'] >= count:
+                return
+        time.sleep(0.001)
+    raise AssertionError('the followers did not join')
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    '''This class represents the request coalescing test cases'''
+
+    def run_concurrently(self, flight, function, count=5):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(flight.run('key', function))
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_concurrent_calls_share_one_run(self):
+        flight = SingleFlight()
+        calls = []
+
+        def function():
+            calls.append(1)
+            wait_for_followers(flight, 'key', 4)
+            return 'result'
+
+        results, errors = self.run_concurrently(flight, function)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('result', False)] +
+                         [('result', True)] * 4)
+        self.assertEqual(flight.calls, {})
+
+    def test_exception_is_shared(self):
+        flight = SingleFlight()
+
+        def function():
+            wait_for_followers(flight, 'key', 2)
+            raise ValueError('failed')
+
+        results, errors = self.run_concurrently(flight, function, count=3)
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+
+    def test_later_calls_run_again(self):
+        flight = SingleFlight()
+
+        self.assertEqual(flight.run('key', lambda: 1), (1, False))
+        self.assertEqual(flight.run('key', lambda: 2), (2, False))
+
+    def test_cached_view_is_coalesced(self):
+        self.check_coalesced(MemoryBackend())
+
+    def test_view_is_coalesced_without_backend(self):
+        self.check_coalesced(None)
+
+    def check_coalesced(self, backend):
+        app = Flask(__name__)
+        cache = ResponseCache(backend, ttl=60)
+        calls = []
+
+        @app.route('/movies/<int:movie_id>')
+        @cache.cached(lambda movie_id: [f'movie:{movie_id}'])
+        def get_movie(movie_id):
+            calls.append(movie_id)
+            wait_for_followers(cache.flights, next(iter(cache.flights.calls)),
+                               2)
+            if movie_id == 2:
+                abort(404)
+            return jsonify({'id': movie_id})
+
+        for movie_id, status in ((1, 200), (2, 404)):
+            responses = []
+
+            def get():
+                responses.append(
+                    app.test_client().get(f'/movies/{movie_id}'))
+
+            threads = [threading.Thread(target=get) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual([response.status_code
+                              for response in responses], [status] * 3)
+            # the 404 of abort is raised in every request instead
+            expected = ['COALESCED', 'COALESCED', 'MISS'] \
+                if status == 200 else [''] * 3
+            self.assertEqual(sorted(response.headers.get('X-Cache', '')
+                                    for response in responses), expected)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(cache.stats()['coalesced'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
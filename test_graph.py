@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import datetime
+
+from flask import Flask
+
+from graph import Adjacency, CastGraph
+from models import setup_db, db, write_links, Actor, Movie
+
+
+class AdjacencyTestCase(unittest.TestCase):
+    '''This class represents the CSR array test cases'''
+
+    def test_arrays(self):
+        adjacency = Adjacency([(1, 2), (1, 5), (3, 4)])
+        self.assertEqual(list(adjacency.offsets), [0, 0, 2, 2, 3])
+        self.assertEqual(list(adjacency.linked(1)), [2, 5])
+        self.assertEqual(list(adjacency.linked(2)), [])
+        self.assertEqual(list(adjacency.linked(9)), [])
+
+    def test_changes_are_idempotent(self):
+        adjacency = Adjacency([(1, 2), (1, 5)])
+        adjacency.add(1, 2)
+        adjacency.remove(1, 7)
+        self.assertEqual(adjacency.changes, 0)
+
+        adjacency.add(1, 3)
+        adjacency.add(1, 3)
+        adjacency.remove(1, 5)
+        adjacency.add(9, 1)
+        self.assertEqual(sorted(adjacency.linked(1)), [2, 3])
+        self.assertEqual(list(adjacency.linked(9)), [1])
+        self.assertEqual(adjacency.changes, 3)
+
+        adjacency.add(1, 5)
+        adjacency.remove(1, 3)
+        self.assertEqual(sorted(adjacency.linked(1)), [2, 5])
+        self.assertEqual(adjacency.changes, 1)
+
+
+class CastGraphTestCase(unittest.TestCase):
+    '''This class represents the co-star graph test cases
+
+    Movies 1 to 4 link actors 1-2, 2-3, 3-4 and 1-2-5, actor 6 has no
+    movies.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///' +
+                 os.path.join(self.directory, 'graph.db'), [])
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+        for number in range(1, 5):
+            Movie(title=f'Movie{number}',
+                  release_date=datetime(2020, 1, 1)).insert()
+        for number in range(1, 7):
+            Actor(name=f'Actor{number}', age=30, gender='other').insert()
+        for movie_id, actors in [(1, [1, 2]), (2, [2, 3]), (3, [3, 4]),
+                                 (4, [1, 2, 5])]:
+            self.link(movie_id, actors)
+        self.graph = CastGraph()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(self.app).dispose()
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def link(self, movie_id, new=(), removed=()):
+        write_links('movie_id', movie_id, list(new), list(removed))
+        db.session.commit()
+
+    def test_costars(self):
+        self.assertEqual(self.graph.costars(2), [(1, 2), (3, 1), (5, 1)])
+        self.assertEqual(self.graph.costars(6), [])
+
+    def test_shortest_path(self):
+        self.assertEqual(self.graph.shortest_path(1, 4),
+                         ([1, 2, 3, 4], [1, 2, 3]))
+        self.assertEqual(self.graph.shortest_path(4, 5),
+                         ([4, 3, 2, 5], [3, 2, 4]))
+        self.assertEqual(self.graph.shortest_path(2, 2), ([2], []))
+        self.assertIsNone(self.graph.shortest_path(1, 4, max_degrees=2))
+        self.assertIsNone(self.graph.shortest_path(1, 6))
+
+    def test_refresh_applies_changes(self):
+        self.assertEqual(len(self.graph.shortest_path(1, 4)[1]), 3)
+        self.link(2, removed=[3])
+        self.assertIsNone(self.graph.shortest_path(1, 4))
+        self.link(3, new=[5])
+        self.assertEqual(self.graph.shortest_path(1, 4),
+                         ([1, 5, 4], [4, 3]))
+        Actor.query.get(5).delete()
+        self.assertIsNone(self.graph.shortest_path(1, 4))
+        self.assertEqual(self.graph.builds, 1)
+
+    def test_rebuild(self):
+        # a link is a change of both arrays
+        self.graph.compact_changes = 3
+        self.graph.costars(1)
+        self.link(1, new=[3])
+        self.assertEqual(self.graph.costars(3), [(2, 2), (1, 1), (4, 1)])
+        self.assertEqual(self.graph.builds, 1)
+        self.link(1, new=[4])
+        self.assertEqual(self.graph.costars(4), [(3, 2), (1, 1), (2, 1)])
+        self.assertEqual(self.graph.builds, 2)
+        self.assertEqual(self.graph.movies.changes, 0)
+
+        # changes older than the kept ones
+        self.graph.changes_kept = 0
+        self.link(1, removed=[4])
+        self.assertEqual(self.graph.costars(4), [(3, 1)])
+        self.assertEqual(self.graph.builds, 3)
+
+
+'''Make the tests conveniently executable'''
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import json
+import time
+import unittest
+
+from unittest import mock
+
+from flask import Flask
+
+import instrumentation
+from instrumentation import (
+    finish_request,
+    start_request,
+    timed,
+    RequestTimings
+)
+from models import setup_db, db, Movie
+from serializer import json_response
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    '''This class represents the request instrumentation test cases'''
+
+    def setUp(self):
+        app = Flask(__name__)
+        setup_db(app, 'sqlite://', [])
+        app.before_request(start_request)
+        app.after_request(finish_request)
+        with app.app_context():
+            db.create_all()
+
+        @app.route('/movies')
+        def get_movies():
+            with timed('auth'):
+                time.sleep(0.002)
+            titles = [movie.title for movie in Movie.query]
+            db.session.execute('SELECT 1')
+            return json_response({'titles': titles})
+
+        self.client = app.test_client()
+
+    def test_server_timing_header(self):
+        response = self.client.get('/movies')
+
+        entries = dict(entry.split(';', 1) for entry in
+                       response.headers['Server-Timing'].split(', '))
+        self.assertEqual(set(entries),
+                         {'auth', 'serialize', 'db', 'total'})
+        self.assertIn('desc="2 queries"', entries['db'])
+        self.assertGreaterEqual(float(entries['auth'][4:]), 2)
+
+    def test_slow_request_logs_statements(self):
+        with mock.patch.object(instrumentation, 'SLOW_REQUEST_MS', 0), \
+                self.assertLogs('instrumentation', 'WARNING') as logs:
+            self.client.get('/movies')
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['path'], line['status'], line['sql_count']),
+                         ('/movies', 200, 2))
+        self.assertEqual(len(line['slow_statements']), 2)
+        self.assertTrue(any(statement['statement'] == 'SELECT 1'
+                            for statement in line['slow_statements']))
+
+    def test_only_slowest_statements_are_kept(self):
+        timings = RequestTimings(keep=2)
+        for seconds in (0.3, 0.1, 0.5, 0.2):
+            timings.add_sql(f'statement {seconds}', seconds)
+
+        self.assertEqual(timings.sql_count, 4)
+        self.assertEqual([statement['statement']
+                          for statement in timings.slowest()],
+                         ['statement 0.5', 'statement 0.3'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from flask import Flask, current_app
+
+from jobs import format_job, JobFailed, JobQueue, JobWorkers
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JobQueueTestCase(unittest.TestCase):
+    '''This class represents the job queue test cases'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='capstone-jobs-')
+        self.clock = FakeClock()
+        self.queue = JobQueue(os.path.join(self.directory, 'jobs.db'),
+                              stale_seconds=60, retention_seconds=3600,
+                              clock=self.clock)
+        self.workers = JobWorkers(self.queue, Flask(__name__), threads=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claim_oldest_first(self):
+        first = self.queue.enqueue('count', {'n': 1}, 'user|1', 'get:jobs')
+        self.clock.now += 1
+        second = self.queue.enqueue('count', {'n': 2})
+
+        job = self.queue.claim()
+        self.assertEqual(job['id'], first)
+        self.assertEqual(job['payload'], {'n': 1})
+        self.assertEqual(job['status'], 'running')
+        self.assertEqual(self.queue.claim()['id'], second)
+        self.assertIsNone(self.queue.claim())
+
+    def test_progress_and_result(self):
+        @self.workers.handler('count')
+        def count(payload, progress):
+            for done in range(payload['n'] + 1):
+                progress(done, payload['n'])
+            return {'counted': payload['n']}
+
+        id = self.queue.enqueue('count', {'n': 3})
+        self.assertEqual(format_job(self.queue.get(id))['progress'], 0.0)
+        self.assertEqual(self.workers.run_pending(), 1)
+
+        job = format_job(self.queue.get(id))
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual((job['done'], job['total']), (3, 3))
+        self.assertEqual(job['progress'], 1.0)
+        self.assertEqual(job['result'], {'counted': 3})
+        self.assertIsNotNone(job['finished_at'])
+
+    def test_failed_jobs(self):
+        @self.workers.handler('reject')
+        def reject(payload, progress):
+            raise JobFailed('unprocessable', {'errors': [1]})
+
+        @self.workers.handler('crash')
+        def crash(payload, progress):
+            raise RuntimeError('boom')
+
+        rejected = self.queue.enqueue('reject', {})
+        crashed = self.queue.enqueue('crash', {})
+        with self.assertLogs('jobs', 'ERROR'):
+            self.workers.run_pending()
+
+        job = self.queue.get(rejected)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'unprocessable')
+        self.assertEqual(job['result'], {'errors': [1]})
+        job = self.queue.get(crashed)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], 'Something went wrong!')
+
+    def test_stale_and_expired_jobs(self):
+        stale = self.queue.enqueue('count', {})
+        self.queue.claim()
+        self.clock.now += 61
+        self.assertIsNone(self.queue.claim())
+        job = self.queue.get(stale)
+        self.assertEqual((job['status'], job['error']),
+                         ('failed', 'interrupted'))
+
+        self.clock.now += 3601
+        self.queue.claim()
+        self.assertIsNone(self.queue.get(stale))
+
+    def test_stale_job_keeps_failed_status(self):
+        @self.workers.handler('slow')
+        def slow(payload, progress):
+            # another worker fails the job as stale meanwhile
+            self.clock.now += 61
+            self.assertIsNone(self.queue.claim())
+            progress(1, 1)
+            return {'done': True}
+
+        id = self.queue.enqueue('slow', {})
+        with self.assertLogs('jobs', 'WARNING'):
+            self.workers.run_pending()
+
+        job = self.queue.get(id)
+        self.assertEqual((job['status'], job['error']),
+                         ('failed', 'interrupted'))
+        self.assertEqual(job['done'], 0)
+        self.assertIsNone(job['result'])
+
+    def test_threads_claim_every_job_once(self):
+        ran = []
+        finished = threading.Event()
+
+        @self.workers.handler('append')
+        def append(payload, progress):
+            self.assertIsNotNone(current_app)
+            ran.append(payload['n'])
+            if len(ran) == 20:
+                finished.set()
+
+        for n in range(20):
+            self.queue.enqueue('append', {'n': n})
+        self.workers.threads = 4
+        self.workers.poll_seconds = 0.01
+        self.workers.start()
+        self.addCleanup(self.workers.stop, 10)
+
+        self.assertTrue(finished.wait(10))
+        self.assertEqual(sorted(ran), list(range(20)))
+
+
+'''Make the tests conveniently executable'''
+if __name__ == "__main__":
+    unittest.main()
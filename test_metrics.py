@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from metrics import Registry, measure
+
+
+class MetricsTestCase(unittest.TestCase):
+    '''This class represents the /metrics registry test cases'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.registry = Registry(self.directory, flush_seconds=0,
+                                 prefix='test_')
+        self.requests = self.registry.counter('requests', 'Requests',
+                                              ['route'])
+        self.workers = self.registry.gauge('workers', 'Workers')
+        self.latency = self.registry.histogram('latency', 'Latency',
+                                               ['outcome'],
+                                               buckets=(0.1, float('inf')))
+
+    def write_worker(self, pid, requests, latency_counts):
+        '''Writes the file of another worker to the metrics directory'''
+
+        snapshot = {'pid': pid, 'metrics': {
+            'test_requests': {'kind': 'counter', 'help': 'Requests',
+                              'labels': ['route'],
+                              'samples': [[['/movies'], requests]]},
+            'test_workers': {'kind': 'gauge', 'help': 'Workers',
+                             'labels': [], 'samples': [[[], 1]]},
+            'test_latency': {'kind': 'histogram', 'help': 'Latency',
+                             'labels': ['outcome'],
+                             'buckets': ['0.1', '+Inf'],
+                             'samples': [[['success'],
+                                          [latency_counts, 1.5]]]},
+        }}
+        path = os.path.join(self.directory, f'{pid}-other.json')
+        with open(path, 'w') as file:
+            json.dump(snapshot, file)
+
+    def test_render_format(self):
+        self.requests.inc('/movies')
+        self.requests.inc('/movies', amount=2)
+        self.workers.set(1)
+        with measure(self.latency):
+            pass
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{route="/movies"} 3', lines)
+        self.assertIn('test_workers 1', lines)
+        self.assertIn('test_latency_bucket{outcome="success",le="0.1"} 1',
+                      lines)
+        self.assertIn('test_latency_bucket{outcome="success",le="+Inf"} 1',
+                      lines)
+        self.assertIn('test_latency_count{outcome="success"} 1', lines)
+
+    def test_measure_failure(self):
+        with self.assertRaises(ValueError), measure(self.latency):
+            raise ValueError()
+
+        self.assertIn('test_latency_count{outcome="failure"} 1',
+                      self.registry.render())
+
+    def test_workers_are_added_up(self):
+        self.requests.inc('/movies')
+        self.workers.set(1)
+        self.registry.flush()
+        # a live worker, the parent of this process
+        self.write_worker(os.getppid(), 4, [2, 1])
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn('test_requests_total{route="/movies"} 5', lines)
+        self.assertIn('test_workers 2', lines)
+        self.assertIn('test_latency_bucket{outcome="success",le="0.1"} 2',
+                      lines)
+        self.assertIn('test_latency_count{outcome="success"} 3', lines)
+
+    def test_gauges_of_exited_workers_are_skipped(self):
+        self.workers.set(1)
+        # above the largest pid linux hands out
+        self.write_worker(2 ** 22 + 1, 4, [0, 1])
+
+        lines = self.registry.render().splitlines()
+
+        self.assertIn('test_requests_total{route="/movies"} 4', lines)
+        self.assertIn('test_workers 1', lines)
+
+    def test_flush_replaces_own_file(self):
+        self.requests.inc('/movies')
+        self.registry.flush()
+        self.requests.inc('/movies')
+        self.registry.flush()
+
+        self.assertEqual(os.listdir(self.directory),
+                         [os.path.basename(self.registry.path)])
+        self.assertIn('test_requests_total{route="/movies"} 2',
+                      self.registry.render())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class MigrationTestCase(unittest.TestCase):
+    '''This class represents the migration test cases, run through
+    `python manage.py db` in a process of its own as in production
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'migrate.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def manage(self, *args):
+        env = dict(os.environ, DATABASE_URL='sqlite:///' + self.path,
+                   JOBS_DATABASE=os.path.join(self.directory, 'jobs.db'))
+        process = subprocess.run(
+            [sys.executable, 'manage.py', 'db', *args], cwd=ROOT, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode:
+            self.fail(process.stderr.decode()[-2000:])
+
+    def test_upgrade_populated_database(self):
+        # full-text search, before updated_at and the link counters
+        self.manage('upgrade', 'c3d58f0e6b21')
+        with sqlite3.connect(self.path) as connection:
+            connection.executescript('''
+                INSERT INTO movies (id, title, release_date)
+                VALUES (1, 'Old Movie', '2020-01-01 00:00:00.000000');
+                INSERT INTO actors (id, name, age, gender)
+                VALUES (1, 'Old Actor', 40, 'male');
+                INSERT INTO movie_actor VALUES (1, 1);
+            ''')
+
+        self.manage('upgrade')
+        with sqlite3.connect(self.path) as connection:
+            rows = connection.execute(
+                'SELECT updated_at, actor_count FROM movies').fetchall()
+            self.assertEqual(len(rows), 1)
+            self.assertIsNotNone(rows[0][0])
+            self.assertEqual(rows[0][1], 1)
+            self.assertEqual(connection.execute(
+                'SELECT count(*) FROM movie_actor').fetchone(), (1,))
+            # the full-text triggers still follow renames
+            connection.execute("UPDATE actors SET name = 'New Name'")
+            self.assertEqual(connection.execute(
+                "SELECT rowid FROM actors_fts WHERE actors_fts MATCH 'new'"
+            ).fetchall(), [(1,)])
+
+        self.manage('downgrade', 'base')
+
+
+'''Make the tests conveniently executable'''
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+
+import pool
+from pool import (
+    async_database_options,
+    engine_options,
+    pool_status,
+    PoolMetrics,
+    TimedQueuePool
+)
+
+
+class PoolTestCase(unittest.TestCase):
+    '''This class represents the connection pool test cases'''
+
+    def test_sqlite_keeps_default_pool(self):
+        self.assertEqual(engine_options('sqlite:///capstone.db'), {})
+
+    def test_postgres_options(self):
+        with mock.patch.object(pool, 'DB_POOL_SIZE', 3), \
+                mock.patch.object(pool, 'DB_STATEMENT_TIMEOUT', 5000):
+            options = engine_options('postgres://user@localhost/capstone')
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    def test_pgbouncer_disables_prepared_statements(self):
+        with mock.patch.object(pool, 'DB_PGBOUNCER', True), \
+                mock.patch.object(pool, 'DB_STATEMENT_TIMEOUT', 5000):
+            options = engine_options(
+                'postgresql+asyncpg://user@localhost/capstone')
+
+        self.assertEqual(options['connect_args'],
+                         {'statement_cache_size': 0})
+
+    def test_async_options(self):
+        with mock.patch.object(pool, 'DB_POOL_SIZE', 3), \
+                mock.patch.object(pool, 'DB_MAX_OVERFLOW', 2), \
+                mock.patch.object(pool, 'DB_STATEMENT_TIMEOUT', 5000):
+            url, options = async_database_options(
+                'postgres://user@localhost/capstone')
+
+        self.assertEqual(url, 'postgresql://user@localhost/capstone')
+        self.assertEqual((options['min_size'], options['max_size']), (3, 5))
+        self.assertEqual(options['server_settings'],
+                         {'statement_timeout': '5000'})
+        self.assertEqual(async_database_options('sqlite:///capstone.db'),
+                         ('sqlite:///capstone.db', {}))
+
+    def test_options_create_engine(self):
+        options = engine_options('postgres://user@localhost/capstone')
+        options.pop('connect_args', None)
+        engine = create_engine('sqlite://', **options)
+
+        with engine.connect() as connection:
+            connection.execute('SELECT 1')
+            status = pool_status(engine.pool)
+            self.assertEqual(status['checked_out'], 1)
+
+        self.assertEqual(pool_status(engine.pool)['checked_out'], 0)
+        self.assertEqual(status['wait_seconds']['count'], 1)
+
+    def test_timeout_counted(self):
+        import sqlite3
+        queue_pool = TimedQueuePool(
+            lambda: sqlite3.connect(':memory:', check_same_thread=False),
+            pool_size=1, max_overflow=0, timeout=0.01)
+        connection = queue_pool.connect()
+
+        with self.assertRaises(TimeoutError):
+            queue_pool.connect()
+        connection.close()
+
+        status = pool_status(queue_pool)
+        self.assertEqual(status['timeouts'], 1)
+        self.assertEqual(status['checked_out'], 0)
+
+    def test_histogram_is_cumulative(self):
+        metrics = PoolMetrics(buckets=(0.01, 0.1, float('inf')))
+        for seconds in (0.001, 0.05, 0.05, 3):
+            metrics.observe(seconds)
+
+        histogram = metrics.histogram()
+        self.assertEqual(histogram['buckets'],
+                         [(0.01, 1), (0.1, 3), ('+Inf', 4)])
+        self.assertEqual(histogram['count'], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from ratelimit import (
+    parse_limits,
+    MemoryBuckets,
+    RateLimited,
+    RateLimiter
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RateLimitTestCase(unittest.TestCase):
+    '''This class represents the rate limiter test cases'''
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(MemoryBuckets(clock=self.clock), {
+            'get:movies': (2, 10), '*': (5, 1)})
+
+    def test_parse_limits(self):
+        self.assertEqual(parse_limits('get:movies=120/60, post:movies=1/5'),
+                         {'get:movies': (120, 60.0),
+                          'post:movies': (1, 5.0)})
+        self.assertEqual(parse_limits(''), {})
+        with self.assertRaises(ValueError):
+            parse_limits('get:movies=0/60')
+
+    def test_burst_then_refill(self):
+        payload = {'sub': 'user|1'}
+        self.limiter.check('get:movies', payload)
+        self.limiter.check('get:movies', payload)
+
+        with self.assertRaises(RateLimited) as context:
+            self.limiter.check('get:movies', payload)
+        self.assertAlmostEqual(context.exception.retry_after, 5)
+
+        # one token every 5 seconds
+        self.clock.now += 5
+        self.limiter.check('get:movies', payload)
+        with self.assertRaises(RateLimited):
+            self.limiter.check('get:movies', payload)
+
+    def test_buckets_per_client_and_permission(self):
+        self.limiter.check('get:movies', {'sub': 'user|1'})
+        self.limiter.check('get:movies', {'sub': 'user|1'})
+
+        self.limiter.check('get:movies', {'sub': 'user|2'})
+        for _ in range(5):
+            self.limiter.check('get:actors', {'sub': 'user|1'})
+        with self.assertRaises(RateLimited):
+            self.limiter.check('get:actors', {'sub': 'user|1'})
+
+    def test_unlimited_without_limit(self):
+        limiter = RateLimiter(MemoryBuckets(clock=self.clock),
+                              {'post:movies': (1, 60)})
+        for _ in range(10):
+            limiter.check('get:movies', {'sub': 'user|1'})
+
+    def test_evicted_bucket_is_full(self):
+        buckets = MemoryBuckets(maxsize=1, clock=self.clock)
+        self.assertEqual(buckets.take('a', 1, 0.1), 0)
+        self.assertGreater(buckets.take('a', 1, 0.1), 0)
+        buckets.take('b', 1, 0.1)
+
+        self.assertEqual(buckets.take('a', 1, 0.1), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from datetime import datetime
+from functools import wraps
+
+from flask import Flask, g, jsonify, request
+
+from models import setup_db, db, Movie
+from replicas import read_replica, replica_set
+
+
+def as_client(f):
+    '''Stands in for requires_auth, the client is sent in a header'''
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.jwt_payload = {'sub': request.headers.get('X-Client')}
+        return f(*args, **kwargs)
+    return wrapper
+
+
+class ReplicaTestCase(unittest.TestCase):
+    '''This class represents the read replica routing test cases'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 0.0
+        self.primary = self.database('primary')
+        self.replicas = [self.database('replica0'),
+                         self.database('replica1')]
+
+    def tearDown(self):
+        replica_set.configure([])
+        replica_set.last_writes.clear()
+        replica_set.clock = time.monotonic
+        shutil.rmtree(self.directory)
+
+    def database(self, name):
+        '''Creates a SQLite database holding one movie titled name'''
+
+        url = 'sqlite:///' + os.path.join(self.directory, name + '.db')
+        app = Flask(__name__)
+        setup_db(app, url, [])
+        with app.app_context():
+            db.create_all()
+            Movie(title=name, release_date=datetime(2020, 1, 1)).insert()
+        return url
+
+    def make_app(self, replica_urls):
+        app = Flask(__name__)
+        setup_db(app, self.primary, replica_urls)
+        replica_set.clock = lambda: self.now
+
+        @app.route('/movies')
+        @as_client
+        @read_replica
+        def get_movies():
+            return jsonify([movie.title for movie in Movie.query])
+
+        @app.route('/movies', methods=['POST'])
+        @as_client
+        def create_movie():
+            Movie(title='new', release_date=datetime(2021, 1, 1)).insert()
+            return jsonify({'success': True})
+
+        return app.test_client()
+
+    def get_titles(self, client, name='reader'):
+        res = client.get('/movies', headers={'X-Client': name})
+        self.assertEqual(res.status_code, 200)
+        return res.get_json()
+
+    def test_reads_use_replicas_in_turn(self):
+        client = self.make_app(self.replicas)
+
+        titles = [self.get_titles(client) for _ in range(4)]
+
+        self.assertEqual(sorted(titles), [['replica0'], ['replica0'],
+                                          ['replica1'], ['replica1']])
+
+    def test_without_replicas_reads_use_primary(self):
+        client = self.make_app([])
+
+        self.assertEqual(self.get_titles(client), ['primary'])
+
+    def test_read_your_writes(self):
+        client = self.make_app(self.replicas[:1])
+        client.post('/movies', headers={'X-Client': 'writer'})
+
+        self.assertEqual(self.get_titles(client, 'writer'),
+                         ['primary', 'new'])
+        self.assertEqual(self.get_titles(client, 'reader'), ['replica0'])
+
+        self.now += replica_set.sticky_seconds
+        self.assertEqual(self.get_titles(client, 'writer'), ['replica0'])
+
+    def test_failed_replica_is_ejected(self):
+        missing = 'sqlite:///' + os.path.join(self.directory, 'missing',
+                                              'replica.db')
+        client = self.make_app([missing, self.replicas[0]])
+
+        titles = [self.get_titles(client) for _ in range(3)]
+
+        # the failed read was retried on the primary
+        self.assertEqual(titles, [['primary'], ['replica0'], ['replica0']])
+        self.assertTrue(replica_set.is_ejected(replica_set.engines[0]))
+
+        self.now += replica_set.eject_seconds
+        self.assertFalse(replica_set.is_ejected(replica_set.engines[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
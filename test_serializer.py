@@ -0,0 +1,47 @@
+import json
+import unittest
+
+from datetime import datetime
+
+from serializer import format_date, get_dumps, orjson
+
+
+class SerializerTestCase(unittest.TestCase):
+    '''This class represents the json serializer test cases'''
+
+    def setUp(self):
+        self.body = {
+            'success': True,
+            'movies': [{'id': 1, 'title': 'Ünïcode "quoted"',
+                        'release_date': 'Sunday, Jul 25 2021',
+                        'updated_at': '2021-07-25T10:00:00.123456'}],
+            'next_cursor': None
+        }
+
+    def test_stdlib_dumps(self):
+        data = get_dumps('json')(self.body)
+
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), self.body)
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_orjson_matches_stdlib(self):
+        self.assertEqual(get_dumps('orjson')(self.body),
+                         get_dumps('json')(self.body))
+
+    def test_unknown_serializer(self):
+        with self.assertRaises(ValueError):
+            get_dumps('yaml')
+
+    def test_format_date_cached(self):
+        format_date.cache_clear()
+        date = datetime(2021, 7, 25)
+
+        self.assertEqual(format_date(date), date.strftime('%A, %b %d %Y'))
+        self.assertEqual(format_date(datetime(2021, 7, 25)),
+                         'Sunday, Jul 25 2021')
+        self.assertEqual(format_date.cache_info().hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
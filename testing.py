@@ -0,0 +1,274 @@
+'''Fixtures of the test suite, no PostgreSQL server or Auth0 tenant needed
+
+- LocalIssuer signs tokens with an RSA key generated at start and serves
+  its public half to auth0.jwks_cache as the JWKS.
+- WorkerDatabase builds one database per test worker (SQLite by default,
+  PostgreSQL with TEST_DATABASE_URL) once, and runs every test in a
+  transaction rolled back afterwards. Commits of the app release a
+  SAVEPOINT and rollbacks return to it, so writes look durable within a
+  test and are gone after it.
+
+Test workers of pytest-xdist (`python -m pytest -n auto`) get a database
+each, named after PYTEST_XDIST_WORKER.
+'''
+
+import atexit
+import base64
+import os
+import shutil
+import tempfile
+import time
+
+from datetime import datetime
+
+# Tokens are signed locally, these settings only have to be the same for
+# the issuer and auth0. pytest sets them in conftest.py before importing
+# any test module, these cover `python test_app.py`.
+os.environ.setdefault('AUTH0_DOMAIN', 'test.local')
+os.environ.setdefault('API_AUDIENCE', 'capstone')
+os.environ.setdefault('ALGORITHMS', '["RS256"]')
+
+import rsa  # noqa: E402
+from jose import jwt  # noqa: E402
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.engine.url import make_url  # noqa: E402
+from flask_sqlalchemy import SignallingSession  # noqa: E402
+
+import auth0  # noqa: E402
+from models import setup_db, db, Actor, Movie  # noqa: E402
+
+# Database url the test databases are derived from, the name of the
+# pytest-xdist worker is appended to the database name. Unset, every
+# worker uses a SQLite file in a temporary directory.
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+ROLES = {
+    'assistant': ['get:actors', 'get:movies'],
+    'director': ['delete:actors', 'get:actors', 'get:movies',
+                 'patch:actors', 'patch:movies', 'post:actors'],
+    'producer': ['delete:actors', 'delete:movies', 'get:actors',
+                 'get:movies', 'patch:actors', 'patch:movies',
+                 'post:actors', 'post:movies'],
+}
+
+# Rows every test starts with, the same as in test_capstone.psql
+SEED = [
+    (Movie, {'title': 'Test Movie1', 'release_date': datetime(2025, 9, 25)}),
+    (Movie, {'title': 'Test Movie2', 'release_date': datetime(2030, 10, 10)}),
+    (Movie, {'title': 'Test Movie3', 'release_date': datetime(2022, 1, 1)}),
+    (Actor, {'name': 'Test Actor1', 'age': 35, 'gender': 'male'}),
+    (Actor, {'name': 'Test Actress', 'age': 22, 'gender': 'female'}),
+    (Actor, {'name': 'Test Actor2', 'age': 53, 'gender': 'male'}),
+]
+
+
+def _base64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    '''LocalIssuer
+    Signs tokens the way the Auth0 tenant does, with a key of its own
+
+    Parameters
+    ----------
+    kid: key id in the token headers and the JWKS
+    bits: RSA key size, small keys keep the start fast
+    '''
+
+    def __init__(self, kid='test-key', bits=1024):
+        public, private = rsa.newkeys(bits)
+        self.kid = kid
+        self.private_key = private.save_pkcs1().decode()
+        self.jwks = {'keys': [{
+            'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+            'n': _base64_int(public.n), 'e': _base64_int(public.e)}]}
+
+    def install(self):
+        '''Makes auth0.jwks_cache read the keys of this issuer'''
+
+        auth0.jwks_cache.set_source(lambda: self.jwks)
+
+    def token(self, permissions, sub='test|user', expires_in=3600,
+              **claims):
+        '''Returns a token accepted by auth0.verify_decode_jwt
+
+        Parameters
+        ----------
+        permissions: list of permissions or the name of one of ROLES
+        sub: subject of the token
+        expires_in: seconds until expiry, negative for expired tokens
+        claims: claims added to or replacing the default ones
+        '''
+
+        if isinstance(permissions, str):
+            sub = f'test|{permissions}'
+            permissions = ROLES[permissions]
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{auth0.AUTH0_DOMAIN}/',
+            'aud': auth0.API_AUDIENCE,
+            'sub': sub,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_key, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def header(self, permissions, **kwargs):
+        '''Returns an Authorization header with a token, see token'''
+
+        return {'Authorization':
+                f'Bearer {self.token(permissions, **kwargs)}'}
+
+
+def worker_database_url(url=TEST_DATABASE_URL,
+                        worker=os.getenv('PYTEST_XDIST_WORKER')):
+    '''Returns the url of the database of this test worker, None for a
+    SQLite file
+    '''
+
+    if not url:
+        return None
+    url = make_url(url)
+    if worker:
+        url.database = f'{url.database}_{worker}'
+    return str(url)
+
+
+def _begin_sqlite_transactions(engine):
+    '''Lets SQLAlchemy emit BEGIN on SQLite, pysqlite defers it to the
+    first write and breaks SAVEPOINT
+    '''
+
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+
+class WorkerDatabase:
+    '''WorkerDatabase
+    Database of one test worker, built once with the schema and the SEED
+    rows
+
+    Parameters
+    ----------
+    url: database url, see worker_database_url, None for a SQLite file
+    '''
+
+    def __init__(self, url=None):
+        self.url = url
+        self.directory = None
+        self.built = False
+        self.engine = None
+        self.connection = None
+        self.transaction = None
+        self.savepoint = None
+        self._session = None
+        # on the session class, listeners of the sessionmaker class
+        # would hide the ones of models
+        event.listen(SignallingSession, 'after_transaction_create',
+                     self._restart_savepoint)
+        event.listen(SignallingSession, 'after_commit',
+                     self._release_savepoint)
+
+    def build(self):
+        '''Creates the database, its tables and the SEED rows, once'''
+
+        if self.built:
+            return
+        if self.url is None:
+            self.directory = tempfile.mkdtemp(prefix='capstone-test-')
+            self.url = 'sqlite:///' + os.path.join(self.directory,
+                                                   'capstone.db')
+        else:
+            self._create_database()
+        engine = create_engine(self.url)
+        try:
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                for model, values in SEED:
+                    connection.execute(model.__table__.insert(), values)
+        finally:
+            engine.dispose()
+        self.built = True
+
+    def _create_database(self):
+        # a fresh database, from the server's maintenance database
+        url = make_url(self.url)
+        name = url.database
+        url.database = 'postgres'
+        server = create_engine(str(url), isolation_level='AUTOCOMMIT')
+        try:
+            server.execute(f'DROP DATABASE IF EXISTS "{name}"')
+            server.execute(f'CREATE DATABASE "{name}"')
+        finally:
+            server.dispose()
+
+    def destroy(self):
+        '''Removes the SQLite file, PostgreSQL databases are dropped by
+        the next build
+        '''
+
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def setup_app(self, app):
+        '''Builds the database if needed and binds app to it'''
+
+        self.build()
+        setup_db(app, self.url, [])
+        with app.app_context():
+            self.engine = db.get_engine(app)
+        if self.engine.dialect.name == 'sqlite':
+            _begin_sqlite_transactions(self.engine)
+            self.engine.dispose()
+
+    def begin(self):
+        '''Starts the transaction of a test, db.session uses it until
+        rollback is called
+        '''
+
+        self.connection = self.engine.connect()
+        self.transaction = self.connection.begin()
+        self.savepoint = self.connection.begin_nested()
+        self._session = db.session
+        db.session = db.create_scoped_session(
+            {'bind': self.connection, 'binds': {}})
+
+    def _in_test(self, session):
+        return self.connection is not None and \
+            session.bind is self.connection
+
+    def _restart_savepoint(self, session, transaction):
+        # the session rolled the savepoint back
+        if self._in_test(session) and transaction.parent is None and \
+                not self.savepoint.is_active:
+            self.savepoint = self.connection.begin_nested()
+
+    def _release_savepoint(self, session):
+        if self._in_test(session) and self.savepoint.is_active:
+            self.savepoint.commit()
+
+    def rollback(self):
+        '''Rolls back everything written since begin'''
+
+        db.session.remove()
+        db.session = self._session
+        if self.savepoint.is_active:
+            self.savepoint.rollback()
+        self.transaction.rollback()
+        self.connection.close()
+        self.connection = None
+
+
+issuer = LocalIssuer()
+database = WorkerDatabase(worker_database_url())
+atexit.register(database.destroy)